@@ -0,0 +1,139 @@
+"""Positions as rows of a NumPy bitboard array, for batch queries.
+
+Each position is 12 uint64 bitboards, one per colour and piece type (White's
+pawns, knights, bishops, rooks, queens and king, then Black's). Material,
+piece counts, game phases and material signatures are then computed for all
+the positions of a game, or of a whole corpus, at once with a vectorized
+popcount, instead of with a few Python calls per position.
+"""
+
+import chess
+import chess.pgn
+import numpy as np
+
+import helpers
+import utils
+
+piece_types = [chess.PAWN, chess.KNIGHT, chess.BISHOP, chess.ROOK,
+               chess.QUEEN, chess.KING]
+# Column of each (colour, piece type)
+columns = {(color, piece_type): (0 if color else 6) + i
+           for color in [chess.WHITE, chess.BLACK]
+           for i, piece_type in enumerate(piece_types)}
+piece_values = np.array([utils.values.get(piece_type, 0)
+                         for piece_type in piece_types], dtype=np.int32)
+# Order pieces are listed in by material signatures
+signature_order = [chess.KING, chess.QUEEN, chess.ROOK, chess.BISHOP,
+                   chess.KNIGHT, chess.PAWN]
+
+
+def board_bitboards(board: chess.Board) -> np.ndarray:
+    """A position's 12 bitboards."""
+    return np.array([board.pieces_mask(piece_type, color)
+                     for color in [chess.WHITE, chess.BLACK]
+                     for piece_type in piece_types], dtype=np.uint64)
+
+
+def game_bitboards(game) -> np.ndarray:
+    """ Bitboards of every position in a game, from the starting position
+    to the final one.
+
+    :param game: a chess.pgn.Game, or a final board with the mainline on its
+        move stack (e.g. from helpers.HeadersAndFinalBoard).
+
+    :return: (plies + 1) x 12 uint64 array.
+    """
+    if isinstance(game, chess.pgn.Game):
+        board = game.board()
+        moves = list(game.mainline_moves())
+    else:
+        board = game.root()
+        moves = game.move_stack
+    rows = np.empty((len(moves) + 1, 12), dtype=np.uint64)
+    rows[0] = board_bitboards(board)
+    for i, move in enumerate(moves, start=1):
+        board.push(move)
+        rows[i] = board_bitboards(board)
+    return rows
+
+
+def _final_board_bitboards(headers_and_board) -> np.ndarray:
+    return game_bitboards(headers_and_board[1])
+
+
+def corpus_bitboards(pgn_path: str, processes: int = None):
+    """ Bitboards of every position of every game in a PGN file.
+
+    :return: (all positions x 12 array, index of each game's first row,
+        game links)
+    """
+    offsets, gamelinks = helpers.game_offsets(pgn_path)
+    games = helpers.map_games(_final_board_bitboards, pgn_path, offsets,
+                              visitor=helpers.HeadersAndFinalBoard,
+                              processes=processes)
+    starts = np.cumsum([0] + [len(rows) for rows in games[:-1]])
+    rows = np.concatenate(games) if games \
+        else np.empty((0, 12), dtype=np.uint64)
+    return rows, starts, gamelinks
+
+
+def popcount(bitboards: np.ndarray) -> np.ndarray:
+    """Number of set bits in each uint64."""
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(bitboards)
+    # SWAR popcount, for NumPy < 2.0
+    x = bitboards - ((bitboards >> np.uint64(1)) &
+                     np.uint64(0x5555555555555555))
+    x = (x & np.uint64(0x3333333333333333)) + \
+        ((x >> np.uint64(2)) & np.uint64(0x3333333333333333))
+    x = (x + (x >> np.uint64(4))) & np.uint64(0x0F0F0F0F0F0F0F0F)
+    return ((x * np.uint64(0x0101010101010101)) >> np.uint64(56)).astype(
+        np.uint8)
+
+
+def piece_counts(bitboards: np.ndarray) -> np.ndarray:
+    """N x 12 counts of each colour and piece type."""
+    return popcount(bitboards).astype(np.uint8)
+
+
+def material(bitboards: np.ndarray) -> np.ndarray:
+    """N x 2 material (White's, Black's), in pawns, as in
+    utils.material_count."""
+    counts = piece_counts(bitboards).astype(np.int32)
+    return np.stack([counts[:, :6] @ piece_values,
+                     counts[:, 6:] @ piece_values], axis=1)
+
+
+def material_diff(bitboards: np.ndarray, side: chess.Color) -> np.ndarray:
+    """Material difference from side's point of view, as in
+    utils.material_diff."""
+    both = material(bitboards)
+    diff = both[:, 0] - both[:, 1]
+    return diff if side else -diff
+
+
+def phases(bitboards: np.ndarray) -> np.ndarray:
+    """Game phase of each position, as in utils.game_phase."""
+    counts = piece_counts(bitboards).astype(np.int32)
+    # Knights, bishops, rooks and queens of both sides
+    majors_and_minors = counts[:, [1, 2, 3, 4, 7, 8, 9, 10]].sum(axis=1)
+    return np.select([majors_and_minors <= 6, majors_and_minors <= 10],
+                     ["endgame", "middlegame"], "opening")
+
+
+def signatures(bitboards: np.ndarray) -> np.ndarray:
+    """Material signature of each position, as in
+    utils.material_signature."""
+    counts = piece_counts(bitboards)
+    if not len(counts):
+        return np.empty(0, dtype=object)
+    # Most positions in a game share their material, so only build each
+    # distinct signature once
+    distinct, inverse = np.unique(counts, axis=0, return_inverse=True)
+    names = np.array([
+        "v".join("".join(chess.piece_symbol(piece_type).upper() *
+                         int(row[columns[color, piece_type]])
+                         for piece_type in signature_order)
+                 for color in [chess.WHITE, chess.BLACK])
+        for row in distinct], dtype=object)
+    return names[inverse.reshape(-1)]
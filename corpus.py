@@ -0,0 +1,149 @@
+"""Several PGN files read as one collection of games.
+
+A corpus is given as any mix of:
+
+- PGN files, optionally compressed (.pgn.gz, .pgn.bz2 or .pgn.xz)
+- glob patterns, e.g. "inputs/season-*/*.pgn" ("**" matches any number of
+  directories)
+- manifests: text files (.txt) listing any of the above, one per line, with
+  paths relative to the manifest; blank lines and lines starting with # are
+  ignored
+
+Each file's game offsets, links and keys (see helpers.scan_games()) are
+cached in cache_dir, and only rescanned when the file changes, so adding a
+new season's PGN to a corpus only scans that file. Files are scanned in
+parallel, biggest first, so one big file doesn't leave the other workers
+idle at the end.
+
+Games in a corpus are located by (path, offset) pairs instead of offsets,
+and helpers.game_offsets(), map_games(), analyse_games(), etc. accept a
+Corpus wherever they accept a PGN path. Copies of a game in several files
+are only counted once.
+"""
+
+import glob
+import hashlib
+import json
+import multiprocessing
+import os
+
+from tqdm import tqdm
+
+import helpers
+
+default_cache_dir = "inputs/.corpus_index"
+manifest_extensions = {".txt"}
+
+
+def expand(specs: list) -> list:
+    """The PGN files that files, globs and manifests refer to, in order and
+    without repeats."""
+    files = []
+    for spec in specs:
+        if glob.has_magic(spec):
+            found = sorted(glob.glob(spec, recursive=True))
+            if not found:
+                print(f"No files match {spec}")
+            files.extend(expand(found))
+        elif os.path.splitext(spec)[1] in manifest_extensions:
+            base = os.path.dirname(spec)
+            with open(spec) as f:
+                lines = [line.strip() for line in f]
+            files.extend(expand([os.path.join(base, line) for line in lines
+                                 if line and not line.startswith("#")]))
+        elif not os.path.exists(spec):
+            raise FileNotFoundError(spec)
+        else:
+            files.append(spec)
+    return list(dict.fromkeys(files))
+
+
+def _scan_file(task):
+    path, cache_path = task
+    offsets, gamelinks, keys = helpers.scan_games(path)
+    stat = os.stat(path)
+    with open(f"{cache_path}.tmp", "w") as f:
+        json.dump({"size": stat.st_size, "mtime": stat.st_mtime,
+                   "offsets": offsets, "gamelinks": gamelinks, "keys": keys},
+                  f)
+    os.replace(f"{cache_path}.tmp", cache_path)
+    return path, (offsets, gamelinks, keys)
+
+
+class Corpus:
+    """PGN files, globs and manifests, read as one collection of games."""
+
+    def __init__(self, specs: list, cache_dir: str = default_cache_dir):
+        self.specs = list(specs)
+        self.files = expand(self.specs)
+        self.cache_dir = cache_dir
+
+    def __str__(self):
+        return f"{len(self.files)} PGN files ({', '.join(self.specs)})"
+
+    def _cache_path(self, path: str) -> str:
+        name = hashlib.sha1(os.path.abspath(path).encode()).hexdigest()
+        return os.path.join(self.cache_dir, f"{name}.json")
+
+    def _cached(self, path: str):
+        """A file's cached scan, or None if it's missing or out of date."""
+        try:
+            with open(self._cache_path(path)) as f:
+                cached = json.load(f)
+        except (OSError, ValueError):
+            return None
+        stat = os.stat(path)
+        if (cached["size"], cached["mtime"]) != (stat.st_size,
+                                                 stat.st_mtime):
+            return None
+        return cached["offsets"], cached["gamelinks"], cached["keys"]
+
+    def scan(self, processes: int = None) -> dict:
+        """ Each file's game offsets, links and keys, from the cache where
+        possible.
+
+        :param processes: worker processes for the files that need scanning.
+            Default value: one per CPU.
+
+        :return: {path: (offsets, links, keys)}
+        """
+        scans = {path: self._cached(path) for path in self.files}
+        todo = sorted((path for path, scan in scans.items() if scan is None),
+                      key=os.path.getsize, reverse=True)
+        if todo:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            tasks = [(path, self._cache_path(path)) for path in todo]
+            with multiprocessing.Pool(min(processes or os.cpu_count(),
+                                          len(tasks))) as pool:
+                for path, scan in tqdm(pool.imap_unordered(_scan_file, tasks),
+                                       total=len(tasks), unit=" files"):
+                    scans[path] = scan
+        return scans
+
+    def game_offsets(self, dedupe: bool = True, processes: int = None):
+        """(path, offset) and link of each game in the corpus, leaving out
+        copies of games seen earlier (in the same file or an earlier one)
+        unless dedupe is False."""
+        scans = self.scan(processes)
+        locations, gamelinks, seen = [], [], set()
+        skipped = 0
+        for path in self.files:
+            for offset, link, key in zip(*scans[path]):
+                if dedupe:
+                    if key in seen:
+                        skipped += 1
+                        continue
+                    seen.add(key)
+                locations.append((path, offset))
+                gamelinks.append(link)
+        if skipped:
+            print(f"Skipping {skipped} duplicate games in {self}")
+        return locations, gamelinks
+
+
+def open_pgn(specs: list, cache_dir: str = default_cache_dir):
+    """A single PGN file's path as is, or else a Corpus."""
+    if len(specs) == 1 and not glob.has_magic(specs[0]) and \
+            os.path.splitext(specs[0])[1] not in manifest_extensions:
+        return specs[0]
+    return Corpus(specs, cache_dir)
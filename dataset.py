@@ -0,0 +1,176 @@
+"""Convert a PGN corpus into a columnar ply dataset.
+
+Parsing PGN text is by far the slowest way to read games, so this does it
+once. A dataset is a directory containing:
+
+- games.csv: one row per game, with its headers and its offset in the PGN
+- plies-00000.npy, plies-00001.npy, ...: one row per mainline ply, stored as
+  NumPy structured arrays in partitions of `partition_size` games
+
+Ply partitions can be memory-mapped, so detectors and statistics can run as
+vectorized scans over them without going through chess.pgn.read_game.
+"""
+
+import glob
+import os
+
+import chess
+import chess.pgn
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+
+import helpers
+import utils
+
+mate_score = 100000
+no_eval = np.iinfo(np.int32).min
+no_clock = -1
+
+ply_dtype = np.dtype([
+    ("game", np.uint32),      # row index in games.csv
+    ("ply", np.uint16),       # 1 for White's first move
+    ("move", np.uint16),      # see encode_move()
+    ("eval", np.int32),       # centipawns from White's POV, or no_eval
+    ("clock", np.int32),      # mover's remaining seconds, or no_clock
+    ("white_material", np.uint8),
+    ("black_material", np.uint8),
+    ("pieces", np.uint8),     # all pieces on the board, kings included
+])
+
+
+def encode_move(move: chess.Move) -> int:
+    """Pack a move into 16 bits: from square, to square, promotion type."""
+    return move.from_square | move.to_square << 6 | (move.promotion or 0) << 12
+
+
+def decode_moves(moves: np.ndarray):
+    """Unpack an array of encoded moves into from, to and promotion arrays."""
+    moves = moves.astype(np.uint16)
+    return moves & 63, (moves >> 6) & 63, moves >> 12
+
+
+def decode_move(move: int) -> chess.Move:
+    """Unpack a single encoded move."""
+    return chess.Move(move & 63, (move >> 6) & 63, (move >> 12) or None)
+
+
+def game_plies(game: chess.pgn.Game, game_index: int) -> np.ndarray:
+    """Build the ply rows for a game's mainline."""
+    rows = []
+    board = game.board()
+    for node in game.mainline():
+        board.push(node.move)
+        score = node.eval()
+        clock = node.clock()
+        rows.append((
+            game_index,
+            board.ply(),
+            encode_move(node.move),
+            no_eval if score is None
+            else score.white().score(mate_score=mate_score),
+            no_clock if clock is None else int(clock),
+            utils.material_count(board, chess.WHITE),
+            utils.material_count(board, chess.BLACK),
+            chess.popcount(board.occupied),
+        ))
+    return np.array(rows, dtype=ply_dtype)
+
+
+def build_dataset(pgn_path: str,
+                  out_dir: str,
+                  partition_size: int = 10000):
+    """Convert every game in a PGN file into a ply dataset.
+
+    :param pgn_path: path to the input PGN.
+    :param out_dir: directory to write the dataset to.
+    :param partition_size: number of games per ply partition. Default value:
+        10000.
+
+    :return: number of games converted.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    for old in glob.glob(os.path.join(out_dir, "plies-*.npy")):
+        os.remove(old)
+
+    pgn = helpers.read_pgn(pgn_path)
+    games = []
+    plies = []
+    partition = 0
+    with tqdm(unit=" games") as progress:
+        while True:
+            offset = pgn.tell()
+            game = chess.pgn.read_game(pgn)
+            if game is None:
+                break
+            plies.append(game_plies(game, len(games)))
+            games.append({"game": len(games), "offset": offset,
+                          **game.headers})
+            progress.update()
+            if len(plies) == partition_size:
+                _save_partition(out_dir, partition, plies)
+                partition += 1
+                plies = []
+    if plies:
+        _save_partition(out_dir, partition, plies)
+    pgn.close()
+
+    pd.DataFrame(games).to_csv(os.path.join(out_dir, "games.csv"),
+                               index=False)
+    return len(games)
+
+
+def _save_partition(out_dir: str, partition: int, plies: list):
+    np.save(os.path.join(out_dir, f"plies-{partition:05}.npy"),
+            np.concatenate(plies))
+
+
+def load_games(out_dir: str) -> pd.DataFrame:
+    """Read a dataset's games table."""
+    return pd.read_csv(os.path.join(out_dir, "games.csv"), dtype=str,
+                       keep_default_na=False).astype({"game": int,
+                                                      "offset": int})
+
+
+def iter_plies(out_dir: str, mmap: bool = True):
+    """Yield each ply partition of a dataset, memory-mapped by default."""
+    for path in sorted(glob.glob(os.path.join(out_dir, "plies-*.npy"))):
+        yield np.load(path, mmap_mode="r" if mmap else None)
+
+
+def load_plies(out_dir: str) -> np.ndarray:
+    """Read all ply partitions of a dataset into one array."""
+    parts = list(iter_plies(out_dir, mmap=False))
+    return np.concatenate(parts) if parts else np.empty(0, dtype=ply_dtype)
+
+
+def game_bounds(plies: np.ndarray):
+    """Find where each game's rows start and end in a ply array.
+
+    :return: game indexes, start rows and end rows (exclusive).
+    """
+    if len(plies) == 0:
+        empty = np.empty(0, dtype=np.int64)
+        return empty, empty, empty
+    starts = np.flatnonzero(np.diff(plies["game"])) + 1
+    starts = np.concatenate(([0], starts))
+    ends = np.concatenate((starts[1:], [len(plies)]))
+    return plies["game"][starts], starts, ends
+
+
+def start_board(game: dict) -> chess.Board:
+    """A game's starting position, from its row in the games table: the
+    [FEN] header's position for games set up from one, else the standard
+    starting position."""
+    fen = game.get("FEN", "")
+    return chess.Board(fen) if fen else chess.Board()
+
+
+def replay(rows: np.ndarray, board: chess.Board = None) -> chess.Board:
+    """Replay a game's ply rows from `board` (for games set up from a FEN,
+    see start_board()), or else the standard starting position."""
+    board = chess.Board() if board is None else board
+    for move in rows["move"]:
+        board.push(decode_move(int(move)))
+    return board
+
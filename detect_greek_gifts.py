@@ -4,133 +4,278 @@ Motivated by a suggestion by https://lichess.org/@/AACtrl in the Lichess4545
 Slack.
 Objective: identify likely Greek gift sacs and assess their quality using
 PGN eval data or a local engine.
-Current version appears to identify mostly plausible sacs but only for White
-and doesn't check sac quality.
+Current version appears to identify mostly plausible sacs by either side.
+Each sac is scored with the eval before it, the eval after the best defence
+(and the best defensive line), and the eval after it was accepted. These
+come from the game's [%eval] comments where Lichess has analysed it; only
+sacs in games without evals are sent to the engine, several at a time.
 
-TODO: expand to identify sacs by Black
 TODO: add castling and king position logic
-TODO: add engine checks
 """
 
-import random
+import concurrent.futures
+import threading
 
 import chess
+import chess.engine
 import pandas as pd
-from chess.pgn import ChildNode
 from tqdm import tqdm
-from datetime import datetime
 
-import choices
+import engine_analysis
 import helpers
-from helpers import read_pgn
+import pipeline
+import sampling
+import store
+import utils
 
 # Helpers and parameters
 task_label = "GreekGifts"
-now = datetime.now()
-now_label = f"{now.year}{now.month}{now.day}_{now.hour}{now.minute}"
-
-# Read PGN file
-pgn = read_pgn(helpers.pgn_path)
-
-# For game data
-all_offsets = []
-all_gamelinks = []
-offsets = []
-gamelinks = []
-
-# For 'candidate' sac data
-can_ucis = []
-can_links = []
-can_movetext = []
-can_fens = []
-
-
-# Scan PGN headers for faster parsing
-while True:
-    offset = pgn.tell()
-    headers = chess.pgn.read_headers(pgn)
-    if headers is None:
-        break
+# Bump when analyse_game's logic changes, so stored results aren't reused
+result_version = 2
+# Length of the best defensive line reported, in plies
+defence_plies = 6
+default_time_per_position = 0.5
+default_engine_workers = 4
+# Centipawns a sac can cost, against the best defence, and still count as
+# sound (or dubious)
+sound_loss = 50
+dubious_loss = 150
+scores = ["eval_before", "eval_after_sac", "eval_after_acceptance",
+          "best_defence"]
+
+
+def pgn_scores(nodes: list, i: int, side: chess.Color) -> dict:
+    """ Score a sac from the [%eval] comments in a game.
+
+    :param nodes: the game and its mainline nodes, so nodes[i] is the sac.
+    :param i: index of the sac's node.
+    :param side: the side that sacrificed.
+
+    :return: evals (from side's point of view, in centipawns) before the sac,
+        after it against the best defence, and after the move played in
+        reply, with the best defence in SAN; or {} if the game has no evals
+        for these positions.
+    """
+    evals = [node.eval() for node in nodes[i - 1:i + 2]]
+    if None in evals:
+        return {}
+    before, after_sac, after_acceptance = [
+        score.pov(side).score(mate_score=engine_analysis.mate_score)
+        for score in evals]
+    # Lichess gives the best move as a variation when the move played was an
+    # inaccuracy or worse, so otherwise the reply played was the defence
+    sac = nodes[i]
+    defence = sac.variations[1] if len(sac.variations) > 1 \
+        else sac.variations[0]
+    line = []
+    while defence is not None and len(line) < defence_plies:
+        line.append(defence.move)
+        defence = defence.next()
+    return {"eval_before": before, "eval_after_sac": after_sac,
+            "eval_after_acceptance": after_acceptance,
+            "best_defence": sac.board().variation_san(line),
+            "scored_by": "pgn"}
+
+
+def analyse_game(game: chess.pgn.Game) -> dict:
+    """Find probable Greek gift sacs in a game, scored from its [%eval]
+    comments where it has them."""
+    nodes = [game, *game.mainline()]
+    first_ply = game.board().ply()
+    candidates = []
+    for ply, move, fen in utils.greek_gifts(game):
+        i = ply - first_ply
+        candidates.append({"link": f"{game.headers['Site']}#{ply}",
+                           "uci": move.uci(), "fen": fen,
+                           "reply": nodes[i + 1].move.uci(),
+                           **pgn_scores(nodes, i, nodes[i - 1].turn())})
+    return {"candidates": candidates}
+
+
+def engine_scores(engine: chess.engine.SimpleEngine,
+                  candidate: dict,
+                  limit: chess.engine.Limit) -> dict:
+    """Score a sac with an engine, as pgn_scores() does from [%eval]
+    comments."""
+    board = chess.Board(candidate["fen"])
+    side = board.turn
+    game_key = object()
+    before, _ = engine_analysis.position_eval(engine, board, limit, game_key)
+    board.push_uci(candidate["uci"])
+    info = engine.analyse(board, limit, game=game_key)
+    after_sac = info["score"].pov(side).score(
+        mate_score=engine_analysis.mate_score)
+    defence = board.variation_san(info.get("pv", [])[:defence_plies])
+    board.push_uci(candidate["reply"])
+    after_acceptance, _ = engine_analysis.position_eval(engine, board, limit,
+                                                       game_key)
+    return {"eval_before": before if side else -before,
+            "eval_after_sac": after_sac,
+            "eval_after_acceptance": after_acceptance if side
+            else -after_acceptance,
+            "best_defence": defence, "scored_by": "engine"}
+
+
+def score_with_engine(per_game: list,
+                      engine_path: str = helpers.engine_path,
+                      workers: int = default_engine_workers,
+                      time_per_position: float = default_time_per_position,
+                      results_store=None) -> list:
+    """ Score the candidates analyse_game() couldn't score from the PGN,
+    with several engines running at once.
+
+    :param per_game: each game's results.
+    :param engine_path: path to the engine.
+    :param workers: number of engines to run in parallel. Default value: 4.
+    :param time_per_position: seconds per position (three per sac). Default
+        value: 0.5.
+    :param results_store: optional store.ResultStore of scores, keyed by
+        candidate link.
+
+    :return: per_game, with scores added to every candidate.
+    """
+    candidates = [can for results in per_game
+                  for can in results["candidates"]]
+    unscored = [can for can in candidates if "scored_by" not in can]
+    found = results_store.load([can["link"] for can in unscored]) \
+        if results_store else {}
+    todo = [can for can in unscored if can["link"] not in found]
+    print(f"{len(candidates) - len(unscored)} sac(s) scored from PGN evals, "
+          f"{len(unscored) - len(todo)} from stored engine scores, "
+          f"{len(todo)} to score with the engine")
+
+    if todo:
+        limit = chess.engine.Limit(time=time_per_position)
+        local = threading.local()
+        engines = []
+        engines_lock = threading.Lock()
+
+        def score(can):
+            # One engine per worker thread, kept for all its sacs
+            if not hasattr(local, "engine"):
+                local.engine = chess.engine.SimpleEngine.popen_uci(
+                    engine_path)
+                with engines_lock:
+                    engines.append(local.engine)
+            return engine_scores(local.engine, can, limit)
+
+        try:
+            with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+                futures = {pool.submit(score, can): can for can in todo}
+                for future in tqdm(concurrent.futures.as_completed(futures),
+                                   total=len(futures)):
+                    link = futures[future]["link"]
+                    found[link] = future.result()
+                    if results_store:
+                        results_store.save({link: found[link]})
+        finally:
+            for engine in engines:
+                engine.quit()
+
+    return [{**results,
+             "candidates": [{**can, **found.get(can["link"], {})}
+                            for can in results["candidates"]]}
+            for results in per_game]
+
+
+def quality(candidate: dict) -> str:
+    """Label a scored sac by what it cost against the best defence."""
+    if candidate.get("eval_before") is None:
+        return ""
+    loss = candidate["eval_before"] - candidate["eval_after_sac"]
+    if loss <= sound_loss:
+        return "sound"
+    return "dubious" if loss <= dubious_loss else "unsound"
+
+
+def report(per_game: list, checked: str):
+    """Summarise per-game results and save the candidates to a
+    spreadsheet."""
+    now_label = helpers.timestamp()
+    candidates = helpers.merge_results(per_game, ["candidates"])["candidates"]
+
+    # After checking all moves in all games...
+    # Report # of identified candidates
+    can_links = [can["link"] for can in candidates]
+    print('')
+    print(f"Finished checking {checked} games!")
+    print(f"Found {len(candidates)} probable Greek gift sacrifice(s)")
+    print(f"{can_links}")
+
+    # Save candidate details, and their scores, to a spreadsheet
+    candidates_out = pd.DataFrame(data={
+        "link": can_links,
+        **{score: [can.get(score) for can in candidates]
+           for score in scores},
+        "quality": [quality(can) for can in candidates]})
+    print(candidates_out["quality"].replace("", "unscored")
+          .value_counts().to_string())
+    with pd.ExcelWriter(f"outputs/{task_label}_{now_label}.xlsx") as writer:
+        candidates_out.to_excel(writer, sheet_name=f"{task_label}")
+    print(f"Saved results in outputs/{task_label}_{now_label}.xlsx")
+    print('')
+    print('--- end ---')
+
+
+def run(pgn_path: str,
+        sample_size: int = 0,
+        sample_ids: list = None,
+        store_path: str = store.default_store_path,
+        games=None,
+        engine_path: str = helpers.engine_path,
+        engine_workers: int = default_engine_workers,
+        time_per_position: float = default_time_per_position,
+        seed: int = None,
+        stratify_by: str = None,
+        processes: int = None):
+    """Find Greek gift sacs in (a selection of) the games in a PGN file, or in
+    games streamed from the Lichess API (see ingest.stream_exports()),
+    reusing results kept in the result store at store_path (unless None).
+    Sacs in games without [%eval] comments are scored with engine_path
+    (or left unscored if it's None). Random samples are reproducible given a
+    seed, and can be stratified (see sampling.sample_games()). Without a
+    sample, every game is analysed as the PGN is read (see
+    pipeline.analyse_pgn()), by processes worker processes."""
+    whole_pgn = games is None and not (sample_size or sample_ids)
+    if whole_pgn:
+        print(f"Checking every game in {pgn_path} as it's read")
+    elif games is None:
+        offsets, keys, total = sampling.sample_games(
+            pgn_path, sample_size, sample_ids, seed, stratify_by)
+        print(f"About to check {len(offsets)} games (from {total} games in "
+              f"the input PGN)")
+    else:
+        print("Checking games as they're downloaded")
+    print('')
+
+    results_store = store.ResultStore(store_path, "greek_gifts",
+                                      {"version": result_version}) \
+        if store_path else None
+
+    # Check each move of each game in the sample or PGN file
+    if whole_pgn:
+        per_game = pipeline.analyse_pgn(analyse_game, pgn_path, results_store,
+                                        processes)
+        checked = f"{len(per_game)}"
+    elif games is None:
+        per_game = helpers.analyse_games(analyse_game, pgn_path, offsets,
+                                         keys, results_store)
+        checked = f"{len(offsets)} / {total}"
     else:
-        all_offsets.append(offset)
-        all_gamelinks.append(headers["Site"])
-
-# Pick a specific set of games to check, based on choices.py
-if choices.sample_games:
-    ## Sample games from input PGN
-    print(f"Sampling {choices.sample_size} games...")
-    print("")
-    offsets = random.sample(all_offsets, choices.sample_size)
-    for i in offsets:
-        gamelinks.append(all_gamelinks[all_offsets.index(i)])
-elif choices.sample_by_ids:
-    ## Select games by Lichess game ID
-    print("Sampling games by specific game ID...")
-    selected_ids = choices.sample_ids
-    for i in selected_ids:
-        offsets.append(all_offsets[all_gamelinks.index(f"{'https://lichess.org/'}{i}")])
-        gamelinks.append(f"{'https://lichess.org/'}{i}")
-    print(f"{len(gamelinks)} to check...")
-    print("")
-else:
-    ## Select all games in input PGN
-    offsets = all_offsets
-    gamelinks = all_gamelinks
-
-print(f"About to check {len(offsets)} games (from {len(all_offsets)} games in the "
-      f"input PGN)")
-print('')
-
-# Check each move of each game in the sample or PGN file
-for offset in tqdm(offsets):
-
-    pgn.seek(offset)
-    game = chess.pgn.read_game(pgn)
-    board = game.board()
-
-    for n in game.mainline():
-
-        # Since we're looking here for Greek gift sacrifices by White
-        # Ignore first, last, or penultimate plies
-        # Ignore any moves that aren't listed as Bxh7 or Bxh6 where a White
-        # bishop captures a Black pawn
-        if not (n.ply() == 1 or n.turn() or n.is_end() or n.next().is_end()) \
-                and \
-                n.san() in {"Bxh7+", "Bxh7", "Bxh6+", "Bxh6"} and \
-                board.is_capture(board.parse_san(n.san())) and \
-                board.piece_at(n.move.to_square).symbol() == "p" and \
-                n.next().turn():
-
-            board.push(n.move)
-
-            # Now check for Black follow-up captures by a pawn or the king
-            if board.is_capture(board.parse_san(n.next().san())) and\
-                    board.piece_at(n.next().move.to_square).symbol() in {"B"} and \
-                    board.piece_at(n.next().move.from_square).symbol() in {"k","p"}:
-
-                can_ucis.append(n.uci())
-                can_fens.append(n.parent.board().fen())
-                can_links.append(f"{game.headers['Site']}#{n.ply()}")
-
-        else:
-            board.push(n.move)
-            continue
-
-# After checking all moves in all games...
-# Report # of identified candidates
-print('')
-print(f"Finished checking {len(offsets)} / {len(all_offsets)} games!")
-print(f"Found {len(can_ucis)} probable Greek gift sacrifice(s)")
-print(f"{can_links}")
-
-# TODO: assess Greek gift sac quality using SF 14.1
-
-# Save candidate details to a spreadsheet
-candidates_out = pd.DataFrame(data = {"link": can_links})
-with pd.ExcelWriter(f"outputs/{task_label}_{now_label}.xlsx") as writer:
-    candidates_out.to_excel(writer, sheet_name=f"{task_label}")
-print(f"Saved results in outputs/{task_label}_{now_label}.xlsx")
-print('')
-print('--- end ---')
+        per_game = helpers.analyse_stream(analyse_game, games, results_store)
+        checked = f"{len(per_game)}"
+    if engine_path:
+        score_store = store.ResultStore(
+            store_path, "greek_gifts_engine",
+            {"version": result_version, "engine_path": str(engine_path),
+             "time_per_position": time_per_position}) \
+            if store_path else None
+        per_game = score_with_engine(per_game, engine_path, engine_workers,
+                                     time_per_position, score_store)
+    report(per_game, checked)
 
 
+if __name__ == '__main__':
+    import sys
+    import main
+    main.main(["greek-gifts"] + sys.argv[1:])
@@ -4,231 +4,175 @@
 # Detect back rank checkmates
 # To add: more interesting checkmates
 
-# USER OPTIONS
-# Select source of games
-# 1: Lichess game IDs
-# 2: previously uploaded PGN file ('games.pgn')
-games_source = 2
-
-# Choose whether to sample games (and sample size)
-sample_games = False
-sample_size = 200
-
 # =============================================================================
 
-from rich import print
-from tqdm import tqdm
-from chess import square_rank, square_file, Board, SquareSet, Piece, PieceType, \
-    square_distance
-from chess import KING, QUEEN, ROOK, BISHOP, KNIGHT, PAWN
-from chess import WHITE, BLACK, Outcome, Termination
-from chess.pgn import ChildNode
-from IPython.display import Image
-from IPython.display import display
-from IPython.display import HTML
-import cairosvg
-import chess.pgn
-import random
-import chess.svg
-import io
 import glob
 import os
-import pandas as pd
-import shutil
-
-import choices
-import utils
-
-# pgn_file = 'games.pgn'
-pgn_file = 'games_team4545_s12.pgn'
-
-# Read PGN
-pgn = open(pgn_file)
-
-offsets = []
-mates = []
-
-knight_mates = []
-bishop_mates = []
-pawn_mates = []
-backrank_mates = []
-anastasia_mates = []
-hook_mates = []
-arabian_mates = []
-smothered_mates = []
-
-knight_gameids = []
-bishop_gameids = []
-pawn_gameids = []
-backrank_gameids = []
-anastasia_gameids = []
-hook_gameids = []
-arabian_gameids = []
-smothered_gameids = []
-
-while True:
-
-    # Scan PGN headers for faster parsing
-    offset = pgn.tell()
-    headers = chess.pgn.read_headers(pgn)
-
-    if headers is None:
-        break
-    else:
-        offsets.append(offset)
 
-total_games = len(offsets)
+import chess
+import chess.pgn
+import chess.svg
+from chess import Termination
+
+import helpers
+import pipeline
+import sampling
+import store
+from mate_patterns import back_rank_mate, anastasia_mate, hook_mate, \
+    arabian_mate, smothered_mate
 
-# Get random sample of games
-offsets = random.sample(offsets, sample_size) if sample_games else offsets
+# Bump when analyse_game's logic changes, so stored results aren't reused
+result_version = 1
 
-print('#####################################')
-print("  IDENTIFY INTERESTING CHECKMATES  ")
-print('#####################################')
-print('')
-print(f"Reading {pgn_file} ({len(offsets)} games)")
-print('')
+# Kinds of mate, and how they're described in the summary
+mate_kinds = {"knight": "mate delivered by a knight",
+              "bishop": "mate delivered by a bishop",
+              "pawn": "mate delivered by a pawn",
+              "backrank": "a back rank mate",
+              "anastasia": "an Anastasia's mate",
+              "hook": "a hook mate",
+              "arabian": "an Arabian mate",
+              "smothered": "a smothered mate"}
 
-# Loop through each selected game
-for offset in tqdm(offsets):
+# Pieces whose mates are reported when they're the only checker
+mating_pieces = {chess.KNIGHT: "knight", chess.BISHOP: "bishop",
+                 chess.PAWN: "pawn"}
 
-    pgn.seek(offset)
-    game = chess.pgn.read_game(pgn)
+
+def analyse_game(game: chess.pgn.Game) -> dict:
+    """ Find the kinds of mate a game ended in.
+
+    :return: {"mates": [game ID] if the game ended in checkmate,
+        <mate kind>: [(game ID, SVG of the final position)]}
+    """
+    results = {"mates": [], **{kind: [] for kind in mate_kinds}}
 
     # Show all checkmates
     final = game.end().board()
     outcome = final.outcome()
     if outcome == None or not outcome.termination == Termination(1):
-        continue
+        return results
 
-    mates.append(game.headers['Site'][-8:])
+    gameid = game.headers['Site'][-8:]
+    results["mates"].append(gameid)
 
     # Get final position
     position = final.fen()
+    found = []
 
     # Identify the piece that delivered mate
     mate_piece = list(final.checkers())
-    if len(mate_piece) is 1:
+    if len(mate_piece) == 1:
         mate_square = chess.Square(mate_piece[0])
+        piece_type = final.piece_type_at(mate_square)
+        if piece_type in mating_pieces:
+            found.append(mating_pieces[piece_type])
 
-        if final.piece_at(mate_square).symbol() in ('n', 'N'):
-            knight_mates.append(chess.svg.board(final, lastmove=final.peek(),
-                                                size=250,
-                                                coordinates=False))
-            knight_gameids.append(game.headers['Site'][-8:])
-
-        if final.piece_at(mate_square).symbol() in ('b', 'B'):
-            bishop_mates.append(chess.svg.board(final, lastmove=final.peek(),
-                                                size=250,
-                                                coordinates=False))
-            bishop_gameids.append(game.headers['Site'][-8:])
-
-        if final.piece_at(mate_square).symbol() in ('p', 'P'):
-            pawn_mates.append(chess.svg.board(final, lastmove=final.peek(),
-                                              size=250,
-                                              coordinates=False))
-            pawn_gameids.append(game.headers['Site'][-8:])
-
-    # Back-rank mate
     if back_rank_mate(game):
-        backrank_mates.append(chess.svg.board(final, lastmove=final.peek(),
-                                              size=250,
-                                              coordinates=False))
-        backrank_gameids.append(game.headers['Site'][-8:])
-
-    # Anastasia's mate
+        found.append("backrank")
     if anastasia_mate(position):
-        anastasia_mates.append(chess.svg.board(final, lastmove=final.peek(),
-                                               size=250,
-                                               coordinates=False))
-        anastasia_gameids.append(game.headers['Site'][-8:])
-
-    # Hook mate
+        found.append("anastasia")
     if hook_mate(position):
-        hook_mates.append(chess.svg.board(final, lastmove=final.peek(),
-                                          size=250,
-                                          coordinates=False))
-        hook_gameids.append(game.headers['Site'][-8:])
-
-    # Arabian mate
+        found.append("hook")
     if arabian_mate(position):
-        arabian_mates.append(chess.svg.board(final, lastmove=final.peek(),
-                                             size=250,
-                                             coordinates=False))
-        arabian_gameids.append(game.headers['Site'][-8:])
-
-    # Smothered mates
+        found.append("arabian")
     if smothered_mate(position):
-        smothered_mates.append(chess.svg.board(final, lastmove=final.peek(),
-                                               size=250,
-                                               coordinates=False))
-        smothered_gameids.append(game.headers['Site'][-8:])
-
-# After checking all games...
-print('')
-print('==== RESULTS ====')
-print('')
-print(f"{len(mates)} games ended in checkmate")
-print('')
-print(f"{len(knight_mates)} games ended with mate delivered by a knight")
-print(f"{len(bishop_mates)} games ended with mate delivered by a bishop")
-print(f"{len(pawn_mates)} games ended with mate delivered by a pawn")
-print('')
-print(f"{len(backrank_mates)} games ended with a back rank mate")
-print(f"{len(anastasia_mates)} games ended with an Anastasia's mate")
-print(f"{len(hook_mates)} games ended with a hook mate")
-print(f"{len(arabian_mates)} games ended with an Arabian mate")
-print(f"{len(smothered_mates)} games ended with a smothered mate")
-print('')
-
-# First delete any previously saved PNGs
-for pngpath in glob.iglob(os.path.join('*.png')):
-    os.remove(pngpath)
-
-# Then save PNGs of knight/bishop/pawn mates
-for m in range(len(knight_mates)):
-    cairosvg.svg2png(bytestring=knight_mates[m],
-                     write_to=f"knight-mate-{m + 1:02}-{knight_gameids[m]}.png")
-
-for m in range(len(bishop_mates)):
-    cairosvg.svg2png(bytestring=bishop_mates[m],
-                     write_to=f"bishop-mate-{m + 1:02}-{bishop_gameids[m]}.png")
-
-for m in range(len(pawn_mates)):
-    cairosvg.svg2png(bytestring=pawn_mates[m],
-                     write_to=f"pawn-mate-{m + 1:02}-{pawn_gameids[m]}.png")
-
-for m in range(len(backrank_mates)):
-    cairosvg.svg2png(bytestring=backrank_mates[m],
-                     write_to=f"backrank-mate-{m + 1:02}-{backrank_gameids[m]}.png")
-
-for m in range(len(anastasia_mates)):
-    cairosvg.svg2png(bytestring=anastasia_mates[m],
-                     write_to=f"anastasia-mate-{m + 1:02}-{anastasia_gameids[m]}.png")
-
-for m in range(len(hook_mates)):
-    cairosvg.svg2png(bytestring=hook_mates[m],
-                     write_to=f"hook-mate-{m + 1:02}-{hook_gameids[m]}.png")
-
-for m in range(len(arabian_mates)):
-    cairosvg.svg2png(bytestring=arabian_mates[m],
-                     write_to=f"arabian-mate-{m + 1:02}-{arabian_gameids[m]}.png")
-
-for m in range(len(smothered_mates)):
-    cairosvg.svg2png(bytestring=smothered_mates[m],
-                     write_to=f"smothered-mate-{m + 1:02}-{smothered_gameids[m]}.png")
-
-# # Then display PNGs below
-# images = glob.glob("*.png")
-# images.sort()
-# for i in range(len(images)):
-#     display(str(i + 1) + ' / ' + str(len(images)),
-#             Image(filename = images[i]),
-#             '', '')
-
-
-
-
-
+        found.append("smothered")
+
+    for kind in found:
+        results[kind].append((gameid, chess.svg.board(final,
+                                                      lastmove=final.peek(),
+                                                      size=250,
+                                                      coordinates=False)))
+    return results
+
+
+def save_images(results: dict):
+    """Save PNGs of each kind of mate, replacing any saved previously."""
+    # Only needed for images, and slow to import
+    import cairosvg
+
+    # First delete any previously saved PNGs
+    for pngpath in glob.iglob(os.path.join('*.png')):
+        os.remove(pngpath)
+
+    for kind in mate_kinds:
+        for m, (gameid, svg) in enumerate(results[kind]):
+            cairosvg.svg2png(bytestring=svg,
+                             write_to=f"{kind}-mate-{m + 1:02}-{gameid}.png")
+
+
+def report(per_game: list, checked: str, images: bool = True):
+    """Summarise per-game results, saving images of the mates unless images
+    is False."""
+    results = helpers.merge_results(per_game, ["mates", *mate_kinds])
+
+    # After checking all games...
+    print('')
+    print('==== RESULTS ====')
+    print('')
+    print(f"Checked {checked} games")
+    print(f"{len(results['mates'])} games ended in checkmate")
+    print('')
+    for kind, description in mate_kinds.items():
+        print(f"{len(results[kind])} games ended with {description}")
+    print('')
+
+    if images:
+        save_images(results)
+
+
+def run(pgn_path: str,
+        sample_size: int = 0,
+        sample_ids: list = None,
+        images: bool = True,
+        store_path: str = store.default_store_path,
+        games=None,
+        seed: int = None,
+        stratify_by: str = None,
+        processes: int = None):
+    """Report interesting checkmates in (a selection of) the games in a PGN
+    file, or in games streamed from the Lichess API (see
+    ingest.stream_exports()), reusing results kept in the result store at
+    store_path (unless None). Random samples are reproducible given a seed,
+    and can be stratified (see sampling.sample_games()). Without a sample,
+    every game is analysed as the PGN is read (see pipeline.analyse_pgn()),
+    by processes worker processes."""
+    print('#####################################')
+    print("  IDENTIFY INTERESTING CHECKMATES  ")
+    print('#####################################')
+    print('')
+    whole_pgn = games is None and not (sample_size or sample_ids)
+    if whole_pgn:
+        print(f"Reading every game in {pgn_path}")
+    elif games is None:
+        offsets, keys, total_games = sampling.sample_games(
+            pgn_path, sample_size, sample_ids, seed, stratify_by)
+        print(f"Reading {pgn_path} ({len(offsets)} of {total_games} games)")
+    else:
+        print("Reading games as they're downloaded")
+    print('')
+
+    results_store = store.ResultStore(store_path, "mates",
+                                      {"version": result_version}) \
+        if store_path else None
+
+    # Loop through each selected game
+    if whole_pgn:
+        per_game = pipeline.analyse_pgn(analyse_game, pgn_path, results_store,
+                                        processes)
+        checked = f"{len(per_game)}"
+    elif games is None:
+        per_game = helpers.analyse_games(analyse_game, pgn_path, offsets,
+                                         keys, results_store)
+        checked = f"{len(offsets)} / {total_games}"
+    else:
+        per_game = helpers.analyse_stream(analyse_game, games, results_store)
+        checked = f"{len(per_game)}"
+    report(per_game, checked, images)
 
 
+if __name__ == '__main__':
+    import sys
+    import main
+    main.main(["mates"] + sys.argv[1:])
@@ -1,90 +1,230 @@
 """Identify sacs in games."""
 
-import random
+import functools
+import os
 
 import chess
+import chess.engine
 import pandas as pd
 from chess.pgn import ChildNode
 from tqdm import tqdm
 
-import choices
+import bitboards
 import helpers
+import memo
+import pipeline
+import position_index as positions
+import sampling
+import store
+import theory
 import utils
-from helpers import read_pgn, check_if_move_is_uniquely_nonlosing, \
-    check_position_against_masters_db
+import verify
+from helpers import check_if_move_is_uniquely_nonlosing
 
 # Helpers and parameters
 material_adv_threshold = 2
 winning_eval_threshold = 300
-gamelink_prefix = "https://lichess.org/"
-
-# Read PGN file
-pgn = read_pgn(helpers.pgn_path)
-
-# For game data
-all_offsets = []
-all_gamelinks = []
-offsets = []
-gamelinks = []
-
-# For 'candidate' sac data
-can_ucis = []
-can_svgs = []
-can_links = []
-can_white = []
-can_black = []
-can_movetext = []
-
-# For rejected candidate data
-forks = []
-skewers = []
-abspinned = []
-onlynonlosing = []
-trapped = []
-theory = []
-
-
-# Scan PGN headers for faster parsing
-while True:
-    offset = pgn.tell()
-    headers = chess.pgn.read_headers(pgn)
-    if headers is None:
-        break
-    else:
-        all_offsets.append(offset)
-        all_gamelinks.append(headers["Site"])
-
-# Pick a specific set of games to check, based on choices.py
-if choices.sample_games:
-    ## Sample games from input PGN
-    print(f"Sampling {choices.sample_size} games...")
-    print("")
-    offsets = random.sample(all_offsets, choices.sample_size)
-    for i in offsets:
-        gamelinks.append(all_gamelinks[all_offsets.index(i)])
-elif choices.sample_by_ids:
-    ## Select games by Lichess game ID
-    print("Sampling games by specific game ID...")
-    selected_ids = choices.sample_ids
-    for i in selected_ids:
-        offsets.append(all_offsets[all_gamelinks.index(f"{gamelink_prefix}{i}")])
-        gamelinks.append(f"{gamelink_prefix}{i}")
-    print(f"{len(gamelinks)} to check...")
-    print("")
-else:
-    ## Select all games in input PGN
-    offsets = all_offsets
-    gamelinks = all_gamelinks
-
-print(f"About to check {len(offsets)} games (from {len(all_offsets)} games in the "
-      f"input PGN)")
-print('')
-
-# For each selected game...
-for offset in tqdm(offsets):
-
-    pgn.seek(offset)
-    game = chess.pgn.read_game(pgn)
+# Moves are only checked after the first opening_plies plies, at least
+# ending_plies before the end (the checks look six plies ahead) and before
+# ply max_ply (since Lichess's server analysis only extends to ply 200)
+opening_plies = 6
+ending_plies = 6
+max_ply = 200
+# Min. matching master games for a candidate to count as theory
+theory_games = verify.theory_games
+# Bump when analyse_game's logic changes, so stored results aren't reused
+result_version = 1
+
+# Kinds of rejected candidates, and the sheets they're saved in
+rejections = {"forks": "forks",
+              "skewers": "skewers",
+              "abs_pinned": "abs_pinned",
+              "only_nonlosing": "nonlosing",
+              "trapped": "trapped",
+              "theory": "theory"}
+
+
+def sacrificed_material(board: chess.Board, n: ChildNode, mat_diff: dict,
+                        i: int, side: int):
+    """ Check whether a capture completes a sac, regardless of the thresholds
+    on the position before the sac, tactics, theory and the engine.
+
+    :param board: the position before the capture.
+    :param n: the capture, the i-th move of the game.
+    :param mat_diff: material difference in every position of the game, from
+        each side's point of view (see analyse_game()).
+    :param i: the capture's move number, from 1.
+    :param side: the side that played the candidate move (before n).
+
+    :return: the material given up after six plies, in centipawns, or None
+        if the capture doesn't complete a sac.
+    """
+    can: ChildNode = n.parent
+    precan: ChildNode = n.parent.parent
+
+    # Ignore non-captures
+    if not board.is_capture(board.parse_san(n.san())):
+        return None
+
+    # Ignore en passant captures
+    if board.is_en_passant((board.parse_san(n.san()))):
+        return None
+
+    # Ignore pawn captures
+    if board.piece_at(n.move.to_square).symbol() in {'P', 'p'}:
+        return None
+
+    # Ignore moves when in check
+    if precan.board().is_check():
+        return None
+
+    # Ignore moves immediately after a promotion
+    if can.move.promotion:
+        return None
+
+    # Ignore castling moves
+    if utils.is_castling(can):
+        return None
+
+    # Ignore captures of a side's last non-pawn piece (when they also have
+    # < 4 pawns)
+    nonpawns = len(board.pieces(2, precan.board().turn)) + \
+               len(board.pieces(3, precan.board().turn)) + \
+               len(board.pieces(4, precan.board().turn)) + \
+               len(board.pieces(5, precan.board().turn))
+    pawns = len(board.pieces(1, precan.board().turn))
+    if nonpawns == 1 and pawns < 4:
+        return None
+
+    # Identify the move after the post-candidate capture
+    child = n.next() if not n.next().is_end() else None
+
+    # Compute the candidate move's CPL
+    can_cpl = can.eval().pov(side).score(
+        mate_score=100000) - precan.eval().pov(side).score(
+        mate_score=100000)
+
+    # Compute change in eval for candidate colour
+    # Between the position 2 plies after the candidate and that before the candidate
+    # If this is higher than the loss in material to this point, reject
+    # If the material balance is positive or even after 2 plies, reject
+    after_two_cpl = child.eval().pov(side).score(
+        mate_score=100000) - precan.eval().pov(side).score(
+        mate_score=100000)
+    after_two_mat_diff = (mat_diff[side][i + 1] - mat_diff[side][i - 2]) * 100
+    after_two_mat_bal = mat_diff[side][i + 1]
+
+    # Reject cases where after 2 plies,
+    # material difference >= 0
+    # candidate CPL >= material loss
+    if after_two_mat_diff >= 0 or \
+            after_two_cpl * -1 > after_two_mat_diff * -1 or \
+            after_two_mat_bal >= 0:
+        return None
+
+    # Reject candidates where material is restored after 4 plies
+    grandchild = child.next()
+    grandchild2 = grandchild.next()
+
+    # Compute change in eval for candidate colour
+    # Between the position 4 plies after the candidate and that before the candidate
+    # If this is higher than the loss in material to this point, reject
+    after_four_cpl = grandchild2.eval().pov(side).score(
+        mate_score=100000) - precan.eval().pov(side).score(
+        mate_score=100000)
+    after_four_mat_diff = (mat_diff[side][i + 3] - mat_diff[side][i - 2]) * 100
+    after_four_mat_bal = mat_diff[side][i + 3]
+
+    if after_four_mat_diff >= 0 or \
+            after_four_cpl * -1 > after_four_mat_diff * -1 or \
+            after_four_mat_bal >= 0:
+        return None
+
+    # Reject candidates where material is restored after 6 plies
+    grandchild3 = grandchild2.next()
+    grandchild4 = grandchild3.next()
+
+    # Compute change in eval for candidate colour
+    # Between the position 6 plies after the candidate and that before the candidate
+    # If this is higher than the loss in material to this point, reject
+    after_six_cpl = grandchild4.eval().pov(side).score(
+        mate_score=100000) - precan.eval().pov(side).score(
+        mate_score=100000)
+    after_six_mat_diff = (mat_diff[side][i + 5] - mat_diff[side][i - 2]) * 100
+    after_six_mat_bal = mat_diff[side][i + 5]
+
+    if after_six_mat_diff >= 0 or \
+            after_six_cpl * -1 > after_six_mat_diff * -1 or \
+            after_six_mat_bal >= 0:
+        return None
+
+    return -after_six_mat_diff
+
+
+def explaining_tactic(n: ChildNode):
+    """ The tactic that explains a sac, if any.
+
+    :param n: the capture completing the sac.
+
+    :return: (rejection kind, ply to link to), or None.
+    """
+    precan = n.parent.parent
+
+    # Reject captures of absolutely pinned pieces
+    if utils.captured_piece_was_abs_pinned(n):
+        return "abs_pinned", precan.ply() + 1
+
+    # Reject captures of trapped pieces
+    if utils.trapped_piece(n):
+        return "trapped", precan.ply()
+
+    # Reject captures of skewered pieces
+    if utils.skewer(n):
+        return "skewers", precan.ply() + 1
+
+    # Reject captures of forked pieces
+    if utils.fork(precan):
+        return "forks", precan.ply()
+    # NB the fork method needs to be extended to avoid excluding certain
+    # kinds of valid sac that can arise after a fork
+    return None
+
+
+def analyse_game(game: chess.pgn.Game,
+                 theory_index: str = theory.default_index_path,
+                 online_theory: bool = True,
+                 engine_path: str = helpers.engine_path,
+                 defer_engine_check: bool = False,
+                 position_index: str = None,
+                 defer_theory_check: bool = False,
+                 candidate_time: float = None) -> dict:
+    """ Find candidate sacs in a game.
+
+    :param game: the game to check.
+    :param theory_index: path to the local opening-theory index.
+    :param online_theory: whether to query the Lichess Masters explorer when
+        there is no local theory index.
+    :param engine_path: path to the engine used for the only-non-losing check.
+    :param defer_engine_check: skip the only-non-losing check, leaving it to
+        engine_check_candidates(). The candidates then also have "fen",
+        "sacrificed" (material, in centipawns) and "eval" keys.
+    :param position_index: optional position index (see position_index.py).
+        Candidates then also have a "recurring" key: the number of other
+        indexed games that reached the position after the sac.
+    :param defer_theory_check: skip the theory check too, leaving both checks
+        to verify.Verifier. The candidates then also have a "theory_fen" key:
+        the position after the sac.
+    :param candidate_time: optional time budget, in seconds, for each
+        candidate's theory and engine checks. A candidate that runs over it
+        raises helpers.GameTimeout, as does the game running over a budget
+        set with helpers.time_limit() (see helpers.GameTimer).
+
+    :return: {"candidates": [candidate details], <rejection kind>: [links]}
+    """
+    results = {"candidates": [], **{kind: [] for kind in rejections}}
+    index = position_index and positions.open_index(position_index)
+    defer_engine_check = defer_engine_check or defer_theory_check
+
     board = game.board()
 
     # # Print game info
@@ -95,190 +235,60 @@ for offset in tqdm(offsets):
 
     last_ply = game.end().ply()
 
+    # Material difference in every position of the game, from each side's
+    # point of view, indexed by the position's number of moves from the start
+    white_diff = bitboards.material_diff(bitboards.game_bitboards(game),
+                                         chess.WHITE).tolist()
+    mat_diff = {1: white_diff, 0: [-diff for diff in white_diff]}
+
     # Check each move from first to last...
-    for n in game.mainline():
+    for i, n in enumerate(game.mainline(), start=1):
+        helpers.check_time()
 
         # Ignore moves before ply 7
-        if n.ply() <= 6:
+        if n.ply() <= opening_plies:
             board.push(n.move)
             last_move = n.move
             continue
 
         # Ignore moves that are either too close to the end or over ply 200
         # (since Lichess's server analysis only extends to ply 200)
-        if n.ply() > last_ply - 6 or n.ply() >= 200:
+        if n.ply() > last_ply - ending_plies or n.ply() >= max_ply:
             break
 
         # Identify the candidate move, the pre-candidate position, and the
         # side that played the candidate move
         can: ChildNode = n.parent
         precan: ChildNode = n.parent.parent
-        side = 1 if precan.board().turn else 0
+        side = 0 if board.turn else 1
 
         # Ignore moves played in objectively winning positions or when
         # significantly ahead in material
         if abs(can.eval().pov(side).score(mate_score=100000)) > winning_eval_threshold or \
-                utils.material_diff(precan.board(), side) >= material_adv_threshold:
-            board.push(n.move)
-            last_move = n.move
-            continue
-
-        # Ignore non-captures
-        if not board.is_capture(board.parse_san(n.san())):
-            board.push(n.move)
-            last_move = n.move
-            continue
-
-        # Ignore en passant captures
-        if board.is_en_passant((board.parse_san(n.san()))):
-            board.push(n.move)
-            last_move = n.move
-            continue
-
-        # Ignore pawn captures
-        if board.piece_at(n.move.to_square).symbol() in {'P', 'p'}:
-            board.push(n.move)
-            last_move = n.move
-            continue
-
-        # Ignore moves when in check
-        if precan.board().is_check():
-            board.push(n.move)
-            last_move = n.move
-            continue
-
-        # Ignore moves immediately after a promotion
-        if can.move.promotion:
-            board.push(n.move)
-            last_move = n.move
-            continue
-
-        # Ignore castling moves
-        if utils.is_castling(can):
-            board.push(n.move)
-            last_move = n.move
-            continue
-
-        # Ignore captures of a side's last non-pawn piece (when they also have
-        # < 4 pawns)
-        nonpawns = len(board.pieces(2, precan.board().turn)) + \
-                   len(board.pieces(3, precan.board().turn)) + \
-                   len(board.pieces(4, precan.board().turn)) + \
-                   len(board.pieces(5, precan.board().turn))
-        pawns = len(board.pieces(1, precan.board().turn))
-        if nonpawns == 1 and pawns < 4:
+                mat_diff[side][i - 2] >= material_adv_threshold:
             board.push(n.move)
             last_move = n.move
             continue
 
-        # Identify the move after the post-candidate capture
-        child = n.next() if not n.next().is_end() else None
-
-        # Compute the candidate move's CPL
-        can_cpl = can.eval().pov(side).score(
-            mate_score=100000) - precan.eval().pov(side).score(
-            mate_score=100000)
-
-        # Compute change in eval for candidate colour
-        # Between the position 2 plies after the candidate and that before the candidate
-        # If this is higher than the loss in material to this point, reject
-        # If the material balance is positive or even after 2 plies, reject
-        after_two_cpl = child.eval().pov(side).score(
-            mate_score=100000) - precan.eval().pov(side).score(
-            mate_score=100000)
-        after_two_mat_diff = (utils.material_diff(child.board(),
-                                                  side) - utils.material_diff(
-            precan.board(), side)) * 100
-        after_two_mat_bal = utils.material_diff(child.board(), side)
-
-        # Reject cases where after 2 plies,
-        # material difference >= 0
-        # candidate CPL >= material loss
-        if after_two_mat_diff >= 0 or \
-                after_two_cpl * -1 > after_two_mat_diff * -1 or \
-                after_two_mat_bal >= 0:
-            board.push(n.move)
-            last_move = n.move
-            continue
-
-        # Reject candidates where material is restored after 4 plies
-        grandchild = child.next()
-        grandchild2 = grandchild.next()
-
-        # Compute change in eval for candidate colour
-        # Between the position 4 plies after the candidate and that before the candidate
-        # If this is higher than the loss in material to this point, reject
-        after_four_cpl = grandchild2.eval().pov(side).score(
-            mate_score=100000) - precan.eval().pov(side).score(
-            mate_score=100000)
-        after_four_mat_diff = (utils.material_diff(grandchild2.board(),
-                                                   side) - utils.material_diff(
-            precan.board(), side)) * 100
-        after_four_mat_bal = utils.material_diff(grandchild2.board(), side)
-
-        if after_four_mat_diff >= 0 or \
-                after_four_cpl * -1 > after_four_mat_diff * -1 or \
-                after_four_mat_bal >= 0:
-            board.push(n.move)
-            last_move = n.move
-            continue
-
-        # Reject candidates where material is restored after 6 plies
-        grandchild3 = grandchild2.next()
-        grandchild4 = grandchild3.next()
-
-        # Compute change in eval for candidate colour
-        # Between the position 6 plies after the candidate and that before the candidate
-        # If this is higher than the loss in material to this point, reject
-        after_six_cpl = grandchild4.eval().pov(side).score(
-            mate_score=100000) - precan.eval().pov(side).score(
-            mate_score=100000)
-        after_six_mat_diff = (utils.material_diff(grandchild4.board(),
-                                                  side) - utils.material_diff(
-            precan.board(), side)) * 100
-        after_six_mat_bal = utils.material_diff(grandchild4.board(), side)
-
-        if after_six_mat_diff >= 0 or \
-                after_six_cpl * -1 > after_six_mat_diff * -1 or \
-                after_six_mat_bal >= 0:
+        # Ignore moves that don't complete a sac
+        sacrificed = sacrificed_material(board, n, mat_diff, i, side)
+        if sacrificed is None:
             board.push(n.move)
             last_move = n.move
             continue
 
         # Now apply some advanced checks...
 
-        # Reject captures of absolutely pinned pieces
-        if utils.captured_piece_was_abs_pinned(n):
-            abspinned.append(
-                f"{game.headers['Site'] + '#' + str(precan.ply() + 1)}")
-            board.push(n.move)
-            last_move = n.move
-            continue
-
-        # Reject captures of trapped pieces
-        if utils.trapped_piece(n):
-            trapped.append(
-                f"{game.headers['Site'] + '#' + str(precan.ply())}")
-            board.push(n.move)
-            last_move = n.move
-            continue
-
-        # Reject captures of skewered pieces
-        if utils.skewer(n):
-            skewers.append(f"{game.headers['Site'] + '#' + str(precan.ply() + 1)}")
+        # Reject captures explained by a tactic (absolutely pinned, trapped,
+        # skewered or forked pieces)
+        tactic = explaining_tactic(n)
+        if tactic:
+            kind, ply = tactic
+            results[kind].append(f"{game.headers['Site'] + '#' + str(ply)}")
             board.push(n.move)
             last_move = n.move
             continue
 
-        # Reject captures of forked pieces
-        if utils.fork(precan):
-            forks.append(f"{game.headers['Site'] + '#' + str(precan.ply())}")
-            board.push(n.move)
-            last_move = n.move
-            continue
-        # NB the fork method needs to be extended to avoid excluding certain
-        # kinds of valid sac that can arise after a fork
-
         # TODO: only consider candidates from objectively undecided positions
 
         # TODO: skip piece captures resulting from a double attack (and the
@@ -287,33 +297,52 @@ for offset in tqdm(offsets):
         # TODO: skip piece captures if a defender of the captured piece was
         #  forced to move away from the defence in the last move.
 
-        # Reject candidates that can be found in the Lichess Masters DB
-        # Min. 3 matching games
-        if check_position_against_masters_db(board.fen()) >= 3:
-            theory.append(f"{game.headers['Site'] + '#' + str(precan.ply() + 1)}")
-            board.push(n.move)
-            last_move = n.move
-            continue
-
-        # Reject candidates considered by the engine to be the only non-losing
-        # move in the position
-        if check_if_move_is_uniquely_nonlosing(fen = precan.board().fen(),
-                                               played = can.uci()):
-            onlynonlosing.append(f"{game.headers['Site'] + '#' + str(precan.ply() + 1)}")
-            board.push(n.move)
-            last_move = n.move
-            continue
+        link = game.headers['Site'] + '#' + str(precan.ply() + 1)
+        with helpers.time_limit(candidate_time, f"candidate {link}"):
+
+            # Reject candidates that can be found in master games (local
+            # theory index or Lichess Masters DB). Min. 3 matching games
+            if not defer_theory_check and \
+                    theory.masters_games(board, theory_index,
+                                         online_theory) >= theory_games:
+                results["theory"].append(link)
+                board.push(n.move)
+                last_move = n.move
+                continue
+
+            # Reject candidates considered by the engine to be the only
+            # non-losing move in the position
+            if not defer_engine_check and \
+                    check_if_move_is_uniquely_nonlosing(
+                        fen=precan.board().fen(), played=can.uci(),
+                        engine_path=engine_path):
+                results["only_nonlosing"].append(link)
+                board.push(n.move)
+                last_move = n.move
+                continue
 
 
         # Save remaining candidate details
-        can_ucis.append(can.uci())
         movenum = ((precan.ply() - 1) // 2) + 1
         movetext = str(movenum) + '. ' + can.san() if side else str(
             movenum) + '...' + can.san()
-        can_movetext.append(movetext)
-        can_links.append(game.headers['Site'] + '#' + str(precan.ply() + 1))
-        can_white.append(game.headers['White'])
-        can_black.append(game.headers['Black'])
+        results["candidates"].append({
+            "link": link,
+            "move": movetext,
+            "uci": can.uci(),
+            "white": game.headers['White'],
+            "black": game.headers['Black']})
+        if defer_engine_check:
+            results["candidates"][-1].update({
+                "fen": precan.board().fen(),
+                "sacrificed": sacrificed,
+                "eval": can.eval().pov(side).score(mate_score=100000)})
+        if defer_theory_check:
+            results["candidates"][-1]["theory_fen"] = board.fen()
+        if index:
+            results["candidates"][-1]["recurring"] = len(
+                {game_id for game_id, _ in index.lookup(board)} -
+                {helpers.game_id(game.headers['Site'])})
 
         # TODO: tag candidates by characteristics (eg by game phase, by sacd'
         #  piece [tag exchange sacs separately], by quality...)
@@ -323,35 +352,260 @@ for offset in tqdm(offsets):
         # Update previous position parameters
         last_move = n.move
 
-
-# After checking all moves in all games...
-# Report # of identified candidates
-print('')
-print(f"Finished checking {len(offsets)} / {len(all_offsets)} games!")
-print(f"Found {len(can_ucis)} candidate sac(s)")
-print(f"{can_links}")
-
-# Save candidate move and selected rejected move details to a spreadsheet
-candidates_out = pd.DataFrame(data = {
-    "link": can_links,
-    "move": can_movetext})
-forks_out = pd.DataFrame(data = {"forks": forks})
-skewers_out = pd.DataFrame(data = {"skewers": skewers})
-abspinned_out = pd.DataFrame(data = {"abs_pinned": abspinned})
-onlynonlosing_out = pd.DataFrame(data = {"only_nonlosing": onlynonlosing})
-trapped_out = pd.DataFrame(data = {"trapped": trapped})
-theory_out = pd.DataFrame(data = {"theory": theory})
-
-with pd.ExcelWriter("outputs/results.xlsx") as writer:
-    candidates_out.to_excel(writer, sheet_name="CANDIDATES")
-    forks_out.to_excel(writer, sheet_name="forks")
-    skewers_out.to_excel(writer, sheet_name="skewers")
-    abspinned_out.to_excel(writer, sheet_name="abs_pinned")
-    onlynonlosing_out.to_excel(writer, sheet_name="nonlosing")
-    trapped_out.to_excel(writer, sheet_name="trapped")
-    theory_out.to_excel(writer, sheet_name="theory")
-print(f"Saved results in outputs./results.xlsx")
-print('')
-print('###########  END  ##############')
-
-
+    return results
+
+
+def save_results(results: dict, path: str = "outputs/results.xlsx"):
+    """Save candidate move and selected rejected move details to a
+    spreadsheet."""
+    columns = ["link", "move"]
+    if any("recurring" in can for can in results["candidates"]):
+        columns.append("recurring")
+    candidates_out = pd.DataFrame(results["candidates"], columns=columns)
+    with pd.ExcelWriter(path) as writer:
+        candidates_out.to_excel(writer, sheet_name="CANDIDATES")
+        for kind, sheet in rejections.items():
+            pd.DataFrame(data = {kind: results[kind]}).to_excel(
+                writer, sheet_name=sheet)
+    print(f"Saved results in {path}")
+
+
+def engine_check_candidates(per_game: list,
+                            engine_path: str = helpers.engine_path,
+                            budget: helpers.EngineBudget = None,
+                            results_store=None,
+                            candidate_time: float = None) -> list:
+    """ Run the only-non-losing check on candidates left by analyse_game()
+    with defer_engine_check, biggest sacs in the most balanced positions
+    first, within an engine time budget.
+
+    :param per_game: each game's results.
+    :param engine_path: path to the engine.
+    :param budget: optional helpers.EngineBudget for the whole run.
+    :param results_store: optional store.ResultStore of verdicts, keyed by
+        candidate link.
+    :param candidate_time: optional time budget, in seconds, for each
+        candidate's search.
+
+    :return: per_game, with candidates the engine rejected moved to
+        "only_nonlosing". Candidates the budget didn't stretch to are kept,
+        with "engine_checked" set to False.
+    """
+    budget = budget or helpers.EngineBudget()
+    candidates = [can for results in per_game
+                  for can in results["candidates"]]
+    verdicts = results_store.load([can["link"] for can in candidates]) \
+        if results_store else {}
+    todo = sorted((can for can in candidates if can["link"] not in verdicts),
+                  key=lambda can: (-can["sacrificed"], abs(can["eval"])))
+    if todo:
+        engine = chess.engine.SimpleEngine.popen_uci(engine_path)
+        for can in tqdm(todo):
+            try:
+                with helpers.time_limit(candidate_time,
+                                        f"candidate {can['link']}"):
+                    verdict = \
+                        helpers.check_if_move_is_uniquely_nonlosing_adaptive(
+                            can["fen"], can["uci"], engine=engine,
+                            budget=budget)
+            except helpers.GameTimeout:
+                verdict = None
+            if verdict is not None:
+                verdicts[can["link"]] = verdict
+                if results_store:
+                    results_store.save({can["link"]: verdict})
+        engine.quit()
+
+    checked = []
+    for results in per_game:
+        kept = []
+        rejected = list(results["only_nonlosing"])
+        for can in results["candidates"]:
+            if verdicts.get(can["link"]):
+                rejected.append(can["link"])
+            else:
+                kept.append({**can, "engine_checked": can["link"] in verdicts})
+        checked.append({**results, "candidates": kept,
+                        "only_nonlosing": rejected})
+    return checked
+
+
+def report(per_game: list, checked: str, output: str = "outputs/results.xlsx"):
+    """Summarise per-game results and save them to a spreadsheet.
+
+    :param per_game: each checked game's results, from analyse_game().
+    :param checked: description of the number of games checked.
+    :param output: spreadsheet to save results in.
+    """
+    results = helpers.merge_results(per_game, ["candidates", *rejections])
+
+    # After checking all moves in all games...
+    # Report # of identified candidates
+    print('')
+    print(f"Finished checking {checked} games!")
+    print(f"Found {len(results['candidates'])} candidate sac(s)")
+    print(f"{[can['link'] for can in results['candidates']]}")
+    print('')
+    save_results(results, output)
+
+
+def run(pgn_path: str,
+        sample_size: int = 0,
+        sample_ids: list = None,
+        theory_index: str = theory.default_index_path,
+        online_theory: bool = True,
+        engine_path: str = helpers.engine_path,
+        output: str = "outputs/results.xlsx",
+        store_path: str = store.default_store_path,
+        games=None,
+        adaptive_engine: bool = False,
+        engine_budget: float = None,
+        position_index: str = None,
+        seed: int = None,
+        stratify_by: str = None,
+        processes: int = None,
+        async_verify: bool = False,
+        max_requests: int = verify.default_max_requests,
+        max_engines: int = verify.default_max_engines,
+        game_time: float = None,
+        candidate_time: float = None,
+        slowest: int = 5):
+    """Find candidate sacs in (a selection of) the games in a PGN file, or in
+    games streamed from the Lichess API (see ingest.stream_exports()).
+
+    Results are kept in the result store at store_path (unless it's None), so
+    games already analysed with the same settings aren't checked again.
+
+    With adaptive_engine (or an engine_budget, in seconds), the
+    only-non-losing check runs once all games are analysed, using adaptive
+    searches on the most promising candidates first until the budget runs
+    out.
+
+    With async_verify, the theory and engine checks are left to a
+    verify.Verifier, which runs up to max_requests explorer queries and
+    max_engines (adaptive) engine searches at once while later games are
+    still being analysed. Candidates in master games never reach the engine.
+
+    Random samples are reproducible given a seed, and can be stratified (see
+    sampling.sample_games()). Without a sample, every game is analysed as the
+    PGN is read (see pipeline.analyse_pgn()), by processes worker processes.
+
+    With a position_index, each candidate is also flagged with the number of
+    other indexed games that reached the same position.
+
+    Each game can be given game_time seconds, and each candidate's theory and
+    engine checks candidate_time seconds. Games that run out of time are left
+    out of the report (and the result store) and listed in
+    outputs/TimedOut_<timestamp>.txt, for a retry with --ids-file. The
+    slowest games are reported either way. The adaptive and asynchronous
+    checks run apart from the games, so candidate_time only caps their
+    engine searches (the verifier's explorer queries are bounded by
+    helpers.explorer_timeout instead).
+    """
+    adaptive_engine = adaptive_engine or engine_budget is not None
+    whole_pgn = games is None and not (sample_size or sample_ids)
+    if whole_pgn:
+        print(f"Checking every game in {pgn_path} as it's read")
+        if processes is None and online_theory and not async_verify:
+            # Each worker queries the explorer, so stay as polite as a
+            # single process unless told otherwise
+            processes = 1
+    elif games is None:
+        offsets, keys, total = sampling.sample_games(
+            pgn_path, sample_size, sample_ids, seed, stratify_by)
+        print(f"About to check {len(offsets)} games (from {total} games in "
+              f"the input PGN)")
+    else:
+        print("Checking games as they're downloaded")
+    print('')
+
+    index = positions.open_index(position_index) if position_index else None
+    config = {"version": result_version,
+              "material_adv_threshold": material_adv_threshold,
+              "winning_eval_threshold": winning_eval_threshold,
+              "opening_plies": opening_plies,
+              "ending_plies": ending_plies,
+              "max_ply": max_ply,
+              "theory_games": theory_games,
+              "theory_index": theory_index,
+              "theory_index_modified": os.path.getmtime(theory_index)
+              if os.path.exists(theory_index) else None,
+              "online_theory": online_theory,
+              "engine_path": engine_path,
+              "defer_engine_check": adaptive_engine,
+              "defer_theory_check": async_verify,
+              "position_index": position_index,
+              # Recurrence counts change as games are added to the index
+              "position_index_games": len(index) if index else None}
+    results_store = store.ResultStore(store_path, "sacs", config) \
+        if store_path else None
+
+    # For each selected game...
+    analyse = functools.partial(analyse_game, theory_index=theory_index,
+                                online_theory=online_theory,
+                                engine_path=engine_path,
+                                defer_engine_check=adaptive_engine,
+                                position_index=position_index,
+                                defer_theory_check=async_verify,
+                                candidate_time=candidate_time)
+    verifier = None
+    if async_verify:
+        budget = helpers.EngineBudget(engine_budget)
+        verdict_store = store.ResultStore(
+            store_path, "sacs_verify",
+            {"version": result_version, "engine_path": engine_path,
+             "theory_index": config["theory_index"],
+             "theory_index_modified": config["theory_index_modified"],
+             "online_theory": online_theory}) if store_path else None
+        verifier = verify.Verifier(theory_index, online_theory, engine_path,
+                                   max_requests, max_engines, budget=budget,
+                                   results_store=verdict_store,
+                                   candidate_time=candidate_time).start()
+    on_result = verifier.submit if verifier else None
+    timer = helpers.GameTimer(game_time)
+    if whole_pgn:
+        per_game = pipeline.analyse_pgn(analyse, pgn_path, results_store,
+                                        processes, on_result=on_result,
+                                        timer=timer)
+        checked = f"{len(per_game)}"
+    elif games is None:
+        per_game = helpers.analyse_games(analyse, pgn_path, offsets,
+                                         keys, results_store,
+                                         on_result=on_result, timer=timer)
+        checked = f"{len(per_game)} / {total}"
+    else:
+        per_game = helpers.analyse_stream(analyse, games, results_store,
+                                          on_result=on_result, timer=timer)
+        checked = f"{len(per_game)}"
+    print('')
+    print(timer.report(slowest))
+    if timer.timed_out:
+        timed_out_path = f"outputs/TimedOut_{helpers.timestamp()}.txt"
+        timer.save_timed_out(timed_out_path)
+        print(f"Listed the games that ran out of time in {timed_out_path}; "
+              f"retry them with --ids-file {timed_out_path}")
+    if verifier:
+        per_game = verifier.finish(per_game)
+        print(verifier.report())
+        print(budget.report())
+    elif adaptive_engine:
+        budget = helpers.EngineBudget(engine_budget)
+        verdict_store = store.ResultStore(
+            store_path, "sacs_engine",
+            {"version": result_version, "engine_path": engine_path}) \
+            if store_path else None
+        per_game = engine_check_candidates(per_game, engine_path, budget,
+                                           verdict_store, candidate_time)
+        print(budget.report())
+    report(per_game, checked, output)
+    print('')
+    print("Position cache:")
+    print(memo.cache.report())
+    print('')
+    print('###########  END  ##############')
+
+
+if __name__ == '__main__':
+    import sys
+    import main
+    main.main(["sacs"] + sys.argv[1:])
@@ -0,0 +1,114 @@
+"""Find the first tablebase-range position reached in each game.
+
+The number of pieces on the board never goes up during a game, so the first
+ply with at most N pieces can be found with a binary search over a game's
+per-ply piece counts (from a ply dataset, see dataset.py) instead of
+checking every position. When reading a PGN directly, games that end with
+more than N pieces are rejected from their final position alone, and the
+others are only walked back from the end of the game.
+"""
+
+import functools
+
+import chess
+import chess.pgn
+import numpy as np
+import pandas as pd
+
+import dataset
+import helpers
+import utils
+
+# Syzygy tablebases cover positions with up to seven pieces
+default_max_pieces = 7
+
+
+def first_ply_at_or_below(pieces: np.ndarray, max_pieces: int) -> int:
+    """Binary search a game's non-increasing piece counts.
+
+    :return: index of the first entry <= max_pieces, or -1 if there is none.
+    """
+    i = int(np.searchsorted(-pieces.astype(np.int16), -max_pieces,
+                            side="left"))
+    return i if i < len(pieces) else -1
+
+
+def _reach(link: str, board: chess.Board) -> dict:
+    return {"link": f"{link}#{board.ply()}",
+            "ply": board.ply(),
+            "pieces": chess.popcount(board.occupied),
+            "signature": utils.material_signature(board),
+            "fen": board.fen()}
+
+
+def game_endgame_reach(headers_and_board,
+                       max_pieces: int = default_max_pieces):
+    """Find the first position with at most max_pieces pieces in a game.
+
+    :param headers_and_board: a game's headers and final board, with the
+        mainline on its move stack.
+    :param max_pieces: Default value: 7.
+
+    :return: dict describing the position, or None if it wasn't reached.
+    """
+    headers, board = headers_and_board
+    if chess.popcount(board.occupied) > max_pieces:
+        return None
+    board = board.copy()
+    while board.move_stack:
+        move = board.pop()
+        if chess.popcount(board.occupied) > max_pieces:
+            board.push(move)
+            break
+    return _reach(headers["Site"], board)
+
+
+def endgame_reach_from_pgn(pgn_path: str,
+                           max_pieces: int = default_max_pieces,
+                           processes: int = None) -> pd.DataFrame:
+    """Run game_endgame_reach over a PGN file in parallel."""
+    offsets, _ = helpers.game_offsets(pgn_path)
+    results = helpers.map_games(
+        functools.partial(game_endgame_reach, max_pieces=max_pieces),
+        pgn_path, offsets, visitor=helpers.HeadersAndFinalBoard, processes=processes)
+    return pd.DataFrame([r for r in results if r is not None])
+
+
+def endgame_reach_from_dataset(out_dir: str,
+                               max_pieces: int = default_max_pieces
+                               ) -> pd.DataFrame:
+    """Find the first tablebase-range position of each game in a dataset."""
+    games = dataset.load_games(out_dir).set_index("game")
+    plies = dataset.load_plies(out_dir)
+    results = []
+    for game, start, end in zip(*dataset.game_bounds(plies)):
+        rows = plies[start:end]
+        i = first_ply_at_or_below(rows["pieces"], max_pieces)
+        if i < 0:
+            continue
+        board = dataset.replay(rows[:i + 1],
+                               dataset.start_board(games.loc[game]))
+        results.append(_reach(games.at[game, "Site"], board))
+    return pd.DataFrame(results)
+
+
+def run(pgn_path: str = None,
+        dataset_path: str = None,
+        max_pieces: int = default_max_pieces,
+        processes: int = None):
+    """Report tablebase-range positions from a PGN or a ply dataset."""
+    task_label = "EndgameReach"
+    now_label = helpers.timestamp()
+
+    if dataset_path:
+        reached = endgame_reach_from_dataset(dataset_path, max_pieces)
+    else:
+        reached = endgame_reach_from_pgn(pgn_path, max_pieces, processes)
+    print(f"{len(reached)} games reached a position with "
+          f"{max_pieces} pieces or fewer")
+    if len(reached):
+        print(reached["signature"].value_counts().head(20).to_string())
+
+    with pd.ExcelWriter(f"outputs/{task_label}_{now_label}.xlsx") as writer:
+        reached.to_excel(writer, sheet_name=f"{task_label}")
+    print(f"Saved results in outputs/{task_label}_{now_label}.xlsx")
@@ -0,0 +1,71 @@
+"""Corpus-wide statistics about the material signatures reached in games.
+
+Each game is reduced to the set of (phase, signature) pairs it passed
+through, e.g. ("endgame", "KRPvKR"), tagged with the game's result. Worker
+processes sum these over shards of the corpus, and the partial histograms
+are merged into corpus-wide counts (see helpers.map_reduce_games), so
+memory use stays bounded however large the corpus is.
+"""
+
+from collections import Counter
+
+import pandas as pd
+
+import bitboards
+import helpers
+
+outcomes = {"1-0": "white_wins", "1/2-1/2": "draws", "0-1": "black_wins"}
+phases = ["opening", "middlegame", "endgame"]
+
+
+def game_signatures(headers_and_board) -> Counter:
+    """Count the (phase, signature, outcome) combinations reached in a game.
+
+    :param headers_and_board: a game's headers and final board, with the
+        mainline on its move stack.
+    """
+    headers, final = headers_and_board
+    outcome = outcomes.get(headers.get("Result"), "unfinished")
+    rows = bitboards.game_bitboards(final)
+    reached = set(zip(bitboards.phases(rows), bitboards.signatures(rows)))
+    return Counter((phase, signature, outcome)
+                   for phase, signature in reached)
+
+
+def signature_table(counts: Counter) -> pd.DataFrame:
+    """Turn merged counts into one row per (phase, signature)."""
+    columns = list(outcomes.values()) + ["unfinished"]
+    if not counts:
+        return pd.DataFrame(columns=["phase", "signature", "games"] + columns)
+    table = pd.Series(counts).unstack(fill_value=0)
+    table = table.reindex(columns=columns, fill_value=0)
+    table.insert(0, "games", table.sum(axis=1))
+    table.index.names = ["phase", "signature"]
+    return table.reset_index().sort_values(["phase", "games"],
+                                           ascending=[True, False],
+                                           ignore_index=True)
+
+
+def endgame_stats(pgn_path: str, processes: int = None) -> pd.DataFrame:
+    """Material signature statistics for every game in a PGN file."""
+    offsets, _ = helpers.game_offsets(pgn_path)
+    counts = helpers.map_reduce_games(game_signatures, pgn_path, offsets,
+                                      visitor=helpers.HeadersAndFinalBoard,
+                                      processes=processes)
+    return signature_table(counts)
+
+
+def run(pgn_path: str, processes: int = None):
+    """Report material signature statistics for a PGN file."""
+    task_label = "EndgameStats"
+    now_label = helpers.timestamp()
+
+    stats = endgame_stats(pgn_path, processes)
+    print("Most common endgames:")
+    print(stats[stats["phase"] == "endgame"].head(20).to_string(index=False))
+
+    with pd.ExcelWriter(f"outputs/{task_label}_{now_label}.xlsx") as writer:
+        for phase in phases:
+            stats[stats["phase"] == phase].to_excel(writer, sheet_name=phase,
+                                                    index=False)
+    print(f"Saved results in outputs/{task_label}_{now_label}.xlsx")
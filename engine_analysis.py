@@ -0,0 +1,157 @@
+"""Whole-game engine analysis.
+
+Each game is analysed in a single engine session, walking the mainline from
+the first position to the last. The engine is told the moves that led to
+each position and that they all belong to the same game, so its hash table
+stays warm: most of what it learned about one position is still useful one
+ply later.
+"""
+
+import time
+
+import chess
+import chess.engine
+import chess.pgn
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+
+import helpers
+import sampling
+
+mate_score = 100000
+# Evals are capped before computing CPL, as Lichess does for its ACPL, so a
+# missed mate doesn't swamp everything else
+cpl_cap = 1000
+default_time_per_position = 0.5
+
+
+def position_eval(engine: chess.engine.SimpleEngine,
+                  board: chess.Board,
+                  limit: chess.engine.Limit,
+                  game_key=None):
+    """ Evaluate a position from White's point of view.
+
+    :return: (eval in centipawns, with mates as +/- mate_score, best move or
+        None if the game is over)
+    """
+    if board.is_checkmate():
+        return (-mate_score if board.turn else mate_score), None
+    if board.is_game_over():
+        return 0, None
+    info = engine.analyse(board, limit, game=game_key)
+    return info["score"].white().score(mate_score=mate_score), \
+        info["pv"][0] if info.get("pv") else None
+
+
+def cpl(evals: np.ndarray, white_to_move: np.ndarray) -> np.ndarray:
+    """ Centipawn loss of each move.
+
+    :param evals: evals of each position from White's point of view, one more
+        than the number of moves.
+    :param white_to_move: whether White played each move.
+
+    :return: CPL of each move (never negative).
+    """
+    capped = np.clip(evals, -cpl_cap, cpl_cap)
+    change = capped[1:] - capped[:-1]
+    return np.maximum(np.where(white_to_move, -change, change), 0)
+
+
+def analyse_game(game: chess.pgn.Game,
+                 engine: chess.engine.SimpleEngine = None,
+                 engine_path: str = helpers.engine_path,
+                 time_per_position: float = default_time_per_position,
+                 depth: int = None) -> dict:
+    """ Evaluate every position in a game's mainline in one engine session.
+
+    :param game: the game to analyse.
+    :param engine: optional engine to reuse across games (it's told when a
+        new game starts).
+    :param engine_path: path to engine's .exe file, used when no engine is
+        given.
+    :param time_per_position: seconds to spend on each position. Default
+        value: 0.5.
+    :param depth: search depth per position, instead of a time limit.
+
+    :return: {"evals": White's eval of each position, including the final
+        one, "best": best move in each position (UCI, "" once the game is
+        over), "moves": moves played (UCI), "cpl": CPL of each move,
+        "positions_per_second": analysis speed}
+    """
+    own_engine = engine is None
+    if own_engine:
+        engine = chess.engine.SimpleEngine.popen_uci(engine_path)
+    limit = chess.engine.Limit(depth=depth) if depth \
+        else chess.engine.Limit(time=time_per_position)
+    # The same key for every position keeps the engine from clearing its
+    # hash table between them
+    game_key = object()
+
+    board = game.board()
+    evals, best, moves, white_to_move = [], [], [], []
+    start = time.perf_counter()
+    for move in [*game.mainline_moves(), None]:
+        score, best_move = position_eval(engine, board, limit, game_key)
+        evals.append(score)
+        best.append(best_move.uci() if best_move else "")
+        if move is None:
+            break
+        moves.append(move.uci())
+        white_to_move.append(board.turn)
+        board.push(move)
+    elapsed = time.perf_counter() - start
+    if own_engine:
+        engine.quit()
+
+    evals = np.array(evals, dtype=np.int32)
+    return {"evals": evals, "best": best, "moves": moves,
+            "cpl": cpl(evals, np.array(white_to_move, dtype=bool)),
+            "positions_per_second": len(evals) / elapsed if elapsed else 0.0}
+
+
+def run(pgn_path: str,
+        sample_size: int = 0,
+        sample_ids: list = None,
+        engine_path: str = helpers.engine_path,
+        time_per_position: float = default_time_per_position,
+        depth: int = None,
+        seed: int = None,
+        stratify_by: str = None):
+    """Analyse (a selection of) the games in a PGN file with one engine, and
+    save per-move evals, best moves and CPL to a CSV file. Random samples are
+    reproducible given a seed, and can be stratified (see
+    sampling.sample_games())."""
+    task_label = "EngineAnalysis"
+    now_label = helpers.timestamp()
+
+    offsets, _, total = sampling.sample_games(
+        pgn_path, sample_size, sample_ids, seed, stratify_by)
+    print(f"About to analyse {len(offsets)} games (from {total} "
+          f"games in the input PGN)")
+
+    rows = []
+    positions = 0
+    start = time.perf_counter()
+    engine = chess.engine.SimpleEngine.popen_uci(engine_path)
+    games = helpers.read_games(pgn_path, offsets)
+    for game in tqdm(games, total=len(offsets)):
+        link = game.headers.get("Site", "?")
+        analysis = analyse_game(game, engine,
+                                time_per_position=time_per_position,
+                                depth=depth)
+        positions += len(analysis["evals"])
+        for ply, move in enumerate(analysis["moves"]):
+            rows.append({"link": f"{link}#{ply + 1}", "move": move,
+                         "best": analysis["best"][ply],
+                         "eval_before": analysis["evals"][ply],
+                         "eval_after": analysis["evals"][ply + 1],
+                         "cpl": analysis["cpl"][ply]})
+    engine.quit()
+    elapsed = time.perf_counter() - start
+
+    print(f"Analysed {positions} positions at "
+          f"{positions / elapsed if elapsed else 0:.1f} positions/s")
+    pd.DataFrame(rows).to_csv(f"outputs/{task_label}_{now_label}.csv",
+                              index=False)
+    print(f"Saved results in outputs/{task_label}_{now_label}.csv")
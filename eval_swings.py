@@ -0,0 +1,234 @@
+"""Find where games swung: blunders, missed wins and turning points.
+
+Works on each game's eval series (the [%eval] comments of Lichess's server
+analysis, from White's point of view, with mates scored as in detect_sacs:
+100000 less the number of moves to mate). The series of every game in a
+batch, or a whole corpus, are concatenated into one array, and each kind of
+swing is found with NumPy diff and threshold operations over all of them at
+once, instead of with node.eval() calls ply by ply.
+
+Evals come from a ply dataset (see dataset.py) or, without one, are read
+from the PGN with a visitor that only parses the mainline's comments.
+
+- blunder: a move that drops its player's winning chances (as in Lichess's
+  analysis, on a scale from -1 to 1) by at least blunder_drop
+- missed win: a move from a position where its player was at least
+  winning_eval ahead to one where they're no more than level_eval ahead
+- turning point: a move after which the side ahead by at least level_eval
+  is the other side from the last one that was
+"""
+
+import chess
+import chess.engine
+import chess.pgn
+import numpy as np
+import pandas as pd
+
+import dataset
+import helpers
+
+task_label = "EvalSwings"
+kinds = ["blunder", "missed_win", "turning_point"]
+mate_score = dataset.mate_score
+no_eval = dataset.no_eval
+
+# Thresholds
+blunder_drop = 0.3
+winning_eval = 300
+level_eval = 100
+# Evals are capped before conversion to winning chances, so mate scores don't
+# overflow np.exp
+max_eval = 10000
+
+series_dtype = np.dtype([
+    ("game", np.uint32),
+    ("ply", np.uint16),       # 1 for White's first move
+    ("eval", np.int32),       # after the move, from White's POV, or no_eval
+])
+
+
+class HeadersAndEvals(chess.pgn.BaseVisitor):
+    """PGN visitor that reads a game's headers and the eval after each
+    mainline move (as in dataset.game_plies), without building any game
+    nodes."""
+
+    def begin_game(self):
+        self.headers = chess.pgn.Headers()
+        self.evals = []
+        self.turn = chess.WHITE
+
+    def visit_header(self, tagname: str, tagvalue: str):
+        self.headers[tagname] = tagvalue
+
+    def begin_variation(self):
+        return chess.pgn.SKIP
+
+    def visit_move(self, board: chess.Board, move: chess.Move):
+        self.evals.append(no_eval)
+        self.turn = not board.turn
+
+    def visit_comment(self, comment: str):
+        if not self.evals or self.evals[-1] != no_eval:
+            return
+        match = chess.pgn.EVAL_REGEX.search(comment)
+        if not match:
+            return
+        if match.group("mate"):
+            mate = int(match.group("mate"))
+            # As in chess.pgn: after a mate, the side to move is mated
+            score = chess.engine.Mate(mate) if mate or self.turn \
+                else -chess.engine.Mate(0)
+        else:
+            score = chess.engine.Cp(round(float(match.group("cp")) * 100))
+        self.evals[-1] = score.score(mate_score=mate_score)
+
+    def handle_error(self, error: Exception):
+        chess.pgn.LOGGER.error("%s while parsing %s", error,
+                               self.headers.get("Site"))
+
+    def result(self):
+        return self.headers, self.evals
+
+
+def _evals(headers_and_evals):
+    return headers_and_evals
+
+
+def winning_chances(evals: np.ndarray) -> np.ndarray:
+    """Winning chances (-1 to 1) for each eval, as in Lichess's analysis."""
+    capped = np.clip(evals, -max_eval, max_eval).astype(np.float64)
+    return 2 / (1 + np.exp(-0.00368208 * capped)) - 1
+
+
+def find_swings(series: np.ndarray) -> pd.DataFrame:
+    """ Find the blunders, missed wins and turning points in a batch of
+    games.
+
+    :param series: rows with "game", "ply" and "eval" fields (e.g. a ply
+        dataset's), sorted by game and then by ply.
+
+    :return: one row per swing: game, ply, kind, side that moved, evals
+        before and after the move (White's POV) and the drop in the mover's
+        winning chances.
+    """
+    game = series["game"].astype(np.int64)
+    ply = series["ply"].astype(np.int64)
+    evals = series["eval"].astype(np.int64)
+    n = len(series)
+    if n < 2:
+        return pd.DataFrame(columns=["game", "ply", "kind", "side",
+                                     "eval_before", "eval_after", "drop"])
+
+    # Each move's eval before (the previous row, if it's the same game's
+    # previous ply) and after, from the mover's point of view
+    has_eval = evals != no_eval
+    follows = np.zeros(n, dtype=bool)
+    follows[1:] = (game[1:] == game[:-1]) & (ply[1:] == ply[:-1] + 1) & \
+        has_eval[1:] & has_eval[:-1]
+    before = np.zeros(n, dtype=np.int64)
+    before[1:] = evals[:-1]
+    sign = np.where(ply % 2 == 1, 1, -1)
+    mover_before = sign * before
+    mover_after = sign * evals
+    chances = winning_chances(evals)
+    drop = np.zeros(n)
+    drop[1:] = sign[1:] * (chances[:-1] - chances[1:])
+
+    blunders = follows & (drop >= blunder_drop)
+    missed_wins = follows & (mover_before >= winning_eval) & \
+        (mover_after <= level_eval)
+
+    # The side ahead after each move (1 for White, -1 for Black, 0 for
+    # neither), and the last side that was ahead before it in the same game
+    ahead = np.where(has_eval, np.sign(evals) * (np.abs(evals) >= level_eval),
+                     0)
+    starts = np.zeros(n, dtype=np.int64)
+    starts[1:] = np.where(game[1:] != game[:-1], np.arange(1, n), 0)
+    starts = np.maximum.accumulate(starts)
+    last = np.maximum.accumulate(np.where(ahead != 0, np.arange(n), -1))
+    previous = np.full(n, -1)
+    previous[1:] = last[:-1]
+    was_ahead = np.where(previous >= starts, ahead[np.maximum(previous, 0)],
+                         0)
+    turning_points = (ahead != 0) & (was_ahead == -ahead)
+
+    swings = []
+    for kind, found in zip(kinds, [blunders, missed_wins, turning_points]):
+        rows = np.flatnonzero(found)
+        swings.append(pd.DataFrame({
+            "game": game[rows],
+            "ply": ply[rows],
+            "kind": kind,
+            "side": np.where(ply[rows] % 2 == 1, "white", "black"),
+            "eval_before": np.where(follows[rows], before[rows], no_eval),
+            "eval_after": evals[rows],
+            "drop": np.where(follows[rows], drop[rows], np.nan)}))
+    return pd.concat(swings, ignore_index=True).sort_values(
+        ["game", "ply"], kind="stable", ignore_index=True)
+
+
+def pgn_series(pgn_path, processes: int = None):
+    """ Every game's eval series from a PGN file, or corpus.Corpus.
+
+    :return: (series rows, each game's headers)
+    """
+    offsets, _ = helpers.game_offsets(pgn_path)
+    games = helpers.map_games(_evals, pgn_path, offsets,
+                              visitor=HeadersAndEvals, processes=processes)
+    lengths = [len(evals) for _, evals in games]
+    series = np.empty(sum(lengths), dtype=series_dtype)
+    series["game"] = np.repeat(np.arange(len(games)), lengths)
+    series["ply"] = np.concatenate(
+        [np.arange(1, length + 1) for length in lengths]) if games else []
+    series["eval"] = np.concatenate(
+        [np.array(evals, dtype=np.int32) for _, evals in games]) \
+        if games else []
+    return series, [headers for headers, _ in games]
+
+
+def dataset_series(out_dir: str):
+    """ Every game's eval series from a ply dataset.
+
+    :return: (series rows, each game's headers)
+    """
+    parts = [part[["game", "ply", "eval"]]
+             for part in dataset.iter_plies(out_dir)]
+    series = np.empty(sum(len(part) for part in parts), dtype=series_dtype)
+    i = 0
+    for part in parts:
+        for field in series_dtype.names:
+            series[field][i:i + len(part)] = part[field]
+        i += len(part)
+    games = dataset.load_games(out_dir).sort_values("game")
+    return series, games.to_dict("records")
+
+
+def run(pgn_path=None, dataset_path: str = None, processes: int = None):
+    """Report the blunders, missed wins and turning points in every game of a
+    PGN file or ply dataset."""
+    now_label = helpers.timestamp()
+    if dataset_path:
+        series, headers = dataset_series(dataset_path)
+    else:
+        series, headers = pgn_series(pgn_path, processes)
+    print(f"Checking {len(series)} plies of {len(headers)} games")
+
+    swings = find_swings(series)
+    swings.insert(0, "link", [
+        f"{headers[game].get('Site', '?')}#{ply}"
+        for game, ply in zip(swings["game"], swings["ply"])])
+    swings = swings.drop(columns="game")
+    print(swings["kind"].value_counts().reindex(kinds, fill_value=0)
+          .to_string())
+
+    with pd.ExcelWriter(f"outputs/{task_label}_{now_label}.xlsx") as writer:
+        for kind in kinds:
+            swings[swings["kind"] == kind].drop(columns="kind").to_excel(
+                writer, sheet_name=kind.upper(), index=False)
+    print(f"Saved results in outputs/{task_label}_{now_label}.xlsx")
+
+
+if __name__ == '__main__':
+    import sys
+    import main
+    main.main(["eval-swings"] + sys.argv[1:])
@@ -2,19 +2,537 @@
 
 import chess
 import chess.engine
-import requests
+import chess.pgn
+import bz2
+import contextlib
+import contextvars
+import gzip
+import hashlib
+import lzma
+import multiprocessing
+import os
+import re
 import time
+from collections import Counter
+from datetime import datetime
+from tqdm import tqdm
 
-import choices
+import memo
 
 engine_path = "engine/stockfish_22031308_x64_avx2/stockfish_22031308_x64_avx2.exe"
-pgn_path = f"inputs/{choices.filename}"
+gamelink_prefix = "https://lichess.org/"
+# Headers that, with the moves, identify games without a Lichess link
+duplicate_headers = ["Event", "White", "Black", "Date", "UTCDate", "UTCTime",
+                     "Result"]
+unknown_header_values = ["", "?", "????.??.??", "*"]
+# Lichess Masters explorer, and how politely to query it
+explorer_url = "https://explorer.lichess.ovh/master"
+explorer_pause = 0.5       # between each query
+explorer_pause_429 = 10    # after a 429 error is raised
+explorer_retries = 3       # after other errors
+explorer_timeout = 30      # seconds to wait for a reply
+# Decompressing openers for compressed PGNs, by extension
+compressed = {".gz": gzip.open, ".bz2": bz2.open, ".xz": lzma.open}
 
 def read_pgn(pgn_path):
-    """Read PGN file."""
+    """Read PGN file, decompressing it if it's a .gz, .bz2 or .xz file."""
+    opener = compressed.get(os.path.splitext(pgn_path)[1])
+    if opener:
+        return opener(pgn_path, "rt")
     pgn = open(pgn_path)
     return pgn
 
+
+def is_compressed(path: str) -> bool:
+    return os.path.splitext(path)[1] in compressed
+
+
+def games_at(pgn, path: str, offsets: list, visitor=chess.pgn.GameBuilder):
+    """ Yield the games at offsets in an open PGN file.
+
+    A compressed file can only seek by decompressing again from the start,
+    so its games are found by reading straight through it, skipping the
+    games in between, as long as offsets are in file order.
+    """
+    sequential = is_compressed(path)
+    for offset in offsets:
+        if not sequential or pgn.tell() > offset:
+            pgn.seek(offset)
+        while pgn.tell() < offset and chess.pgn.skip_game(pgn):
+            pass
+        yield chess.pgn.read_game(pgn, Visitor=visitor)
+
+
+class _LineRecorder:
+    """File wrapper keeping the lines chess.pgn reads from it."""
+
+    def __init__(self, pgn):
+        self.pgn = pgn
+        self.lines = []
+
+    def readline(self) -> str:
+        line = self.pgn.readline()
+        self.lines.append(line)
+        return line
+
+
+def pgn_files(pgn_path) -> list:
+    """The files making up a PGN input: a PGN file's path, or a
+    corpus.Corpus."""
+    return [pgn_path] if isinstance(pgn_path, str) else pgn_path.files
+
+
+def file_runs(pgn_path, offsets: list, chunksize: int = None) -> list:
+    """ Split the games to read into runs of games from the same file.
+
+    :param pgn_path: path to a PGN file, or a corpus.Corpus.
+    :param offsets: from game_offsets(): offsets in the file, or (path,
+        offset) pairs for a corpus.
+    :param chunksize: maximum number of games in a run. Compressed files
+        are never split, so each is only decompressed once.
+
+    :return: [(path, offsets)] in the same order as offsets.
+    """
+    if isinstance(pgn_path, str):
+        runs = [(pgn_path, list(offsets))] if len(offsets) else []
+    else:
+        runs = []
+        for path, offset in offsets:
+            if not runs or runs[-1][0] != path:
+                runs.append((path, []))
+            runs[-1][1].append(offset)
+    if not chunksize:
+        return runs
+    chunks = []
+    for path, run in runs:
+        size = len(run) if is_compressed(path) else chunksize
+        chunks.extend((path, run[i:i + size])
+                      for i in range(0, len(run), size))
+    return chunks
+
+
+def read_games(pgn_path, offsets: list, visitor=chess.pgn.GameBuilder):
+    """Yield the games at offsets (see file_runs()) in order, opening each
+    file once per run of games from it."""
+    for path, run in file_runs(pgn_path, offsets):
+        with read_pgn(path) as pgn:
+            yield from games_at(pgn, path, run, visitor)
+
+
+def normalize_movetext(movetext: str) -> str:
+    """Moves alone, without comments, variations, NAGs or move numbers, so
+    copies of a game from different exports compare equal."""
+    movetext = re.sub(r"\{[^}]*\}|;[^\n]*|\$\d+", " ", movetext)
+    while "(" in movetext:
+        stripped = re.sub(r"\([^()]*\)", " ", movetext)
+        if stripped == movetext:
+            break
+        movetext = stripped
+    movetext = re.sub(r"\d+\.(\.\.)?", " ", movetext)
+    return " ".join(movetext.split())
+
+
+def game_key(headers: chess.pgn.Headers, movetext: str = None) -> str:
+    """ Key that is the same for every copy of a game: its Lichess ID, or
+    else a hash of its key headers and normalized movetext.
+
+    :param headers: the game's headers.
+    :param movetext: the game's raw movetext. Only needed for games without
+        a Lichess link.
+    """
+    site = headers.get("Site", "")
+    if site.startswith(gamelink_prefix):
+        return game_id(site)
+    # Unknown values count as missing, as chess.pgn fills them in for
+    # missing Seven Tag Roster headers when it reads a whole game
+    text = "|".join([*("" if headers.get(tag, "") in unknown_header_values
+                       else headers[tag] for tag in duplicate_headers),
+                     normalize_movetext(movetext or "")])
+    return hashlib.sha1(text.encode()).hexdigest()
+
+
+def iter_headers(pgn_path):
+    """Yield the offset, headers and key (see game_key()) of each game in a
+    PGN, reading only its headers where it can."""
+    with read_pgn(pgn_path) as pgn:
+        # Keeps the movetext read_headers skips, without seeking back for it
+        recorder = _LineRecorder(pgn)
+        while True:
+            offset = pgn.tell()
+            recorder.lines = []
+            headers = chess.pgn.read_headers(recorder)
+            if headers is None:
+                break
+            if headers.get("Site", "").startswith(gamelink_prefix):
+                key = game_key(headers)
+            else:
+                key = game_key(headers, "".join(
+                    line for line in recorder.lines
+                    if not line.startswith("[")))
+            yield offset, headers, key
+
+
+def scan_games(pgn_path):
+    """Scan a PGN's headers for each game's offset, link and key (see
+    game_key())."""
+    offsets = []
+    gamelinks = []
+    keys = []
+    for offset, headers, key in iter_headers(pgn_path):
+        offsets.append(offset)
+        gamelinks.append(headers.get("Site", ""))
+        keys.append(key)
+    return offsets, gamelinks, keys
+
+
+def duplicates(keys: list) -> list:
+    """Indices of the games that are copies of an earlier game."""
+    seen = set()
+    found = []
+    for i, key in enumerate(keys):
+        if key in seen:
+            found.append(i)
+        seen.add(key)
+    return found
+
+
+def game_offsets(pgn_path, dedupe: bool = True):
+    """Scan a PGN's headers for each game's offset and link, leaving out
+    copies of games seen earlier in the file unless dedupe is False. For a
+    corpus.Corpus, offsets are (path, offset) pairs."""
+    if not isinstance(pgn_path, str):
+        return pgn_path.game_offsets(dedupe)
+    offsets, gamelinks, keys = scan_games(pgn_path)
+    if not dedupe:
+        return offsets, gamelinks
+    skip = set(duplicates(keys))
+    if skip:
+        print(f"Skipping {len(skip)} duplicate games in {pgn_path}")
+    return [offset for i, offset in enumerate(offsets) if i not in skip], \
+        [link for i, link in enumerate(gamelinks) if i not in skip]
+
+
+def game_id(gamelink: str) -> str:
+    """Lichess game ID from a game link."""
+    return gamelink.rstrip("/").rsplit("/", 1)[-1]
+
+
+class GameTimeout(Exception):
+    """Raised by check_time() once the time allowed has run out."""
+
+
+# (deadline on the time.monotonic() clock, what it's for, seconds allowed)
+_deadline = contextvars.ContextVar("deadline",
+                                   default=(float("inf"), None, None))
+
+
+@contextlib.contextmanager
+def time_limit(seconds: float = None, what: str = "game"):
+    """ Allow the code run in this context seconds to finish (or less, if an
+    enclosing limit runs out sooner).
+
+    Cancellation is cooperative: code that can take a while calls
+    check_time() where it's safe to stop, which raises GameTimeout once the
+    time is up. Limits apply to the current thread only.
+
+    :param seconds: time allowed, or None for no (further) limit.
+    :param what: what the time is for, for GameTimeout's message.
+    """
+    if seconds is None:
+        yield
+        return
+    deadline = time.monotonic() + seconds
+    token = _deadline.set(min(_deadline.get(), (deadline, what, seconds)))
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def time_left() -> float:
+    """Seconds left before the innermost time_limit() runs out (inf if
+    there's no limit)."""
+    return _deadline.get()[0] - time.monotonic()
+
+
+def check_time(needed: float = 0):
+    """Raise GameTimeout if the time allowed has run out, or would run out
+    within needed seconds (e.g. before a pause or a fixed-time search)."""
+    deadline, what, seconds = _deadline.get()
+    if deadline - time.monotonic() < needed:
+        raise GameTimeout(f"{what} ran over its {seconds:g}s budget")
+
+
+class GameTimer:
+    """Per-game time budget for a run, with how long each game took and
+    which games ran out of time, by game key (see game_key())."""
+
+    def __init__(self, seconds: float = None):
+        self.seconds = seconds
+        self.times = {}
+        self.timed_out = {}
+
+    def run(self, analyse, game: chess.pgn.Game, key: str = None):
+        """analyse(game), or None if it ran out of time.
+
+        :param key: the game's key, if already known (else from
+            stream_key()).
+        """
+        key = key or stream_key(game)
+        start = time.perf_counter()
+        try:
+            with time_limit(self.seconds, "game"):
+                return analyse(game)
+        except GameTimeout as error:
+            self.timed_out[key] = str(error)
+            return None
+        finally:
+            self.times[key] = time.perf_counter() - start
+
+    def update(self, times: dict, timed_out: dict):
+        """Add games timed elsewhere, e.g. by a worker process's timer."""
+        self.times.update(times)
+        self.timed_out.update(timed_out)
+
+    def slowest(self, n: int = 5) -> list:
+        """[(game key, seconds)] of the n slowest games, slowest first."""
+        return sorted(self.times.items(), key=lambda item: -item[1])[:n]
+
+    def report(self, n: int = 5) -> str:
+        lines = [f"{len(self.times)} games took {sum(self.times.values()):.1f}"
+                 f"s; {len(self.timed_out)} ran out of time"]
+        lines += [f"  {key}: {seconds:.2f}s"
+                  + (f" ({self.timed_out[key]})"
+                     if key in self.timed_out else "")
+                  for key, seconds in self.slowest(n)]
+        return "\n".join(lines)
+
+    def save_timed_out(self, path: str):
+        """List the keys of the games that ran out of time (their Lichess
+        IDs, for Lichess games), one per line, for a retry with
+        --ids-file."""
+        with open(path, "w") as f:
+            f.writelines(f"{key}\n" for key in self.timed_out)
+
+
+def analyse_games(analyse,
+                  pgn_path: str,
+                  offsets: list,
+                  keys: list,
+                  store=None,
+                  save_every: int = 100,
+                  on_result=None,
+                  timer: GameTimer = None) -> list:
+    """ Run a per-game detector over the selected games in a PGN file.
+
+    :param analyse: function taking a chess.pgn.Game and returning its
+        (JSON-serializable) results.
+    :param pgn_path: path to the PGN file, or a corpus.Corpus.
+    :param offsets: offsets of the selected games (see file_runs()).
+    :param keys: keys of the selected games (see game_key()).
+    :param store: optional store.ResultStore, keyed by game_key(). Games with
+        stored results are skipped, and new results are added to it as the
+        run goes.
+    :param save_every: number of new results to collect before writing them
+        to the store. Default value: 100.
+    :param on_result: optional function called with each game's results as
+        soon as they're ready (stored results first).
+    :param timer: optional GameTimer, timing each game and giving it a time
+        budget. Games that run out of time are left out of the results.
+
+    :return: each game's results, in the same order as offsets.
+    """
+    ids = list(keys)
+    stored = store.load(ids) if store else {}
+    todo = [(offset, i) for offset, i in zip(offsets, ids) if i not in stored]
+    if store:
+        print(f"Reusing stored results for {len(offsets) - len(todo)} games")
+        print('')
+    if on_result:
+        for results in stored.values():
+            on_result(results)
+
+    new = {}
+    pending = {}
+    games = read_games(pgn_path, [offset for offset, _ in todo])
+    try:
+        for (_, i), game in zip(tqdm(todo), games):
+            results = timer.run(analyse, game, i) if timer \
+                else analyse(game)
+            if results is None:
+                continue
+            new[i] = pending[i] = results
+            if on_result:
+                on_result(new[i])
+            if store and len(pending) >= save_every:
+                store.save(pending)
+                pending = {}
+    finally:
+        # A run stopped by an error or interrupt keeps the results it has
+        if store and pending:
+            store.save(pending)
+    return [stored[i] if i in stored else new[i] for i in ids
+            if i in stored or i in new]
+
+
+def stream_key(game: chess.pgn.Game) -> str:
+    """game_key() of a game already parsed, with its movetext exported
+    again (only needed for games without a Lichess link)."""
+    if game.headers.get("Site", "").startswith(gamelink_prefix):
+        return game_key(game.headers)
+    return game_key(game.headers, game.accept(chess.pgn.StringExporter(
+        headers=False, comments=False, variations=False)))
+
+
+def analyse_stream(analyse, games, store=None, save_every: int = 100,
+                   on_result=None, timer: GameTimer = None) -> list:
+    """ Run a per-game detector over games as they arrive, e.g. from
+    ingest.stream_exports().
+
+    :param analyse: function taking a chess.pgn.Game and returning its
+        (JSON-serializable) results.
+    :param games: iterable of chess.pgn.Game.
+    :param store: optional store.ResultStore, used as in analyse_games().
+    :param save_every: number of new results to collect before writing them
+        to the store. Default value: 100.
+    :param on_result: optional function called with each game's results as
+        soon as they're ready.
+    :param timer: optional GameTimer, used as in analyse_games().
+
+    :return: each game's results, in the order the games arrived.
+    """
+    results = []
+    pending = {}
+    reused = 0
+    try:
+        for game in tqdm(games):
+            i = stream_key(game)
+            stored = store.load([i]) if store else {}
+            if i in stored:
+                reused += 1
+                results.append(stored[i])
+            else:
+                game_results = timer.run(analyse, game, i) if timer \
+                    else analyse(game)
+                if game_results is None:
+                    continue
+                results.append(game_results)
+                pending[i] = results[-1]
+            if on_result:
+                on_result(results[-1])
+            if store and len(pending) >= save_every:
+                store.save(pending)
+                pending = {}
+    finally:
+        # Games the stream has moved past (e.g. in its resume state) keep
+        # their results even if the run stops early
+        if store and pending:
+            store.save(pending)
+    if store:
+        print(f"Reused stored results for {reused} games")
+    return results
+
+
+def merge_results(results: list, kinds: list) -> dict:
+    """Combine per-game results, each a dict of lists, into one dict."""
+    merged = {kind: [] for kind in kinds}
+    for game_results in results:
+        for kind in kinds:
+            merged[kind].extend(game_results[kind])
+    return merged
+
+
+def timestamp() -> str:
+    """Label used to tell apart output files from different runs."""
+    now = datetime.now()
+    return f"{now.year}{now.month}{now.day}_{now.hour}{now.minute}"
+
+
+class HeadersAndFinalBoard(chess.pgn.BoardBuilder):
+    """PGN visitor that reads a game's headers and final position (with the
+    mainline on its move stack), without building any game nodes."""
+
+    def begin_headers(self):
+        self.headers = chess.pgn.Headers()
+        return self.headers
+
+    def visit_header(self, tagname: str, tagvalue: str):
+        self.headers[tagname] = tagvalue
+
+    def handle_error(self, error: Exception):
+        # Keep the position reached so far, as chess.pgn.GameBuilder does
+        chess.pgn.LOGGER.error("%s while parsing %s", error,
+                               self.headers.get("Site"))
+
+    def result(self):
+        return self.headers, self.board
+
+
+def _map_chunk(task):
+    func, pgn_path, offsets, visitor, reduce = task
+    results = Counter() if reduce else []
+    with read_pgn(pgn_path) as pgn:
+        for game in games_at(pgn, pgn_path, offsets, visitor):
+            result = func(game)
+            if reduce:
+                results.update(result)
+            else:
+                results.append(result)
+    return results
+
+
+def map_games(func,
+              pgn_path: str,
+              offsets: list,
+              visitor=chess.pgn.GameBuilder,
+              processes: int = None,
+              chunksize: int = 200,
+              reduce: bool = False):
+    """ Apply a function to games in a PGN file using a pool of processes.
+
+    :param func: module-level function taking whatever `visitor` builds for
+        a game (a chess.pgn.Game by default).
+    :param pgn_path: path to the PGN file, or a corpus.Corpus.
+    :param offsets: offsets of the games to read, from game_offsets().
+    :param visitor: chess.pgn visitor class used to read each game.
+    :param processes: number of worker processes. Default value: one per CPU.
+    :param chunksize: number of games sent to a worker at a time. Default
+        value: 200.
+    :param reduce: func returns a Counter (or dict of counts), which each
+        worker sums over its chunk of games. The chunks' partial counts are
+        then merged as they come in, so memory use depends on the number of
+        distinct keys rather than on the number of games.
+
+    :return: func's results, in the same order as offsets, or with reduce,
+        their merged counts.
+    """
+    # Chunks never span files, so games from big and small files are spread
+    # evenly over the workers
+    tasks = [(func, path, run, visitor, reduce)
+             for path, run in file_runs(pgn_path, offsets, chunksize)]
+    results = Counter() if reduce else []
+    with multiprocessing.Pool(processes) as pool:
+        chunks = pool.imap_unordered(_map_chunk, tasks) if reduce \
+            else pool.imap(_map_chunk, tasks)
+        for chunk in tqdm(chunks, total=len(tasks), unit=" chunks"):
+            if reduce:
+                results.update(chunk)
+            else:
+                results.extend(chunk)
+    return results
+
+
+def map_reduce_games(func,
+                     pgn_path: str,
+                     offsets: list,
+                     visitor=chess.pgn.GameBuilder,
+                     processes: int = None,
+                     chunksize: int = 200) -> Counter:
+    """Count things across games in a PGN file: map_games() with reduce."""
+    return map_games(func, pgn_path, offsets, visitor, processes, chunksize,
+                     reduce=True)
+
+
 def evaluate_move(fen: str,
                   played: str,
                   time_per_move: int = 3,
@@ -24,21 +542,29 @@ def evaluate_move(fen: str,
     :param fen: FEN of position preceding move
     :param played: move that was played in UCI format
     :param time_per_move: number of seconds the engine should spend analysing
-        the position. Default value: 3.
+        each of the positions before and after the move. Default value: 3.
     :param engine_path: path to engine's .exe file.
 
     :return: cpl
     """
-    mate_thresh = 100000
+    import engine_analysis
+
     engine = chess.engine.SimpleEngine.popen_uci(engine_path)
     board = chess.Board(fen)
-    info = engine.analyse(board,
-                          multipv=1,
-                          limit=chess.engine.Limit(time=time_per_move))
+    limit = chess.engine.Limit(time=time_per_move)
+    game_key = object()
+    before, _ = engine_analysis.position_eval(engine, board, limit, game_key)
+    white = board.turn
+    board.push_uci(played)
+    after, _ = engine_analysis.position_eval(engine, board, limit, game_key)
     engine.quit()
-    # TODO: finish!
-    return None
+    return int(engine_analysis.cpl([before, after], [white])[0])
 
+@memo.memoize("uniquely_nonlosing",
+              lambda fen, played, num_engine_moves=5, time_per_move=3,
+              engine_path=engine_path: (memo.fen_key(fen), played,
+                                        num_engine_moves, time_per_move,
+                                        str(engine_path)))
 def check_if_move_is_uniquely_nonlosing(fen: str,
                                         played: str,
                                         num_engine_moves: int = 5,
@@ -59,6 +585,9 @@ def check_if_move_is_uniquely_nonlosing(fen: str,
     """
     mate_thresh = 100000
 
+    # Don't start a search that would run past the time allowed (see
+    # time_limit())
+    check_time(time_per_move)
     engine = chess.engine.SimpleEngine.popen_uci(engine_path)
     board = chess.Board(fen)
     info = engine.analyse(board, multipv=num_engine_moves,
@@ -71,6 +600,7 @@ def check_if_move_is_uniquely_nonlosing(fen: str,
         board.parse_uci(played)) == top_move else False
 
     if not played_matches_top:
+        check_time(time_per_move)
         engine = chess.engine.SimpleEngine.popen_uci(engine_path)
         board = chess.Board(fen)
         move_info = engine.analyse(board,
@@ -103,6 +633,166 @@ def check_if_move_is_uniquely_nonlosing(fen: str,
         return False
 
 
+class EngineBudget:
+    """Engine time allowed for a run, and a tally of how it was spent."""
+
+    def __init__(self, seconds: float = None):
+        self.seconds = seconds
+        self.spent = 0.0
+        self.saved = 0.0
+        self.checks = 0
+        self.skipped = 0
+
+    def remaining(self) -> float:
+        if self.seconds is None:
+            return float("inf")
+        return max(self.seconds - self.spent, 0.0)
+
+    def record(self, spent: float, fixed_cost: float):
+        """Count a check that took spent seconds, where the fixed-time check
+        would have taken fixed_cost."""
+        self.checks += 1
+        self.spent += spent
+        self.saved += fixed_cost - spent
+
+    def report(self) -> str:
+        budget = "no limit" if self.seconds is None else f"{self.seconds:.0f}s"
+        return (f"{self.checks} engine checks took {self.spent:.1f}s "
+                f"(budget: {budget}), saving {self.saved:.1f}s on fixed-time "
+                f"checks; {self.skipped} skipped for lack of time")
+
+
+def _other_nonlosing(board: chess.Board,
+                     played: chess.Move,
+                     lines: list,
+                     num_engine_moves: int,
+                     mate_thresh: int = 100000) -> bool:
+    """Whether engine lines (sorted best first) show a non-losing move other
+    than the played one that isn't much worse than it."""
+    evals = [(info["pv"][0],
+              info["score"].pov(board.turn).score(mate_score=mate_thresh))
+             for info in lines]
+    others = [e for move, e in evals if move != played][:num_engine_moves]
+    played_eval = next((e for move, e in evals if move == played), None)
+    if played_eval is None:
+        # The played move is worse than every line searched, so any other
+        # non-losing move will do
+        return any(e > -300 for e in others)
+    return any(e > -300 and played_eval - e <= 300 for e in others)
+
+
+class StableVerdict:
+    """The only-non-losing verdict of a multi-PV search, updated as the
+    search deepens, and settled once it has held for stable_depths
+    consecutive depths from min_depth on."""
+
+    def __init__(self, board: chess.Board, move: chess.Move, num_lines: int,
+                 num_engine_moves: int, min_depth: int, stable_depths: int):
+        self.board = board
+        self.move = move
+        self.num_lines = num_lines
+        self.num_engine_moves = num_engine_moves
+        self.min_depth = min_depth
+        self.stable_depths = stable_depths
+        self.latest = {}
+        self.verdicts = []
+        self.played_is_top = False
+
+    @property
+    def verdict(self):
+        """The latest verdict, or None if not even one depth has finished."""
+        return self.verdicts[-1] if self.verdicts else None
+
+    def update(self, info: dict) -> bool:
+        """Take in an info line from the search, returning whether the
+        verdict is settled."""
+        if "pv" not in info or "score" not in info:
+            return False
+        self.latest[info.get("multipv", 1)] = info
+        # Wait for the last line of each depth
+        if info.get("multipv", 1) != self.num_lines or \
+                len(self.latest) < self.num_lines:
+            return False
+        lines = [self.latest[i] for i in sorted(self.latest)]
+        self.played_is_top = lines[0]["pv"][0] == self.move
+        self.verdicts.append(not _other_nonlosing(self.board, self.move, lines,
+                                                  self.num_engine_moves))
+        return info.get("depth", 0) >= self.min_depth and \
+            len(self.verdicts) >= self.stable_depths and \
+            len(set(self.verdicts[-self.stable_depths:])) == 1
+
+    def fixed_cost(self, time_per_move: float) -> float:
+        """Time the fixed-time check would have taken."""
+        return time_per_move if self.played_is_top else 2 * time_per_move
+
+
+def check_if_move_is_uniquely_nonlosing_adaptive(
+        fen: str,
+        played: str,
+        num_engine_moves: int = 5,
+        time_per_move: float = 3,
+        engine_path: str = engine_path,
+        engine: chess.engine.SimpleEngine = None,
+        budget: EngineBudget = None,
+        min_depth: int = 12,
+        stable_depths: int = 3):
+    """ Adaptive version of check_if_move_is_uniquely_nonlosing().
+
+    Runs one multi-PV search covering the top moves and (if it is among them)
+    the played move, instead of a fixed-time search followed by a second
+    search of the played move. If the played move isn't in the top lines it
+    is worse than all of them, so they alone settle the verdict. The search
+    deepens until the verdict has been the same for stable_depths
+    consecutive depths (from min_depth on), or time_per_move (or the time
+    left, see time_limit()) runs out.
+
+    :param fen: FEN of position preceding move
+    :param played: move that was played, in UCI format
+    :param num_engine_moves: max number of other engine moves to consider.
+        Default value: 5.
+    :param time_per_move: max number of seconds to spend on the position.
+        Default value: 3.
+    :param engine_path: path to engine's .exe file, used when no engine is
+        given.
+    :param engine: optional engine to reuse between checks.
+    :param budget: optional EngineBudget; time spent is charged to it.
+    :param min_depth: depth before which the verdict is never final.
+    :param stable_depths: number of consecutive depths the verdict has to
+        hold for.
+
+    :return: True or False, or None if the budget is used up.
+    """
+    budget = budget or EngineBudget()
+    check_time()
+    limit = min(time_per_move, budget.remaining(), time_left())
+    if limit <= 0:
+        budget.skipped += 1
+        return None
+
+    board = chess.Board(fen)
+    move = chess.Move.from_uci(played)
+    num_lines = min(num_engine_moves + 1, board.legal_moves.count())
+    own_engine = engine is None
+    if own_engine:
+        engine = chess.engine.SimpleEngine.popen_uci(engine_path)
+
+    start = time.perf_counter()
+    verdict = StableVerdict(board, move, num_lines, num_engine_moves,
+                            min_depth, stable_depths)
+    with engine.analysis(board, chess.engine.Limit(time=limit),
+                         multipv=num_lines) as analysis:
+        for info in analysis:
+            if verdict.update(info):
+                break
+    spent = time.perf_counter() - start
+    if own_engine:
+        engine.quit()
+
+    budget.record(spent, verdict.fixed_cost(time_per_move))
+    return verdict.verdict
+
+
+@memo.memoize("masters", memo.fen_key)
 def check_position_against_masters_db(fen: str):
   """ Check FEN for matching Lichess Masters DB games.
 
@@ -110,25 +800,40 @@ def check_position_against_masters_db(fen: str):
   :return: matches: the number of Lichess Masters database games that reached
   the input position.
   """
-  # How long to wait between DB queries
-  pause_queries = 0.5  # between each query
-  pause_429 = 10       # after a 429 error is raised
-
-  fendict = {}
-  cachedfen = fendict.get(fen)
-  if cachedfen:
-    r = cachedfen
-  else:
-    while True:
-      payload = {'fen': fen, 'topGames': 0, 'moves': 30}
-      r = requests.get(f'https://explorer.lichess.ovh/master', params = payload)
-      if r.status_code == 200:
-        time.sleep(pause_queries)
-        r = r.json()
-        break
-      if r.status_code == 429:
-        print(f"Pausing for {pause_429} seconds")
-        time.sleep(pause_429)
-        continue
-    matches = r['white'] + r['black'] + r['draws']
-  return matches
\ No newline at end of file
+  import requests
+
+  failures = 0
+  while True:
+    payload = {'fen': fen, 'topGames': 0, 'moves': 30}
+    # Don't wait for a reply, or pause before retrying, past the time
+    # allowed (see time_limit())
+    check_time()
+    left = time_left()
+    try:
+      r = requests.get(explorer_url, params = payload,
+                       timeout = min(left, explorer_timeout))
+    except requests.Timeout:
+      # A slow reply counts as a failure, like an error status
+      check_time()
+      failures += 1
+      if failures > explorer_retries:
+        raise
+      check_time(explorer_pause * 2 ** failures)
+      time.sleep(explorer_pause * 2 ** failures)
+      continue
+    if r.status_code == 200:
+      time.sleep(explorer_pause)
+      r = r.json()
+      break
+    if r.status_code == 429:
+      check_time(explorer_pause_429)
+      print(f"Pausing for {explorer_pause_429} seconds")
+      time.sleep(explorer_pause_429)
+      continue
+    failures += 1
+    if failures > explorer_retries:
+      r.raise_for_status()
+    check_time(explorer_pause * 2 ** failures)
+    time.sleep(explorer_pause * 2 ** failures)
+  matches = r['white'] + r['black'] + r['draws']
+  return matches
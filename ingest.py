@@ -0,0 +1,244 @@
+"""Stream games straight from the Lichess game export API.
+
+Games are read from the HTTP response as it downloads (in PGN or NDJSON
+format) and handed to the detectors one by one, so analysis overlaps with
+the download instead of waiting for a whole export to be saved in inputs/.
+Several users' games can be pulled at once, and a state file remembers the
+newest game seen from each export so the next run only asks for newer ones.
+"""
+
+import io
+import json
+import os
+import queue
+import threading
+import time
+from datetime import datetime, timezone
+
+import chess
+import chess.engine
+import chess.pgn
+
+lichess_url = "https://lichess.org"
+pause_429 = 60  # seconds, as asked for by the Lichess API docs
+
+
+def user_export_url(user: str, base_url: str = lichess_url) -> str:
+    return f"{base_url}/api/games/user/{user}"
+
+
+def _get(url: str, params: dict, fmt: str, token: str = None):
+    """Start a streamed export request, waiting out any 429s."""
+    import requests
+
+    headers = {"Accept": "application/x-ndjson" if fmt == "ndjson"
+               else "application/x-chess-pgn"}
+    if token:
+        headers["Authorization"] = f"Bearer {token}"
+    while True:
+        r = requests.get(url, params=params, headers=headers, stream=True,
+                         timeout=60)
+        if r.status_code == 429:
+            r.close()
+            print(f"Pausing for {pause_429} seconds")
+            time.sleep(pause_429)
+            continue
+        r.raise_for_status()
+        return r
+
+
+def split_pgn(lines):
+    """Group the lines of a PGN stream into one string per game."""
+    game = []
+    in_movetext = False
+    for line in lines:
+        if line.startswith("[") and in_movetext:
+            yield "\n".join(game)
+            game = []
+            in_movetext = False
+        if line.strip() and not line.startswith("["):
+            in_movetext = True
+        game.append(line)
+    if in_movetext:
+        yield "\n".join(game)
+
+
+def game_from_ndjson(data: dict) -> chess.pgn.Game:
+    """Build a game, with eval and clock comments, from an NDJSON export
+    line."""
+    game = chess.pgn.Game()
+    created = datetime.fromtimestamp(data["createdAt"] / 1000, timezone.utc)
+    game.headers["Event"] = f"{'Rated' if data.get('rated') else 'Casual'} " \
+                            f"{data.get('perf', '')} game".replace("  ", " ")
+    game.headers["Site"] = f"{lichess_url}/{data['id']}"
+    game.headers["Date"] = created.strftime("%Y.%m.%d")
+    game.headers["UTCDate"] = created.strftime("%Y.%m.%d")
+    game.headers["UTCTime"] = created.strftime("%H:%M:%S")
+    for color in ["white", "black"]:
+        player = data["players"][color]
+        name = player.get("user", {}).get("name", "?")
+        game.headers[color.capitalize()] = name
+        if "rating" in player:
+            game.headers[f"{color.capitalize()}Elo"] = str(player["rating"])
+    winner = data.get("winner")
+    if winner:
+        game.headers["Result"] = "1-0" if winner == "white" else "0-1"
+    elif data.get("status") in {"started", "created"}:
+        game.headers["Result"] = "*"
+    else:
+        game.headers["Result"] = "1/2-1/2"
+    if "initialFen" in data:
+        game.setup(data["initialFen"])
+
+    analysis = data.get("analysis", [])
+    clocks = data.get("clocks", [])
+    board = game.board()
+    node = game
+    for i, san in enumerate(data.get("moves", "").split()):
+        move = board.parse_san(san)
+        board.push(move)
+        node = node.add_variation(move)
+        if i < len(analysis):
+            if "eval" in analysis[i]:
+                score = chess.engine.Cp(analysis[i]["eval"])
+            elif "mate" in analysis[i]:
+                score = chess.engine.Mate(analysis[i]["mate"])
+            else:
+                score = None
+            if score is not None:
+                node.set_eval(chess.engine.PovScore(score, chess.WHITE))
+        if i < len(clocks):
+            node.set_clock(clocks[i] / 100)
+    return game
+
+
+def game_timestamp(game: chess.pgn.Game) -> int:
+    """When a game started, in milliseconds since the epoch (or 0)."""
+    try:
+        started = datetime.strptime(
+            f"{game.headers['UTCDate']} {game.headers['UTCTime']}",
+            "%Y.%m.%d %H:%M:%S").replace(tzinfo=timezone.utc)
+    except (KeyError, ValueError):
+        return 0
+    return int(started.timestamp() * 1000)
+
+
+def stream_games(url: str,
+                 since: int = None,
+                 fmt: str = "pgn",
+                 token: str = None,
+                 params: dict = None):
+    """ Yield games from a Lichess export endpoint as they arrive.
+
+    :param url: export URL, e.g. from user_export_url().
+    :param since: only export games started after this time (in ms since the
+        epoch).
+    :param fmt: "pgn" or "ndjson".
+    :param token: optional Lichess API token (exports are faster with one).
+    :param params: extra query parameters.
+    """
+    params = {"evals": "true", "clocks": "true", "sort": "dateAsc",
+              **(params or {})}
+    if since:
+        params["since"] = since
+    with _get(url, params, fmt, token) as r:
+        r.encoding = "utf-8"
+        lines = r.iter_lines(decode_unicode=True)
+        if fmt == "ndjson":
+            for line in lines:
+                if line.strip():
+                    yield game_from_ndjson(json.loads(line))
+        else:
+            for text in split_pgn(lines):
+                game = chess.pgn.read_game(io.StringIO(text))
+                if game is not None:
+                    yield game
+
+
+class ResumeState:
+    """Newest game start time seen for each export URL, kept in a JSON
+    file."""
+
+    def __init__(self, path: str = None):
+        self.path = path
+        self.latest = {}
+        if path and os.path.exists(path):
+            with open(path) as f:
+                self.latest = json.load(f)
+
+    def since(self, url: str):
+        latest = self.latest.get(url)
+        return latest + 1 if latest is not None else None
+
+    def update(self, url: str, game: chess.pgn.Game):
+        self.latest[url] = max(self.latest.get(url, 0), game_timestamp(game))
+
+    def save(self):
+        if self.path:
+            with open(self.path, "w") as f:
+                json.dump(self.latest, f, indent=1)
+
+
+def stream_exports(urls: list,
+                   state: ResumeState = None,
+                   fmt: str = "pgn",
+                   token: str = None,
+                   workers: int = 4,
+                   queue_size: int = 100):
+    """ Pull several exports at once and yield their games as they arrive.
+
+    Each export is downloaded in its own thread into a bounded queue, so
+    downloads pause while the consumer falls behind. The resume state only
+    moves past a game once the consumer asks for the next one, i.e. once
+    it's done with it, so a game abandoned mid-analysis is requested again
+    next time. The state is saved when the stream is done (or abandoned).
+
+    :param urls: export URLs, e.g. one per user from user_export_url().
+    :param state: optional ResumeState; only newer games are requested.
+    :param fmt: "pgn" or "ndjson".
+    :param token: optional Lichess API token.
+    :param workers: max number of simultaneous downloads. Default value: 4.
+    :param queue_size: max number of downloaded games waiting to be
+        analysed. Default value: 100.
+    """
+    state = state or ResumeState()
+    games = queue.Queue(maxsize=queue_size)
+    todo = queue.Queue()
+    for url in urls:
+        todo.put(url)
+    stop = threading.Event()
+    done = object()
+
+    def download():
+        while not stop.is_set():
+            try:
+                url = todo.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                for game in stream_games(url, state.since(url), fmt, token):
+                    if stop.is_set():
+                        break
+                    games.put((url, game))
+            except Exception as error:
+                games.put((url, error))
+        games.put((None, done))
+
+    threads = [threading.Thread(target=download, daemon=True)
+               for _ in range(min(workers, len(urls)))]
+    for thread in threads:
+        thread.start()
+    finished = 0
+    try:
+        while finished < len(threads):
+            url, game = games.get()
+            if game is done:
+                finished += 1
+            elif isinstance(game, Exception):
+                print(f"Failed to download {url}: {game}")
+            else:
+                yield game
+                state.update(url, game)
+    finally:
+        stop.set()
+        state.save()
@@ -1,9 +1,481 @@
 """chess-curator v0.1
 
+Usage: python main.py COMMAND [OPTIONS]
+
+Run `python main.py --help` for the list of commands, and
+`python main.py COMMAND --help` for each command's options.
+
+Only argparse is imported up front; each command imports the modules it
+needs (and so pandas, NumPy, the engine and HTTP clients, etc.) when it
+runs, so listing commands or options is instant.
 """
 
+import argparse
+
+default_pgn = "inputs/allgames_team4545.pgn"
+default_theory_index = "inputs/masters_theory.npz"
+default_store = "outputs/results.sqlite"
+default_engine = \
+    "engine/stockfish_22031308_x64_avx2/stockfish_22031308_x64_avx2.exe"
+default_resume_state = "outputs/ingest_state.json"
+default_position_index = "inputs/position_index"
+default_index_cache = "inputs/.corpus_index"
+
+
+def pgn_input(args):
+    """The --pgn file, or a corpus.Corpus if several files, globs or
+    manifests were given."""
+    import corpus
+    return corpus.open_pgn(args.pgn, args.index_cache)
+
+
+def ids_file(path: str) -> list:
+    """The game IDs (or keys, see helpers.game_key()) listed in a file, e.g.
+    the games a run timed out on."""
+    with open(path) as f:
+        return f.read().split()
+
+
+def lichess_games(args):
+    """Games streamed from the Lichess API, if any were asked for, else
+    None (so the PGN file is read)."""
+    if not args.lichess_users and not args.lichess_urls:
+        return None
+    import ingest
+    urls = [ingest.user_export_url(user, args.lichess_server)
+            for user in args.lichess_users] + args.lichess_urls
+    state = ingest.ResumeState(args.resume_state)
+    return ingest.stream_exports(urls, state, args.lichess_format,
+                                 args.lichess_token, args.downloads)
+
+
+def sacs(args):
+    import detect_sacs
+    detect_sacs.run(pgn_input(args), args.sample, args.ids, args.theory_index,
+                    args.online_theory, args.engine, args.output,
+                    args.store, lichess_games(args), args.adaptive_engine,
+                    args.engine_budget, args.position_index,
+                    seed=args.seed, stratify_by=args.stratify_by,
+                    processes=args.processes, async_verify=args.async_verify,
+                    max_requests=args.max_requests,
+                    max_engines=args.max_engines, game_time=args.game_time,
+                    candidate_time=args.candidate_time,
+                    slowest=args.slowest)
+
+
+def sacs_sweep(args):
+    import sacs_sweep
+    grid = {parameter: getattr(args, parameter)
+            for parameter in ["material_adv_threshold",
+                              "winning_eval_threshold", "opening_plies",
+                              "ending_plies", "max_ply", "theory_games"]
+            if getattr(args, parameter)}
+    sacs_sweep.run(pgn_input(args), grid, args.sample, args.ids,
+                   args.theory_index, args.online_theory, args.store,
+                   seed=args.seed, stratify_by=args.stratify_by,
+                   processes=args.processes)
+
+
+def greek_gifts(args):
+    import detect_greek_gifts
+    detect_greek_gifts.run(pgn_input(args), args.sample, args.ids, args.store,
+                           lichess_games(args), args.engine,
+                           args.engine_workers, args.time_per_position,
+                           seed=args.seed, stratify_by=args.stratify_by,
+                           processes=args.processes)
+
+
+def mates(args):
+    import detect_mates
+    detect_mates.run(pgn_input(args), args.sample, args.ids, args.images,
+                     args.store, lichess_games(args), seed=args.seed,
+                     stratify_by=args.stratify_by, processes=args.processes)
+
+
+def endgame_reach(args):
+    import endgame_reach
+    endgame_reach.run(pgn_input(args), args.dataset, args.max_pieces,
+                      args.processes)
+
+
+def endgame_stats(args):
+    import endgame_stats
+    endgame_stats.run(pgn_input(args), args.processes)
+
+
+def tactics_stats(args):
+    import tactics_stats
+    tactics_stats.run(pgn_input(args), args.processes)
+
+
+def eval_swings(args):
+    import eval_swings
+    eval_swings.run(pgn_input(args), args.dataset, args.processes)
+
+
+def engine_analysis(args):
+    import engine_analysis
+    engine_analysis.run(pgn_input(args), args.sample, args.ids, args.engine,
+                        args.time_per_position, args.depth,
+                        seed=args.seed, stratify_by=args.stratify_by)
+
+
+def dataset(args):
+    import dataset
+    n = dataset.build_dataset(args.pgn, args.out, args.partition_size)
+    print(f"Saved {n} games in {args.out}")
+
+
+def theory_index(args):
+    import theory
+    index = theory.build_theory_index(args.reference, args.max_ply)
+    index.save(args.out)
+    print(f"Saved {len(index)} positions in {args.out}")
+
+
+def position_index(args):
+    import corpus
+    import position_index
+    index = position_index.PositionIndex(args.index)
+    added = index.update(corpus.expand(args.pgns), args.processes)
+    if args.compact:
+        index.compact()
+    print(f"Added {added} games to {args.index} ({len(index)} in all)")
+
+
+def find_position(args):
+    import time
+    import chess
+    import position_index
+    index = position_index.open_index(args.index)
+    if index is None:
+        raise SystemExit(f"No position index in {args.index}")
+    start = time.perf_counter()
+    found = index.lookup(chess.Board(args.fen))
+    elapsed = time.perf_counter() - start
+    for game_id, ply in found:
+        print(f"https://lichess.org/{game_id}#{ply}")
+    print(f"{len(found)} occurrence(s) in "
+          f"{len({game_id for game_id, _ in found})} game(s), "
+          f"found in {elapsed * 1000:.1f}ms")
 
-if __name__ == '__main__':
-    # do sthg
 
+def shard_plan(args):
+    import shards
+    options = {"theory_index": args.theory_index,
+               "online_theory": args.online_theory,
+               "engine_path": args.engine} if args.detector == "sacs" else {}
+    shards.plan(args.queue, args.pgn, args.shards, args.detector, options)
+    print(f"Queued {args.shards} shards of {args.pgn} in {args.queue}")
 
+
+def shard_work(args):
+    import shards
+    print(f"Finished {shards.work(args.queue)} shards")
+
+
+def shard_requeue(args):
+    import shards
+    print(f"Requeued {shards.requeue(args.queue)} shards")
+
+
+def shard_merge(args):
+    import shards
+    detector = shards.load_plan(args.queue)["detector"]
+    options = {"sacs": {"output": args.output},
+               "mates": {"images": args.images}}.get(detector, {})
+    shards.merge(args.queue, **options)
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        prog="chess-curator",
+        description="Find interesting things in Lichess games.")
+    commands = parser.add_subparsers(title="commands", required=True)
+
+    # Options shared by commands that read games from a PGN file
+    pgn_options = argparse.ArgumentParser(add_help=False)
+    pgn_options.add_argument("--pgn", default=default_pgn,
+                             help=f"input PGN (default: {default_pgn})")
+
+    # Options shared by commands that can read games from several PGN files
+    corpus_options = argparse.ArgumentParser(add_help=False)
+    corpus_options.add_argument(
+        "--pgn", nargs="+", default=[default_pgn], metavar="PGN",
+        help="input PGN files (optionally .gz, .bz2 or .xz), globs, or "
+             f".txt manifests listing them (default: {default_pgn})")
+    corpus_options.add_argument(
+        "--index-cache", default=default_index_cache,
+        help="where to cache the game offsets of each file of a multi-file "
+             f"corpus (default: {default_index_cache})")
+
+    selection = argparse.ArgumentParser(add_help=False)
+    group = selection.add_mutually_exclusive_group()
+    group.add_argument("--sample", type=int, default=0, metavar="N",
+                       help="check a random sample of N games")
+    group.add_argument("--ids", nargs="+", metavar="ID",
+                       help="only check these Lichess game IDs")
+    group.add_argument("--ids-file", dest="ids", type=ids_file,
+                       metavar="FILE",
+                       help="only check the game IDs listed in FILE, e.g. "
+                            "games an earlier run timed out on")
+    selection.add_argument("--seed", type=int,
+                           help="seed for --sample, to draw the same games "
+                                "again")
+    selection.add_argument("--stratify-by",
+                           choices=["rating", "time-control", "season"],
+                           help="sample the same number of games from each "
+                                "rating band, time control or season")
+
+    incremental = argparse.ArgumentParser(add_help=False)
+    incremental.add_argument("--store", default=default_store,
+                             help="result store used to skip games analysed "
+                                  f"before (default: {default_store})")
+    incremental.add_argument("--no-store", dest="store",
+                             action="store_const", const=None,
+                             help="analyse every game, without a result store")
+
+    # Options for detectors that can read games straight from the Lichess API
+    lichess = argparse.ArgumentParser(add_help=False)
+    group = lichess.add_argument_group(
+        "streaming from Lichess",
+        "Stream games from the Lichess export API instead of reading --pgn.")
+    group.add_argument("--lichess-user", dest="lichess_users", nargs="+",
+                       default=[], metavar="USER",
+                       help="export these users' games")
+    group.add_argument("--lichess-url", dest="lichess_urls", nargs="+",
+                       default=[], metavar="URL",
+                       help="other export URLs, e.g. a tournament's games")
+    group.add_argument("--lichess-format", choices=["pgn", "ndjson"],
+                       default="pgn")
+    group.add_argument("--lichess-token", help="Lichess API token")
+    group.add_argument("--lichess-server", default="https://lichess.org",
+                       help="server to export users' games from")
+    group.add_argument("--resume-state", default=default_resume_state,
+                       help="file recording the newest game seen per export, "
+                            "so later runs only fetch newer games "
+                            f"(default: {default_resume_state})")
+    group.add_argument("--downloads", type=int, default=4,
+                       help="max simultaneous exports (default: 4)")
+
+    parallel = argparse.ArgumentParser(add_help=False)
+    parallel.add_argument("--processes", type=int,
+                          help="worker processes (default: one per CPU)")
+
+    command = commands.add_parser("sacs",
+                                  parents=[corpus_options, selection,
+                                           incremental, lichess, parallel],
+                                  help="identify piece sacrifices")
+    command.add_argument("--theory-index", default=default_theory_index,
+                         help="local opening-theory index "
+                              f"(default: {default_theory_index})")
+    command.add_argument("--no-online-theory", dest="online_theory",
+                         action="store_false",
+                         help="don't query the Lichess Masters explorer when "
+                              "there is no local theory index")
+    command.add_argument("--engine", default=default_engine,
+                         help="UCI engine for the only-non-losing check")
+    command.add_argument("--adaptive-engine", action="store_true",
+                         help="run the only-non-losing check as one search "
+                              "per candidate that stops once its verdict "
+                              "is settled")
+    command.add_argument("--engine-budget", type=float, metavar="SECONDS",
+                         help="engine time for the whole run, spent on the "
+                              "most promising candidates first (implies "
+                              "--adaptive-engine)")
+    command.add_argument("--position-index", metavar="DIR",
+                         help="flag candidates whose position occurred in "
+                              "other games in this position index")
+    command.add_argument("--async-verify", action="store_true",
+                         help="run the theory and engine checks "
+                              "concurrently, while later games are analysed")
+    command.add_argument("--max-requests", type=int, default=2,
+                         help="explorer queries at once with --async-verify "
+                              "(default: 2)")
+    command.add_argument("--max-engines", type=int, default=2,
+                         help="engines searching at once with --async-verify "
+                              "(default: 2)")
+    command.add_argument("--game-time", type=float, metavar="SECONDS",
+                         help="give up on games still being checked after "
+                              "this long, listing them for a retry")
+    command.add_argument("--candidate-time", type=float, metavar="SECONDS",
+                         help="give up on games whose theory and engine "
+                              "checks of a candidate take longer than this")
+    command.add_argument("--slowest", type=int, default=5, metavar="N",
+                         help="report the N slowest games (default: 5)")
+    command.add_argument("--output", default="outputs/results.xlsx",
+                         help="spreadsheet to save results in")
+    command.set_defaults(func=sacs)
+
+    command = commands.add_parser(
+        "sacs-sweep",
+        parents=[corpus_options, selection, incremental, parallel],
+        help="count the sacs found with each combination of thresholds",
+        description="Read each game once, then count the candidate sacs "
+                    "(before the engine check) found with every combination "
+                    "of the given thresholds, and how they differ from the "
+                    "current settings. Thresholds left out keep their "
+                    "current values.")
+    command.add_argument("--theory-index", default=default_theory_index,
+                         help="local opening-theory index "
+                              f"(default: {default_theory_index})")
+    command.add_argument("--no-online-theory", dest="online_theory",
+                         action="store_false",
+                         help="don't query the Lichess Masters explorer when "
+                              "there is no local theory index")
+    group = command.add_argument_group("thresholds to try")
+    group.add_argument("--material-adv-threshold", type=int, nargs="+",
+                       metavar="PAWNS",
+                       help="skip moves when this far ahead in material")
+    group.add_argument("--winning-eval-threshold", type=int, nargs="+",
+                       metavar="CP",
+                       help="skip moves in positions evaluated beyond this")
+    group.add_argument("--opening-plies", type=int, nargs="+", metavar="N",
+                       help="skip the first N plies (at least 2)")
+    group.add_argument("--ending-plies", type=int, nargs="+", metavar="N",
+                       help="skip the last N plies (at least 6)")
+    group.add_argument("--max-ply", type=int, nargs="+", metavar="N",
+                       help="skip moves from ply N")
+    group.add_argument("--theory-games", type=int, nargs="+", metavar="N",
+                       help="master games making a sac theory")
+    command.set_defaults(func=sacs_sweep)
+
+    command = commands.add_parser("greek-gifts",
+                                  parents=[corpus_options, selection,
+                                           incremental, lichess, parallel],
+                                  help="identify Greek gift sacrifices")
+    command.add_argument("--engine", default=default_engine,
+                         help="UCI engine for scoring sacs in games without "
+                              "[%%eval] comments")
+    command.add_argument("--no-engine", dest="engine", action="store_const",
+                         const=None,
+                         help="leave sacs without [%%eval] comments unscored")
+    command.add_argument("--engine-workers", type=int, default=4,
+                         help="engines to run at once")
+    command.add_argument("--time-per-position", type=float, default=0.5,
+                         metavar="SECONDS")
+    command.set_defaults(func=greek_gifts)
+
+    command = commands.add_parser("mates",
+                                  parents=[corpus_options, selection,
+                                           incremental, lichess, parallel],
+                                  help="identify well-known mate patterns")
+    command.add_argument("--no-images", dest="images", action="store_false",
+                         help="don't save PNGs of the final positions")
+    command.set_defaults(func=mates)
+
+    command = commands.add_parser(
+        "endgame-reach", parents=[corpus_options, parallel],
+        help="find the first tablebase-range position of each game")
+    command.add_argument("--dataset",
+                         help="read a ply dataset instead of the PGN")
+    command.add_argument("--max-pieces", type=int, default=7)
+    command.set_defaults(func=endgame_reach)
+
+    command = commands.add_parser(
+        "endgame-stats", parents=[corpus_options, parallel],
+        help="count the material signatures reached in games")
+    command.set_defaults(func=endgame_stats)
+
+    command = commands.add_parser(
+        "tactics-stats", parents=[corpus_options, parallel],
+        help="count tactics per game and per player")
+    command.set_defaults(func=tactics_stats)
+
+    command = commands.add_parser(
+        "eval-swings", parents=[corpus_options, parallel],
+        help="find blunders, missed wins and turning points from the "
+             "games' evals")
+    command.add_argument("--dataset",
+                         help="read a ply dataset instead of the PGN")
+    command.set_defaults(func=eval_swings)
+
+    command = commands.add_parser(
+        "engine-analysis", parents=[corpus_options, selection],
+        help="evaluate every move of each game with one engine session")
+    command.add_argument("--engine", default=default_engine)
+    command.add_argument("--time-per-position", type=float, default=0.5,
+                         metavar="SECONDS")
+    command.add_argument("--depth", type=int,
+                         help="search to this depth instead of for a time")
+    command.set_defaults(func=engine_analysis)
+
+    command = commands.add_parser(
+        "dataset", parents=[pgn_options],
+        help="convert a PGN into a columnar ply dataset")
+    command.add_argument("out", help="directory to save the dataset in")
+    command.add_argument("--partition-size", type=int, default=10000,
+                         help="games per ply partition")
+    command.set_defaults(func=dataset)
+
+    command = commands.add_parser(
+        "theory-index", help="build the local opening-theory index")
+    command.add_argument("reference", nargs="+",
+                         help="reference PGN(s), e.g. master games")
+    command.add_argument("--out", default=default_theory_index)
+    command.add_argument("--max-ply", type=int, default=50,
+                         help="only index positions up to this ply")
+    command.set_defaults(func=theory_index)
+
+    command = commands.add_parser(
+        "position-index", parents=[parallel],
+        help="add games to the position index, for position search")
+    command.add_argument("pgns", nargs="+", metavar="PGN",
+                         help="PGN files, globs or .txt manifests")
+    command.add_argument("--index", default=default_position_index,
+                         help=f"index directory (default: "
+                              f"{default_position_index})")
+    command.add_argument("--compact", action="store_true",
+                         help="merge the index's segments afterwards")
+    command.set_defaults(func=position_index)
+
+    command = commands.add_parser(
+        "find-position", help="list the indexed games reaching a position")
+    command.add_argument("fen")
+    command.add_argument("--index", default=default_position_index)
+    command.set_defaults(func=find_position)
+
+    command = commands.add_parser(
+        "shard-plan", parents=[pgn_options],
+        help="split a PGN into shards for a run over several machines")
+    command.add_argument("queue", help="queue directory shared by all nodes")
+    command.add_argument("--detector", default="sacs",
+                         choices=["sacs", "greek-gifts", "mates"])
+    command.add_argument("--shards", type=int, default=64,
+                         help="number of shards (default: 64)")
+    command.add_argument("--theory-index", default=default_theory_index)
+    command.add_argument("--no-online-theory", dest="online_theory",
+                         action="store_false")
+    command.add_argument("--engine", default=default_engine)
+    command.set_defaults(func=shard_plan)
+
+    command = commands.add_parser(
+        "shard-work", help="analyse queued shards until none are left")
+    command.add_argument("queue")
+    command.set_defaults(func=shard_work)
+
+    command = commands.add_parser(
+        "shard-requeue",
+        help="requeue shards left unfinished by stopped nodes")
+    command.add_argument("queue")
+    command.set_defaults(func=shard_requeue)
+
+    command = commands.add_parser(
+        "shard-merge", help="report the results of a finished sharded run")
+    command.add_argument("queue")
+    command.add_argument("--output", default="outputs/results.xlsx",
+                         help="spreadsheet to save sacs results in")
+    command.add_argument("--no-images", dest="images", action="store_false",
+                         help="don't save PNGs of mates")
+    command.set_defaults(func=shard_merge)
+
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
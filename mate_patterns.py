@@ -5,7 +5,9 @@ for lichess-puzzler.
 https://github.com/ornicar/lichess-puzzler/blob/dec5337f3c4f62b6d2999e0170d5ece12e8599da/tagger/cook.py
 """
 
-from chess import Outcome
+import chess
+from chess import Outcome, SquareSet, square_distance, square_file, square_rank
+from chess import KNIGHT, PAWN
 from chess.pgn import Game
 
 
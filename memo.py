@@ -0,0 +1,99 @@
+"""Shared memo layer for per-position computations.
+
+The same positions crop up again and again across league games (especially
+in openings and common endgames), so results of tactic checks, explorer
+lookups and engine calls are cached under the position's Zobrist hash plus
+the kind of computation.
+"""
+
+import functools
+from collections import OrderedDict, defaultdict
+from typing import Callable, Hashable
+
+import chess
+import chess.polyglot
+
+default_maxsize = 100000
+
+
+class PositionCache:
+    """Bounded LRU cache with per-kind hit/miss counts."""
+
+    def __init__(self, maxsize: int = default_maxsize):
+        self.maxsize = maxsize
+        self.enabled = True
+        self._entries = OrderedDict()
+        self.hits = defaultdict(int)
+        self.misses = defaultdict(int)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def lookup(self, kind: str, key: Hashable, compute: Callable):
+        """Return the cached result for (kind, key), computing it if needed."""
+        if not self.enabled:
+            return compute()
+        entry = (kind, key)
+        try:
+            self._entries.move_to_end(entry)
+        except KeyError:
+            self.misses[kind] += 1
+            result = compute()
+            self._entries[entry] = result
+            if len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+            return result
+        self.hits[kind] += 1
+        return self._entries[entry]
+
+    def clear(self):
+        self._entries.clear()
+        self.hits.clear()
+        self.misses.clear()
+
+    def stats(self) -> dict:
+        """Hits, misses and hit rate for each kind of computation."""
+        stats = {}
+        for kind in sorted(set(self.hits) | set(self.misses)):
+            hits, misses = self.hits[kind], self.misses[kind]
+            stats[kind] = {"hits": hits, "misses": misses,
+                           "hit_rate": hits / (hits + misses)}
+        return stats
+
+    def report(self) -> str:
+        return "\n".join(
+            f"{kind}: {s['hits']} hits, {s['misses']} misses "
+            f"({s['hit_rate']:.1%} hit rate)"
+            for kind, s in self.stats().items())
+
+
+cache = PositionCache()
+
+
+def board_key(board: chess.Board) -> int:
+    return chess.polyglot.zobrist_hash(board)
+
+
+def fen_key(fen: str) -> int:
+    return chess.polyglot.zobrist_hash(chess.Board(fen))
+
+
+def memoize(kind: str, key: Callable[..., Hashable]):
+    """Cache a function's results in the shared position cache.
+
+    :param kind: label for the computation, kept separate from other kinds.
+    :param key: called with the function's arguments; returns a hashable key
+        that fully determines the result (normally built around board_key()
+        or fen_key()), or None if the key would cost more than the function
+        itself, in which case the result isn't cached.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            entry = key(*args, **kwargs)
+            if entry is None:
+                return func(*args, **kwargs)
+            return cache.lookup(kind, entry,
+                                lambda: func(*args, **kwargs))
+        return wrapper
+    return decorator
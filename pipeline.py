@@ -0,0 +1,205 @@
+"""Reading and analysing the games in a PGN at the same time.
+
+A reader thread splits the PGN (or corpus.Corpus) into each game's text and
+queues them in batches, worker processes parse and analyse them, and the
+calling thread writes their results to the result store as they come back:
+
+    reader thread --> tasks --> worker processes --> results --> writer
+
+Both queues are bounded, so memory use doesn't grow with the size of the
+PGN, and analysis starts as soon as the first batch is read rather than
+after a scan of the whole file. The reader also skips copies of games it
+has already queued, and games with stored results, so workers only get new
+games.
+"""
+
+import io
+import multiprocessing
+import os
+import queue
+import re
+import threading
+import traceback
+
+import chess.pgn
+from tqdm import tqdm
+
+import helpers
+import ingest
+
+default_batch_size = 20
+# Batches queued per worker, to keep workers busy while the reader catches up
+batches_per_worker = 4
+
+header_pattern = re.compile(r'^\[(\w+)\s+"(.*)"\]\s*$', re.M)
+
+
+def split_games(pgn_path):
+    """Yield each game's text from a PGN file or corpus.Corpus."""
+    for path in helpers.pgn_files(pgn_path):
+        with helpers.read_pgn(path) as pgn:
+            yield from ingest.split_pgn(line.rstrip("\n") for line in pgn)
+
+
+def _read(pgn_path, store, dedupe, batch_size, tasks, results):
+    """Queue batches of games for the workers, with the stored results of
+    games analysed before."""
+    try:
+        # SQLite connections can't be shared between threads
+        store = store.reopen() if store else None
+        seen = set()
+        batches = 0
+        batch = []
+        for text in split_games(pgn_path):
+            headers = dict(header_pattern.findall(text))
+            key = helpers.game_key(headers, header_pattern.sub("", text))
+            if dedupe:
+                if key in seen:
+                    continue
+                seen.add(key)
+            batch.append((key, text))
+            if len(batch) == batch_size:
+                tasks.put(_task(batches, batch, store))
+                batches += 1
+                batch = []
+        if batch:
+            tasks.put(_task(batches, batch, store))
+            batches += 1
+        results.put(("done", batches))
+    except Exception as error:
+        results.put(("error", error))
+
+
+def _task(n, batch, store):
+    """Batch number, game keys (see helpers.game_key()), (key, text) of the
+    games to analyse, and the stored results of the others."""
+    ids = [i for i, _ in batch]
+    stored = store.load(ids) if store else {}
+    return n, ids, [(i, text) for i, text in batch if i not in stored], \
+        stored
+
+
+def _work(analyse, tasks, results, game_time):
+    """Analyse batches of games until told to stop, sending back their
+    results and how long each game took."""
+    while True:
+        task = tasks.get()
+        if task is None:
+            return
+        n, ids, new, stored = task
+        timer = helpers.GameTimer(game_time)
+        try:
+            analysed = {}
+            for i, text in new:
+                game_results = timer.run(
+                    analyse, chess.pgn.read_game(io.StringIO(text)), i)
+                if game_results is not None:
+                    analysed[i] = game_results
+        except Exception:
+            results.put(("error", RuntimeError(traceback.format_exc())))
+            return
+        results.put((n, ids, analysed, stored, timer.times,
+                     timer.timed_out))
+
+
+def analyse_pgn(analyse,
+                pgn_path,
+                store=None,
+                processes: int = None,
+                batch_size: int = default_batch_size,
+                dedupe: bool = True,
+                save_every: int = 100,
+                on_result=None,
+                timer: helpers.GameTimer = None) -> list:
+    """ Run a per-game detector over every game in a PGN file, reading,
+    analysing and storing results at the same time.
+
+    :param analyse: module-level function (or functools.partial of one)
+        taking a chess.pgn.Game and returning its (JSON-serializable) results.
+    :param pgn_path: path to the PGN file, or a corpus.Corpus.
+    :param store: optional store.ResultStore, keyed by helpers.game_key().
+        Games with stored results are skipped, and new results are added to
+        it as the run goes.
+    :param processes: number of worker processes. Default value: one per CPU.
+    :param batch_size: number of games sent to a worker at a time. Default
+        value: 20.
+    :param dedupe: skip copies of games seen earlier.
+    :param save_every: number of new results to collect before writing them
+        to the store. Default value: 100.
+    :param on_result: optional function called with each game's results as
+        soon as they're ready, in the order of the games.
+    :param timer: optional helpers.GameTimer, timing each game and giving it
+        a time budget. Games that run out of time are left out of the
+        results.
+
+    :return: each game's results, in the order of the games in the PGN.
+    """
+    processes = processes or os.cpu_count()
+    tasks = multiprocessing.Queue(processes * batches_per_worker)
+    results = multiprocessing.Queue(processes * batches_per_worker)
+    workers = [multiprocessing.Process(target=_work,
+                                       args=(analyse, tasks, results,
+                                             timer and timer.seconds),
+                                       daemon=True)
+               for _ in range(processes)]
+    for worker in workers:
+        worker.start()
+    threading.Thread(target=_read,
+                     args=(pgn_path, store, dedupe, batch_size, tasks,
+                           results),
+                     daemon=True).start()
+
+    per_game = []
+    finished = {}
+    pending = {}
+    reused = 0
+    total = None
+    next_batch = 0
+    progress = tqdm(unit=" games")
+    try:
+        while total is None or next_batch < total:
+            try:
+                message = results.get(timeout=1)
+            except queue.Empty:
+                if not all(worker.is_alive() for worker in workers):
+                    raise RuntimeError("A pipeline worker stopped")
+                continue
+            if message[0] == "done":
+                total = message[1]
+                continue
+            if message[0] == "error":
+                raise message[1]
+            n, ids, analysed, stored, times, timed_out = message
+            if timer:
+                timer.update(times, timed_out)
+            finished[n] = [stored[i] if i in stored else analysed[i]
+                           for i in ids if i in stored or i in analysed]
+            pending.update(analysed)
+            reused += len(stored)
+            progress.update(len(ids))
+            if store and len(pending) >= save_every:
+                store.save(pending)
+                pending = {}
+            # Batches come back in any order, but results are kept in the
+            # order of the games
+            while next_batch in finished:
+                for game_results in finished.pop(next_batch):
+                    per_game.append(game_results)
+                    if on_result:
+                        on_result(game_results)
+                next_batch += 1
+        for _ in workers:
+            tasks.put(None)
+        for worker in workers:
+            worker.join()
+    finally:
+        progress.close()
+        for worker in workers:
+            if worker.is_alive():
+                worker.terminate()
+        # Keep what was analysed before an error or interrupt
+        if store and pending:
+            store.save(pending)
+    if store:
+        print(f"Reused stored results for {reused} games")
+    return per_game
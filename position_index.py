@@ -0,0 +1,177 @@
+"""Corpus-wide position search.
+
+An inverted index from each position's Zobrist hash to the (game, ply)
+pairs where it occurred, so finding the games that reached a position is a
+binary search instead of a replay of every game. An index is a directory
+containing:
+
+- games.txt: the Lichess ID of each indexed game (or, for games without a
+  Lichess link, the hash from helpers.game_key()), one per line
+- postings-00000.npy, postings-00001.npy, ...: segments of (key, game, ply)
+  rows sorted by key, where game is a line number in games.txt
+
+Updating an index only reads games it doesn't have yet, and adds their
+postings as a new segment. Segments are memory-mapped when queried, and can
+be merged into one with compact().
+
+Usage: python main.py position-index PGN [PGN ...]
+       python main.py find-position FEN
+"""
+
+import glob
+import os
+
+import chess
+import chess.pgn
+import chess.polyglot
+import numpy as np
+
+import helpers
+
+default_index_path = "inputs/position_index"
+
+posting_dtype = np.dtype([
+    ("key", np.uint64),       # Zobrist hash of the position
+    ("game", np.uint32),      # line number in games.txt
+    ("ply", np.uint16),       # 0 for the starting position
+])
+
+
+def game_keys(headers_and_board) -> np.ndarray:
+    """Zobrist hash of every position in a game, by ply."""
+    _, final = headers_and_board
+    board = final.root()
+    keys = [chess.polyglot.zobrist_hash(board)]
+    for move in final.move_stack:
+        board.push(move)
+        keys.append(chess.polyglot.zobrist_hash(board))
+    return np.array(keys, dtype=np.uint64)
+
+
+def postings(keys_per_game: list, first_game: int) -> np.ndarray:
+    """Sorted postings for consecutive games numbered from first_game."""
+    rows = np.empty(sum(len(keys) for keys in keys_per_game),
+                    dtype=posting_dtype)
+    i = 0
+    for game, keys in enumerate(keys_per_game, start=first_game):
+        rows["key"][i:i + len(keys)] = keys
+        rows["game"][i:i + len(keys)] = game
+        rows["ply"][i:i + len(keys)] = np.arange(len(keys))
+        i += len(keys)
+    return rows[np.argsort(rows["key"], kind="stable")]
+
+
+class PositionIndex:
+    """Zobrist hash -> games (and plies) reaching the position."""
+
+    def __init__(self, path: str = default_index_path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self.games = []
+        games_path = os.path.join(path, "games.txt")
+        if os.path.exists(games_path):
+            with open(games_path) as f:
+                self.games = f.read().split()
+        self.segments = [np.load(segment, mmap_mode="r")
+                         for segment in self._segment_paths()]
+
+    def __len__(self):
+        return len(self.games)
+
+    def _segment_paths(self) -> list:
+        return sorted(glob.glob(os.path.join(self.path, "postings-*.npy")))
+
+    def _add_segment(self, rows: np.ndarray, game_ids: list):
+        """Save postings for new games, and list the games."""
+        number = len(self._segment_paths())
+        segment = os.path.join(self.path, f"postings-{number:05}.npy")
+        with open(f"{segment}.tmp", "wb") as f:
+            np.save(f, rows)
+        # If this is interrupted, the games are listed without postings
+        # (and so never found) rather than the other way round, which would
+        # mix up the numbering of later games
+        with open(os.path.join(self.path, "games.txt"), "a") as f:
+            f.writelines(f"{game_id}\n" for game_id in game_ids)
+        self.games.extend(game_ids)
+        os.replace(f"{segment}.tmp", segment)
+        self.segments.append(np.load(segment, mmap_mode="r"))
+
+    def update(self, pgn_paths: list, processes: int = None) -> int:
+        """ Add the games in some PGN files that aren't indexed yet.
+
+        :param pgn_paths: PGN files to index.
+        :param processes: worker processes. Default value: one per CPU.
+
+        :return: number of games added.
+        """
+        known = set(self.games)
+        added = 0
+        for pgn_path in pgn_paths:
+            # Games are identified as in helpers.game_key(), so copies of
+            # games already indexed (from this file or others) are skipped
+            offsets, _, keys = helpers.scan_games(pgn_path)
+            new = []
+            for offset, game_id in zip(offsets, keys):
+                if game_id not in known:
+                    known.add(game_id)
+                    new.append((offset, game_id))
+            if len(new) < len(offsets):
+                print(f"Skipping {len(offsets) - len(new)} games in "
+                      f"{pgn_path} that are already indexed")
+            if not new:
+                continue
+            keys = helpers.map_games(game_keys, pgn_path,
+                                     [offset for offset, _ in new],
+                                     visitor=helpers.HeadersAndFinalBoard,
+                                     processes=processes)
+            self._add_segment(postings(keys, len(self.games)),
+                              [game_id for _, game_id in new])
+            added += len(new)
+        return added
+
+    def compact(self):
+        """Merge all segments into one."""
+        if len(self.segments) < 2:
+            return
+        rows = np.concatenate(self.segments)
+        rows = rows[np.argsort(rows["key"], kind="stable")]
+        old = self._segment_paths()
+        self.segments = []
+        merged = os.path.join(self.path, "merged.tmp")
+        with open(merged, "wb") as f:
+            np.save(f, rows)
+        # Replace the first segment, then drop the others, so an interrupted
+        # compaction never loses postings
+        os.replace(merged, old[0])
+        for segment in old[1:]:
+            os.remove(segment)
+        self.segments = [np.load(old[0], mmap_mode="r")]
+
+    def lookup(self, board: chess.Board) -> list:
+        """[(game ID, ply)] for each time the board's position occurred."""
+        key = np.uint64(chess.polyglot.zobrist_hash(board))
+        found = []
+        for segment in self.segments:
+            keys = segment["key"]
+            start = np.searchsorted(keys, key, side="left")
+            end = np.searchsorted(keys, key, side="right")
+            found.extend((self.games[game], int(ply))
+                         for game, ply in zip(segment["game"][start:end],
+                                              segment["ply"][start:end]))
+        return sorted(found)
+
+    def count_games(self, board: chess.Board) -> int:
+        """Number of games in which the board's position occurred."""
+        return len({game for game, _ in self.lookup(board)})
+
+
+_indexes = {}
+
+
+def open_index(path: str = default_index_path):
+    """The index at path (opened once per process), or None if there isn't
+    one."""
+    if path not in _indexes:
+        _indexes[path] = PositionIndex(path) \
+            if os.path.exists(os.path.join(path, "games.txt")) else None
+    return _indexes[path]
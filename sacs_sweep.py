@@ -0,0 +1,298 @@
+"""Sweep detect_sacs's thresholds over a grid of settings.
+
+Each game is read once, and every sac in it (every capture passing
+detect_sacs.sacrificed_material(), at any ply a setting in the grid could
+check) is saved with what the thresholds are applied to: its ply, the eval
+and material balance before it, the tactic explaining it (if any) and the
+number of master games reaching it. Each setting in the grid is then just a
+filter over those features, so a sweep of 50 settings costs about as much as
+one detect_sacs run.
+
+The engine's only-non-losing check isn't part of the sweep: it's too slow to
+run on every sac, and doesn't depend on the thresholds.
+
+Usage: python main.py sacs-sweep --winning-eval-threshold 200 300 400 \
+           --material-adv-threshold 1 2 3
+"""
+
+import functools
+import itertools
+import os
+
+import chess
+import chess.pgn
+import pandas as pd
+
+import bitboards
+import detect_sacs
+import helpers
+import pipeline
+import sampling
+import store
+import theory
+
+task_label = "SacSweep"
+# Bump when game_features()'s logic changes, so stored features aren't reused
+result_version = 1
+
+parameters = ["material_adv_threshold", "winning_eval_threshold",
+              "opening_plies", "ending_plies", "max_ply", "theory_games"]
+# Every sac is at least two plies after the start (so there's an eval before
+# it) and six plies before the end (so its material can be followed)
+min_opening_plies = 2
+min_ending_plies = 6
+# Rejections the sweep can tell apart
+rejections = [kind for kind in detect_sacs.rejections
+              if kind != "only_nonlosing"]
+
+
+def default_config() -> dict:
+    """detect_sacs's current settings."""
+    return {parameter: getattr(detect_sacs, parameter)
+            for parameter in parameters}
+
+
+def grid_configs(grid: dict) -> list:
+    """ Every combination of the settings in a grid.
+
+    :param grid: {parameter: [values]}. Parameters left out keep their
+        default values (see default_config()).
+
+    :return: [config], with the default config first.
+    """
+    unknown = set(grid) - set(parameters)
+    if unknown:
+        raise ValueError(f"Unknown parameters: {', '.join(sorted(unknown))}")
+    default = default_config()
+    values = [grid.get(parameter) or [default[parameter]]
+              for parameter in parameters]
+    configs = [default]
+    for combination in itertools.product(*values):
+        config = dict(zip(parameters, combination))
+        if config["opening_plies"] < min_opening_plies:
+            raise ValueError(f"opening_plies must be at least "
+                             f"{min_opening_plies}")
+        if config["ending_plies"] < min_ending_plies:
+            raise ValueError(f"ending_plies must be at least "
+                             f"{min_ending_plies}")
+        if config not in configs:
+            configs.append(config)
+    return configs
+
+
+def game_features(game: chess.pgn.Game,
+                  theory_index: str = theory.default_index_path,
+                  online_theory: bool = True,
+                  opening_plies: int = min_opening_plies,
+                  max_ply: int = detect_sacs.max_ply) -> dict:
+    """ Every sac in a game, with the features detect_sacs's thresholds are
+    applied to.
+
+    :param game: the game to check.
+    :param theory_index: path to the local opening-theory index.
+    :param online_theory: whether to query the Lichess Masters explorer when
+        there is no local theory index.
+    :param opening_plies: only check moves after this many plies.
+    :param max_ply: only check moves before this ply.
+
+    :return: {"last_ply", "white", "black", "sacs": [sac features]}
+    """
+    board = game.board()
+    last_ply = game.end().ply()
+    white_diff = bitboards.material_diff(bitboards.game_bitboards(game),
+                                         chess.WHITE).tolist()
+    mat_diff = {1: white_diff, 0: [-diff for diff in white_diff]}
+
+    sacs = []
+    for i, n in enumerate(game.mainline(), start=1):
+        if n.ply() <= opening_plies:
+            board.push(n.move)
+            continue
+        if n.ply() > last_ply - min_ending_plies or n.ply() >= max_ply:
+            break
+
+        can = n.parent
+        precan = n.parent.parent
+        side = 0 if board.turn else 1
+        sacrificed = detect_sacs.sacrificed_material(board, n, mat_diff, i,
+                                                     side)
+        if sacrificed is None:
+            board.push(n.move)
+            continue
+
+        link = game.headers['Site'] + '#' + str(precan.ply() + 1)
+        tactic = detect_sacs.explaining_tactic(n)
+        movenum = ((precan.ply() - 1) // 2) + 1
+        sacs.append({
+            "ply": n.ply(),
+            "eval": can.eval().pov(side).score(mate_score=100000),
+            "material": mat_diff[side][i - 2],
+            "sacrificed": sacrificed,
+            "tactic": [tactic[0], game.headers['Site'] + '#' + str(tactic[1])]
+            if tactic else None,
+            # Only sacs not explained by a tactic get as far as the theory
+            # check
+            "masters": None if tactic
+            else theory.masters_games(board, theory_index, online_theory),
+            "link": link,
+            "move": f"{movenum}. {can.san()}" if side
+            else f"{movenum}...{can.san()}",
+            "uci": can.uci()})
+        board.push(n.move)
+
+    return {"last_ply": last_ply,
+            "white": game.headers['White'],
+            "black": game.headers['Black'],
+            "sacs": sacs}
+
+
+def apply_config(per_game: list, config: dict) -> dict:
+    """ The results detect_sacs would give with some settings (leaving out
+    the engine check), from each game's features.
+
+    :return: {"candidates": [candidate details], <rejection kind>: [links]}
+    """
+    results = {"candidates": [], **{kind: [] for kind in rejections}}
+    for features in per_game:
+        for sac in features["sacs"]:
+            if sac["ply"] <= config["opening_plies"] or \
+                    sac["ply"] > features["last_ply"] - config["ending_plies"] \
+                    or sac["ply"] >= config["max_ply"]:
+                continue
+            if abs(sac["eval"]) > config["winning_eval_threshold"] or \
+                    sac["material"] >= config["material_adv_threshold"]:
+                continue
+            if sac["tactic"]:
+                kind, link = sac["tactic"]
+                results[kind].append(link)
+            elif sac["masters"] >= config["theory_games"]:
+                results["theory"].append(sac["link"])
+            else:
+                results["candidates"].append({
+                    "link": sac["link"],
+                    "move": sac["move"],
+                    "uci": sac["uci"],
+                    "white": features["white"],
+                    "black": features["black"]})
+    return results
+
+
+def sweep(per_game: list, configs: list):
+    """ Apply each config to the games' features.
+
+    :param per_game: each game's features, from game_features().
+    :param configs: settings to try, the first of which the others are
+        compared with.
+
+    :return: (one summary row per config, one row per candidate added or
+        removed relative to the first config)
+    """
+    rows = []
+    diffs = []
+    baseline = None
+    for number, config in enumerate(configs):
+        results = apply_config(per_game, config)
+        links = {can["link"]: can for can in results["candidates"]}
+        if baseline is None:
+            baseline = links
+        added = [links[link] for link in links if link not in baseline]
+        removed = [baseline[link] for link in baseline if link not in links]
+        rows.append({"config": number, **config,
+                     "candidates": len(links),
+                     **{kind: len(results[kind]) for kind in rejections},
+                     "added": len(added),
+                     "removed": len(removed)})
+        diffs.extend({"config": number, "change": change,
+                      "link": can["link"], "move": can["move"]}
+                     for change, cans in [("added", added),
+                                          ("removed", removed)]
+                     for can in cans)
+    return rows, diffs
+
+
+def report(rows: list, diffs: list, checked: str):
+    """Print each config's candidate count, and save the sweep to a
+    spreadsheet."""
+    now_label = helpers.timestamp()
+    summary = pd.DataFrame(rows).set_index("config")
+    print('')
+    print(f"Finished checking {checked} games!")
+    print("Config 0 is detect_sacs's current settings")
+    print(summary[[*parameters, "candidates", "added", "removed"]]
+          .to_string())
+    output = f"outputs/{task_label}_{now_label}.xlsx"
+    with pd.ExcelWriter(output) as writer:
+        summary.to_excel(writer, sheet_name="SWEEP")
+        pd.DataFrame(diffs, columns=["config", "change", "link", "move"]) \
+            .to_excel(writer, sheet_name="DIFFS")
+    print(f"Saved results in {output}")
+    print('')
+    print('--- end ---')
+
+
+def run(pgn_path: str,
+        grid: dict,
+        sample_size: int = 0,
+        sample_ids: list = None,
+        theory_index: str = theory.default_index_path,
+        online_theory: bool = True,
+        store_path: str = store.default_store_path,
+        seed: int = None,
+        stratify_by: str = None,
+        processes: int = None):
+    """Sweep detect_sacs's settings over a grid (see grid_configs()), on (a
+    selection of) the games in a PGN file.
+
+    Each game's features are kept in the result store at store_path (unless
+    it's None), so later sweeps over the same games only need to apply the
+    new settings.
+    """
+    configs = grid_configs(grid)
+    # Features cover the widest windows possible (up to ply 200, unless the
+    # grid goes further), so they can be reused by later sweeps
+    max_ply = max(detect_sacs.max_ply,
+                  *(config["max_ply"] for config in configs))
+    whole_pgn = not (sample_size or sample_ids)
+    if whole_pgn:
+        print(f"Checking every game in {pgn_path} as it's read")
+        if processes is None and online_theory:
+            # Each worker queries the explorer, so stay as polite as a
+            # single process unless told otherwise
+            processes = 1
+    else:
+        offsets, keys, total = sampling.sample_games(
+            pgn_path, sample_size, sample_ids, seed, stratify_by)
+        print(f"About to check {len(offsets)} games (from {total} games in "
+              f"the input PGN)")
+    print(f"Trying {len(configs)} settings")
+    print('')
+
+    config = {"version": result_version,
+              "detect_sacs_version": detect_sacs.result_version,
+              "theory_index": theory_index,
+              "theory_index_modified": os.path.getmtime(theory_index)
+              if os.path.exists(theory_index) else None,
+              "online_theory": online_theory,
+              "max_ply": max_ply}
+    results_store = store.ResultStore(store_path, "sacs_features", config) \
+        if store_path else None
+
+    analyse = functools.partial(game_features, theory_index=theory_index,
+                                online_theory=online_theory,
+                                max_ply=max_ply)
+    if whole_pgn:
+        per_game = pipeline.analyse_pgn(analyse, pgn_path, results_store,
+                                        processes)
+        checked = f"{len(per_game)}"
+    else:
+        per_game = helpers.analyse_games(analyse, pgn_path, offsets,
+                                         keys, results_store)
+        checked = f"{len(offsets)} / {total}"
+    rows, diffs = sweep(per_game, configs)
+    report(rows, diffs, checked)
+
+
+if __name__ == '__main__':
+    import sys
+    import main
+    main.main(["sacs-sweep"] + sys.argv[1:])
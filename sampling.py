@@ -0,0 +1,210 @@
+"""Picking games from a PGN in a single pass over its headers.
+
+Random samples are drawn with reservoir sampling, so only the sampled games'
+offsets are ever held in memory, however big the PGN. Stratified samples
+keep a reservoir per stratum (e.g. per rating band) and then take the same
+number of games from each, so small strata aren't drowned out by big ones.
+Samples are reproducible given a seed.
+"""
+
+import random
+import re
+
+import helpers
+
+rating_band_width = 200
+
+
+def rating_band(headers) -> str:
+    """Band of the players' average rating, e.g. "1800-1999"."""
+    try:
+        rating = (int(headers["WhiteElo"]) + int(headers["BlackElo"])) / 2
+    except (KeyError, ValueError):
+        return "unrated"
+    low = int(rating // rating_band_width * rating_band_width)
+    return f"{low}-{low + rating_band_width - 1}"
+
+
+def time_control(headers) -> str:
+    """Lichess speed category, from the estimated game duration (initial
+    time + 40 increments)."""
+    try:
+        initial, increment = headers["TimeControl"].split("+")
+        duration = int(initial) + 40 * int(increment)
+    except (KeyError, ValueError):
+        return "correspondence"
+    for limit, speed in [(30, "ultrabullet"), (180, "bullet"),
+                         (480, "blitz"), (1500, "rapid")]:
+        if duration < limit:
+            return speed
+    return "classical"
+
+
+def season(headers) -> str:
+    """League season named in the Event header (e.g. "Season 21"), or else
+    the year the game was played."""
+    found = re.search(r"season\s*(\d+)", headers.get("Event", ""), re.I)
+    if found:
+        return f"Season {found.group(1)}"
+    return headers.get("UTCDate", headers.get("Date", "????"))[:4]
+
+
+strata = {"rating": rating_band, "time-control": time_control,
+          "season": season}
+
+
+class Reservoir:
+    """Uniform random sample of up to size items from a stream of unknown
+    length (Algorithm R)."""
+
+    def __init__(self, size: int, rng: random.Random):
+        self.size = size
+        self.rng = rng
+        self.seen = 0
+        self.items = []
+
+    def add(self, item):
+        self.seen += 1
+        if len(self.items) < self.size:
+            self.items.append(item)
+        else:
+            i = self.rng.randrange(self.seen)
+            if i < self.size:
+                self.items[i] = item
+
+
+def allocate(sizes: dict, total: int) -> dict:
+    """ Split total as evenly as possible between strata, giving strata too
+    small for an even share all their items.
+
+    :param sizes: number of items available in each stratum.
+    :param total: number of items to take.
+
+    :return: number of items to take from each stratum.
+    """
+    shares = {}
+    left = dict(sizes)
+    while left and total > 0:
+        share = total // len(left)
+        if not share:
+            # Fewer items than strata: one each from the biggest
+            for stratum in sorted(left, key=lambda s: (-left[s], s))[:total]:
+                shares[stratum] = 1
+            return shares
+        small = {stratum: size for stratum, size in left.items()
+                 if size <= share}
+        if not small:
+            # Everyone gets an even share, with the remainder going to the
+            # biggest strata
+            biggest = sorted(left, key=lambda s: (-left[s], s))
+            for i, stratum in enumerate(biggest):
+                shares[stratum] = share + (i < total - share * len(left))
+            return shares
+        for stratum, size in small.items():
+            shares[stratum] = size
+            total -= size
+            del left[stratum]
+    return shares
+
+
+def _headers(pgn_path, full: bool = False):
+    """ Offset, headers and key of each game in a PGN file or corpus.
+
+    :param full: read every header. Otherwise a corpus's games come from its
+        cached scan (see corpus.Corpus.scan()), with only their Site header.
+    """
+    if isinstance(pgn_path, str):
+        yield from helpers.iter_headers(pgn_path)
+        return
+    if not full:
+        scans = pgn_path.scan()
+        for path in pgn_path.files:
+            for offset, link, key in zip(*scans[path]):
+                yield (path, offset), {"Site": link}, key
+        return
+    for path in pgn_path.files:
+        for offset, headers, key in helpers.iter_headers(path):
+            yield (path, offset), headers, key
+
+
+def sample_games(pgn_path: str,
+                 sample_size: int = 0,
+                 sample_ids: list = None,
+                 seed: int = None,
+                 stratify_by: str = None,
+                 dedupe: bool = True):
+    """ Pick the games to check from a PGN file, in one pass over its
+    headers.
+
+    :param pgn_path: path to the PGN file, or a corpus.Corpus.
+    :param sample_size: number of games to sample at random (0 for all).
+    :param sample_ids: Lichess game IDs (or, for games without a Lichess
+        link, keys from helpers.game_key()) to select instead.
+    :param seed: seed for the random sample, to make it reproducible.
+    :param stratify_by: take the same number of games from each stratum, as
+        given by one of the functions in strata.
+    :param dedupe: leave out copies of games seen earlier in the file (which
+        needs each game's key kept in memory).
+
+    :return: selected offsets (see helpers.file_runs()) and keys (see
+        helpers.game_key()), in file order, and the total number of games in
+        the PGN.
+    """
+    rng = random.Random(seed)
+    stratum = strata[stratify_by] if stratify_by else None
+    wanted = set(sample_ids or [])
+    reservoirs = {}
+    selected = []
+    seen = set()
+    total = 0
+    skipped = 0
+    if sample_ids:
+        print("Sampling games by specific game ID...")
+    elif sample_size:
+        print(f"Sampling {sample_size} games" +
+              (f" evenly by {stratify_by}..." if stratify_by else "..."))
+
+    for i, (offset, headers, key) in enumerate(
+            _headers(pgn_path, full=bool(stratify_by))):
+        if dedupe:
+            if key in seen:
+                skipped += 1
+                continue
+            seen.add(key)
+        total += 1
+        game = (i, offset, key, headers.get("Site", ""))
+        if sample_ids:
+            if key in wanted or helpers.game_id(game[3]) in wanted:
+                selected.append(game)
+        elif sample_size:
+            name = stratum(headers) if stratum else ""
+            if name not in reservoirs:
+                reservoirs[name] = Reservoir(sample_size, rng)
+            reservoirs[name].add(game)
+        else:
+            selected.append(game)
+
+    if skipped:
+        print(f"Skipping {skipped} duplicate games in {pgn_path}")
+    if sample_ids:
+        missing = wanted - {helpers.game_id(link)
+                            for _, _, _, link in selected} \
+            - {key for _, _, key, _ in selected}
+        if missing:
+            print(f"Couldn't find {len(missing)} of the games: "
+                  f"{sorted(missing)}")
+    elif sample_size:
+        shares = allocate({name: len(reservoir.items)
+                           for name, reservoir in reservoirs.items()},
+                          sample_size)
+        for name in sorted(shares):
+            # A random subset of a uniform sample is a uniform sample
+            selected.extend(rng.sample(reservoirs[name].items, shares[name]))
+            if stratify_by:
+                print(f"  {name}: {shares[name]} of "
+                      f"{reservoirs[name].seen} games")
+    if sample_ids or sample_size:
+        print("")
+    selected.sort()
+    return [offset for _, offset, _, _ in selected], \
+        [key for _, _, key, _ in selected], total
@@ -0,0 +1,212 @@
+"""Sharded runs over several machines.
+
+A PGN is split into byte ranges that start and end on game boundaries. The
+plan and one task file per shard go in a queue directory on a filesystem all
+the nodes share:
+
+    plan.json       input PGN, detector and its options
+    todo/           shards nobody has started
+    claimed/        shards being analysed
+    done/           each finished shard's per-game results
+
+Each node claims shards by renaming them from todo/ to claimed/ (an atomic
+operation, so no shard is analysed twice) and writes their results to done/.
+The merge step concatenates the results in shard order, which is the order
+of the games in the PGN, so the detector's report is the same as for a run
+on one machine.
+"""
+
+import functools
+import importlib
+import json
+import os
+
+import chess.pgn
+
+import helpers
+
+# Detectors that can run sharded, and the modules providing their
+# analyse_game() and report()
+detectors = {"sacs": "detect_sacs",
+             "greek-gifts": "detect_greek_gifts",
+             "mates": "detect_mates"}
+
+
+def next_game_start(pgn, pos: int) -> int:
+    """ Offset of the first game starting at or after pos in a PGN opened in
+    binary mode (or the file size if there is none).
+
+    A game starts with a header line following a blank line (or at the start
+    of the file).
+    """
+    if pos <= 0:
+        return 0
+    pgn.seek(max(pos - 2, 0))
+    before = pgn.read(pos - max(pos - 2, 0))
+    if before.endswith(b"\n"):
+        prev_blank = before == b"\n\n" or pos == 1
+    else:
+        # Skip the rest of a line we landed in the middle of
+        pgn.readline()
+        prev_blank = False
+    while True:
+        offset = pgn.tell()
+        line = pgn.readline()
+        if not line:
+            return offset
+        if line.startswith(b"[") and prev_blank:
+            return offset
+        prev_blank = not line.strip()
+
+
+def shard_ranges(pgn_path: str, shards: int) -> list:
+    """Split a PGN into (about) equal byte ranges, [(start, end), ...], that
+    start and end on game boundaries. Ranges may be empty."""
+    size = os.path.getsize(pgn_path)
+    with open(pgn_path, "rb") as pgn:
+        bounds = [next_game_start(pgn, size * i // shards)
+                  for i in range(shards)] + [size]
+    return list(zip(bounds, bounds[1:]))
+
+
+def analyse_shard(analyse,
+                  pgn_path: str,
+                  start: int,
+                  end: int,
+                  skip: list = ()) -> list:
+    """Run a per-game detector over the games starting in [start, end),
+    except those starting at the offsets in skip."""
+    results = []
+    skip = set(skip)
+    with helpers.read_pgn(pgn_path) as pgn:
+        pgn.seek(start)
+        while pgn.tell() < end:
+            if pgn.tell() in skip:
+                chess.pgn.skip_game(pgn)
+                continue
+            game = chess.pgn.read_game(pgn)
+            if game is None:
+                break
+            results.append(analyse(game))
+    return results
+
+
+def _task_name(index: int) -> str:
+    return f"{index:05}.json"
+
+
+def _dump(obj, path: str):
+    """Write JSON so that readers never see a half-written file."""
+    with open(f"{path}.tmp", "w") as f:
+        json.dump(obj, f)
+    os.replace(f"{path}.tmp", path)
+
+
+def plan(queue_dir: str,
+         pgn_path: str,
+         shards: int,
+         detector: str = "sacs",
+         options: dict = None):
+    """ Set up a queue directory for a sharded run.
+
+    :param queue_dir: directory shared by all nodes.
+    :param pgn_path: input PGN, at a path all nodes can read.
+    :param shards: number of shards. Use several per node, so fast nodes
+        can pick up the slack.
+    :param detector: one of detectors.
+    :param options: keyword arguments for the detector's analyse_game().
+    """
+    for sub in ["todo", "claimed", "done"]:
+        os.makedirs(os.path.join(queue_dir, sub), exist_ok=True)
+    ranges = shard_ranges(pgn_path, shards)
+    # Copies of earlier games are skipped, as in a run on one machine
+    offsets, _, keys = helpers.scan_games(pgn_path)
+    duplicates = [offsets[i] for i in helpers.duplicates(keys)]
+    if duplicates:
+        print(f"Skipping {len(duplicates)} duplicate games in {pgn_path}")
+    _dump({"pgn": pgn_path, "detector": detector, "options": options or {},
+           "shards": len(ranges)}, os.path.join(queue_dir, "plan.json"))
+    for index, (start, end) in enumerate(ranges):
+        _dump({"index": index, "start": start, "end": end,
+               "skip": [offset for offset in duplicates
+                        if start <= offset < end]},
+              os.path.join(queue_dir, "todo", _task_name(index)))
+
+
+def load_plan(queue_dir: str) -> dict:
+    with open(os.path.join(queue_dir, "plan.json")) as f:
+        return json.load(f)
+
+
+def claim(queue_dir: str):
+    """Take the next shard from todo/, or None if there are none left."""
+    for name in sorted(os.listdir(os.path.join(queue_dir, "todo"))):
+        if not name.endswith(".json"):
+            continue
+        claimed = os.path.join(queue_dir, "claimed", name)
+        try:
+            os.rename(os.path.join(queue_dir, "todo", name), claimed)
+        except FileNotFoundError:
+            # Another node got there first
+            continue
+        with open(claimed) as f:
+            return json.load(f)
+    return None
+
+
+def work(queue_dir: str) -> int:
+    """Analyse shards from a queue directory until none are left, and return
+    how many this node did."""
+    details = load_plan(queue_dir)
+    module = importlib.import_module(detectors[details["detector"]])
+    analyse = functools.partial(module.analyse_game, **details["options"])
+    count = 0
+    while True:
+        task = claim(queue_dir)
+        if task is None:
+            return count
+        name = _task_name(task["index"])
+        print(f"Analysing shard {task['index'] + 1} / {details['shards']}")
+        results = analyse_shard(analyse, details["pgn"], task["start"],
+                                task["end"], task["skip"])
+        _dump({**task, "results": results},
+              os.path.join(queue_dir, "done", name))
+        os.remove(os.path.join(queue_dir, "claimed", name))
+        count += 1
+
+
+def requeue(queue_dir: str) -> int:
+    """Put shards claimed by nodes that stopped before finishing them back in
+    todo/, and return how many there were. Only use this when no nodes are
+    running."""
+    names = os.listdir(os.path.join(queue_dir, "claimed"))
+    for name in names:
+        os.rename(os.path.join(queue_dir, "claimed", name),
+                  os.path.join(queue_dir, "todo", name))
+    return len(names)
+
+
+def merged_results(queue_dir: str) -> list:
+    """Each game's results, in PGN order, from a finished sharded run."""
+    details = load_plan(queue_dir)
+    missing = [index for index in range(details["shards"])
+               if not os.path.exists(os.path.join(queue_dir, "done",
+                                                  _task_name(index)))]
+    if missing:
+        raise RuntimeError(f"{len(missing)} shard(s) aren't finished yet: "
+                           f"{missing}")
+    per_game = []
+    for index in range(details["shards"]):
+        with open(os.path.join(queue_dir, "done", _task_name(index))) as f:
+            per_game.extend(json.load(f)["results"])
+    return per_game
+
+
+def merge(queue_dir: str, **report_options):
+    """Report the results of a finished sharded run, as the detector does
+    for a run on one machine."""
+    details = load_plan(queue_dir)
+    module = importlib.import_module(detectors[details["detector"]])
+    per_game = merged_results(queue_dir)
+    module.report(per_game, f"{len(per_game)} / {len(per_game)}",
+                  **report_options)
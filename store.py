@@ -0,0 +1,71 @@
+"""Persistent per-game result store.
+
+Results are kept in a SQLite database, keyed by Lichess game ID, detector
+name and a hash of the detector's configuration. Later runs only analyse
+games whose ID is new or whose configuration changed, and reuse the stored
+results for the rest.
+"""
+
+import copy
+import hashlib
+import json
+import os
+import sqlite3
+
+default_store_path = "outputs/results.sqlite"
+
+
+def config_hash(config: dict) -> str:
+    """Short, stable hash of a detector's configuration."""
+    text = json.dumps(config, sort_keys=True, default=str)
+    return hashlib.sha1(text.encode()).hexdigest()[:16]
+
+
+class ResultStore:
+    """Stored results for one detector and configuration."""
+
+    def __init__(self, path: str, detector: str, config: dict):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.detector = detector
+        self.config = config_hash(config)
+        self.db = sqlite3.connect(path)
+        self.db.execute("CREATE TABLE IF NOT EXISTS results ("
+                        "game_id TEXT, detector TEXT, config TEXT, "
+                        "result TEXT, "
+                        "PRIMARY KEY (game_id, detector, config))")
+
+    def load(self, game_ids: list) -> dict:
+        """Stored results for whichever of these games have them."""
+        found = {}
+        game_ids = list(game_ids)
+        # Stay well under SQLite's limit on query parameters
+        for i in range(0, len(game_ids), 500):
+            batch = game_ids[i:i + 500]
+            rows = self.db.execute(
+                "SELECT game_id, result FROM results "
+                "WHERE detector = ? AND config = ? "
+                f"AND game_id IN ({', '.join('?' * len(batch))})",
+                [self.detector, self.config, *batch])
+            found.update((game_id, json.loads(result))
+                         for game_id, result in rows)
+        return found
+
+    def save(self, results: dict):
+        """Store results, given as {game ID: result}."""
+        self.db.executemany(
+            "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)",
+            [(game_id, self.detector, self.config, json.dumps(result))
+             for game_id, result in results.items()])
+        self.db.commit()
+
+    def reopen(self):
+        """The same store on a new connection, for use from another
+        thread."""
+        other = copy.copy(self)
+        other.db = sqlite3.connect(self.path)
+        return other
+
+    def close(self):
+        self.db.close()
@@ -0,0 +1,109 @@
+"""Corpus-wide tactics statistics.
+
+Tags every mainline ply of every game with the tactics in utils (forks,
+skewers, captures of trapped pieces and captures of absolutely pinned
+pieces), then counts them per game and per player. The full predicates are
+slow, so each ply first goes through cheap bitboard gates: only captures
+reach the capture-based checks, and only moves that attack two or more
+pieces (checks included) reach the fork check.
+"""
+
+import chess
+import chess.pgn
+import pandas as pd
+
+import helpers
+import utils
+
+tags = ["fork", "skewer", "trapped", "pinned"]
+colors = {chess.WHITE: "white", chess.BLACK: "black"}
+
+
+def ply_tags(node: utils.CachedBoardNode,
+             board: chess.Board,
+             capture: bool) -> list:
+    """Tactics completed by the move leading to a node.
+
+    :param node: the node after the move.
+    :param board: the position after the move.
+    :param capture: whether the move was a capture.
+    """
+    found = []
+    mover = not board.turn
+    attacked = board.attacks_mask(node.move.to_square) & board.occupied_co[
+        not mover]
+    if chess.popcount(attacked & ~board.pawns) >= 2 and utils.fork(node):
+        found.append("fork")
+    if capture and isinstance(node.parent, chess.pgn.ChildNode):
+        if utils.skewer(node):
+            found.append("skewer")
+        if utils.trapped_piece(node):
+            found.append("trapped")
+        if utils.captured_piece_was_abs_pinned(node):
+            found.append("pinned")
+    return found
+
+
+def game_tactics(headers_and_board) -> dict:
+    """Count the tactics played by each side in a game.
+
+    :param headers_and_board: a game's headers and final board, with the
+        mainline on its move stack.
+    """
+    headers, final = headers_and_board
+    counts = {"link": headers.get("Site"),
+              "white": headers.get("White"),
+              "black": headers.get("Black"),
+              "plies": len(final.move_stack),
+              "tagged": []}
+    counts.update({f"{color}_{tag}": 0
+                   for color in colors.values() for tag in tags})
+
+    board = final.root()
+    for node in utils.cached_mainline(final):
+        capture = board.is_capture(node.move)
+        board.push(node.move)
+        for tag in ply_tags(node, board, capture):
+            counts[f"{colors[not board.turn]}_{tag}"] += 1
+            counts["tagged"].append(f"{board.ply()}:{tag}")
+    counts["tagged"] = " ".join(counts["tagged"])
+    return counts
+
+
+def player_table(games: pd.DataFrame) -> pd.DataFrame:
+    """Sum each player's tactics over the games they played, as either
+    colour."""
+    sides = []
+    for color in colors.values():
+        side = games[[color] + [f"{color}_{tag}" for tag in tags]]
+        sides.append(side.set_axis(["player"] + tags, axis=1))
+    players = pd.concat(sides).groupby("player")
+    table = players.sum()
+    table.insert(0, "games", players.size())
+    return table.sort_values("games", ascending=False).reset_index()
+
+
+def tactics_stats(pgn_path: str, processes: int = None):
+    """Tactics counts per game and per player for a PGN file."""
+    offsets, _ = helpers.game_offsets(pgn_path)
+    games = pd.DataFrame(helpers.map_games(
+        game_tactics, pgn_path, offsets,
+        visitor=helpers.HeadersAndFinalBoard, processes=processes))
+    return games, player_table(games)
+
+
+def run(pgn_path: str, processes: int = None):
+    """Report tactics statistics for a PGN file."""
+    task_label = "TacticsStats"
+    now_label = helpers.timestamp()
+
+    games, players = tactics_stats(pgn_path, processes)
+    for tag in tags:
+        total = games[f"white_{tag}"].sum() + games[f"black_{tag}"].sum()
+        print(f"{total} {tag} tag(s) in {len(games)} games")
+
+    # CSV rather than a spreadsheet, since there's a row per game
+    games.to_csv(f"outputs/{task_label}_{now_label}_games.csv", index=False)
+    players.to_csv(f"outputs/{task_label}_{now_label}_players.csv",
+                   index=False)
+    print(f"Saved results in outputs/{task_label}_{now_label}_*.csv")
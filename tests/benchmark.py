@@ -0,0 +1,169 @@
+"""End-to-end benchmark of detect_sacs against the fake engine and stub
+explorer, so changes to engine handling, caching and concurrency can be
+measured on any machine.
+
+Usage (from the repository root):
+    python tests/benchmark.py --games 200 --engine-latency 0.005 \
+        --explorer-latency 0.02 --error-rate 0.01 --rate-limit-every 100
+    python tests/benchmark.py --games 200 --async-verify --max-engines 4
+    python tests/benchmark.py --games 200 --game-time 2 --candidate-time 0.5
+
+Games are random but seeded, with every position evaluated as level, so
+plenty of captures get as far as the theory and engine checks. Prints
+throughput and per-game latency percentiles.
+"""
+
+import argparse
+import functools
+import io
+import os
+import random
+import sys
+import time
+
+import chess
+import chess.pgn
+import numpy as np
+
+tests_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(tests_dir))
+
+import detect_sacs  # noqa: E402
+import helpers  # noqa: E402
+import memo  # noqa: E402
+import stub_explorer  # noqa: E402
+import verify  # noqa: E402
+
+
+def random_games(n: int, plies: int = 80, seed: int = 0) -> list:
+    """Seeded random games, with a level eval after every move."""
+    rng = random.Random(seed)
+    games = []
+    for i in range(n):
+        game = chess.pgn.Game()
+        game.headers["Site"] = f"https://lichess.org/{i:08}"
+        game.headers["White"] = f"white{i % 10}"
+        game.headers["Black"] = f"black{i % 7}"
+        node = game
+        board = game.board()
+        for _ in range(plies):
+            moves = list(board.legal_moves)
+            if not moves:
+                break
+            # Prefer captures, so there's material changing hands
+            captures = [m for m in moves if board.is_capture(m)]
+            move = rng.choice(captures if captures and rng.random() < 0.5
+                              else moves)
+            board.push(move)
+            node = node.add_variation(move)
+            node.set_eval(chess.engine.PovScore(chess.engine.Cp(0),
+                                                chess.WHITE))
+        # Round-trip through PGN text, as the detectors normally read games
+        games.append(chess.pgn.read_game(io.StringIO(str(game))))
+    return games
+
+
+def percentiles(latencies: list) -> str:
+    p50, p90, p99 = np.percentile(latencies, [50, 90, 99])
+    return (f"p50 {p50 * 1000:.0f}ms, p90 {p90 * 1000:.0f}ms, "
+            f"p99 {p99 * 1000:.0f}ms, max {max(latencies) * 1000:.0f}ms")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--games", type=int, default=50)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--engine-latency", type=float, default=0.005,
+                        help="fake engine's seconds per depth")
+    parser.add_argument("--engine-depth", type=int, default=20)
+    parser.add_argument("--explorer-latency", type=float, default=0.02)
+    parser.add_argument("--error-rate", type=float, default=0.0,
+                        help="share of explorer requests failing with a 500")
+    parser.add_argument("--rate-limit-every", type=int, default=0,
+                        help="answer every Nth explorer request with a 429")
+    parser.add_argument("--pause-429", type=float, default=0.1,
+                        help="seconds to wait after a 429")
+    parser.add_argument("--adaptive-engine", action="store_true",
+                        help="use the deferred, adaptive engine check")
+    parser.add_argument("--engine-budget", type=float)
+    parser.add_argument("--async-verify", action="store_true",
+                        help="run the theory and engine checks on the "
+                             "asynchronous verifier")
+    parser.add_argument("--max-requests", type=int,
+                        default=verify.default_max_requests)
+    parser.add_argument("--max-engines", type=int,
+                        default=verify.default_max_engines)
+    parser.add_argument("--game-time", type=float,
+                        help="seconds allowed per game")
+    parser.add_argument("--candidate-time", type=float,
+                        help="seconds allowed per candidate's theory and "
+                             "engine checks")
+    args = parser.parse_args(argv)
+
+    games = random_games(args.games, seed=args.seed)
+    engine = [sys.executable, os.path.join(tests_dir, "fake_uci.py"),
+              "--latency", str(args.engine_latency),
+              "--depth", str(args.engine_depth)]
+    server = stub_explorer.start(latency=args.explorer_latency,
+                                 error_rate=args.error_rate,
+                                 rate_limit_every=args.rate_limit_every,
+                                 seed=args.seed)
+    helpers.explorer_url = server.url
+    helpers.explorer_pause = 0.0
+    helpers.explorer_pause_429 = args.pause_429
+    adaptive = args.adaptive_engine or args.engine_budget is not None
+    budget = helpers.EngineBudget(args.engine_budget)
+    theory_index = os.path.join(tests_dir, "no-index.npz")
+    verifier = verify.Verifier(theory_index, True, engine, args.max_requests,
+                               args.max_engines, budget=budget).start() \
+        if args.async_verify else None
+
+    latencies = []
+    per_game = []
+    failed = 0
+    timer = helpers.GameTimer(args.game_time)
+    analyse = functools.partial(
+        detect_sacs.analyse_game, theory_index=theory_index,
+        online_theory=True, engine_path=engine, defer_engine_check=adaptive,
+        defer_theory_check=args.async_verify,
+        candidate_time=args.candidate_time)
+    start = time.perf_counter()
+    for game in games:
+        game_start = time.perf_counter()
+        try:
+            results = timer.run(analyse, game)
+        except Exception:
+            failed += 1
+        else:
+            if results is not None:
+                per_game.append(results)
+                if verifier:
+                    verifier.submit(results)
+        latencies.append(time.perf_counter() - game_start)
+    if verifier:
+        per_game = verifier.finish(per_game)
+        print(verifier.report())
+        print(budget.report())
+    elif adaptive:
+        per_game = detect_sacs.engine_check_candidates(per_game, engine,
+                                                       budget)
+        print(budget.report())
+    elapsed = time.perf_counter() - start
+    server.stop()
+
+    results = helpers.merge_results(per_game,
+                                    ["candidates", *detect_sacs.rejections])
+    print(f"{len(games)} games in {elapsed:.2f}s "
+          f"({len(games) / elapsed:.1f} games/s), {failed} failed")
+    print(f"Per-game latency: {percentiles(latencies)}")
+    print(timer.report())
+    print(f"{len(results['candidates'])} candidates; rejected: " +
+          ", ".join(f"{len(results[kind])} {kind}"
+                    for kind in detect_sacs.rejections))
+    print(f"Explorer: {server.requests} requests, {server.rate_limited} "
+          f"429s, {server.errors} errors")
+    print(memo.cache.report())
+
+
+if __name__ == '__main__':
+    main()
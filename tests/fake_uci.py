@@ -0,0 +1,133 @@
+"""Deterministic fake UCI engine, for tests and benchmarks.
+
+Run it as an engine with e.g.
+    chess.engine.SimpleEngine.popen_uci(
+        [sys.executable, "tests/fake_uci.py", "--latency", "0.01"])
+
+Moves are scored from a hash of the position and move (or from a JSON file
+of {FEN: {UCI move: centipawns}}, from the point of view of the side to
+move), so the same position always gets the same evals. Each depth takes
+--latency seconds, and --fail-every N makes every Nth search crash the
+engine, so callers' timing and error handling can be exercised without a
+real engine.
+"""
+
+import argparse
+import json
+import sys
+import threading
+import time
+import zlib
+
+import chess
+
+
+def move_score(board: chess.Board, move: chess.Move, scores: dict) -> int:
+    fen = board.fen()
+    if fen in scores and move.uci() in scores[fen]:
+        return scores[fen][move.uci()]
+    if fen in scores:
+        return -1000
+    return zlib.crc32(f"{fen} {move.uci()}".encode()) % 601 - 300
+
+
+def search(board, multipv, max_depth, movetime, searchmoves, latency, scores,
+           stop, out):
+    moves = searchmoves or list(board.legal_moves)
+    ranked = sorted(moves, key=lambda m: (-move_score(board, m, scores),
+                                          m.uci()))[:multipv]
+    start = time.perf_counter()
+    for depth in range(1, max_depth + 1):
+        if stop.wait(latency) and depth > 1:
+            break
+        for i, move in enumerate(ranked):
+            out(f"info depth {depth} seldepth {depth} multipv {i + 1} "
+                f"score cp {move_score(board, move, scores)} nodes "
+                f"{depth * 1000} pv {move.uci()}")
+        if movetime is not None and time.perf_counter() - start >= movetime:
+            break
+    out(f"bestmove {ranked[0].uci()}" if ranked else "bestmove (none)")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="seconds per depth")
+    parser.add_argument("--depth", type=int, default=20,
+                        help="max depth of a search without a depth limit")
+    parser.add_argument("--scores", help="JSON file of scripted scores")
+    parser.add_argument("--fail-every", type=int, default=0,
+                        help="crash on every Nth search")
+    args = parser.parse_args(argv)
+    scores = {}
+    if args.scores:
+        with open(args.scores) as f:
+            scores = json.load(f)
+
+    lock = threading.Lock()
+
+    def out(line):
+        with lock:
+            sys.stdout.write(line + "\n")
+            sys.stdout.flush()
+
+    board = chess.Board()
+    multipv = 1
+    searches = 0
+    stop = threading.Event()
+    thread = None
+    for line in sys.stdin:
+        tokens = line.split()
+        if not tokens:
+            continue
+        command = tokens[0]
+        if command == "uci":
+            out("id name FakeUCI")
+            out("option name MultiPV type spin default 1 min 1 max 500")
+            out("option name Hash type spin default 16 min 1 max 1024")
+            out("uciok")
+        elif command == "isready":
+            out("readyok")
+        elif command == "setoption" and "MultiPV" in tokens:
+            multipv = int(tokens[-1])
+        elif command == "position":
+            if tokens[1] == "startpos":
+                board = chess.Board()
+                rest = tokens[2:]
+            else:
+                end = tokens.index("moves") if "moves" in tokens \
+                    else len(tokens)
+                board = chess.Board(" ".join(tokens[2:end]))
+                rest = tokens[end:]
+            for uci in rest[1:]:
+                board.push_uci(uci)
+        elif command == "go":
+            searches += 1
+            if args.fail_every and searches % args.fail_every == 0:
+                sys.exit(1)
+            depth, movetime, searchmoves = args.depth, None, []
+            for i, token in enumerate(tokens):
+                if token == "depth":
+                    depth = int(tokens[i + 1])
+                elif token == "movetime":
+                    movetime = int(tokens[i + 1]) / 1000
+                elif token == "searchmoves":
+                    searchmoves = [chess.Move.from_uci(uci)
+                                   for uci in tokens[i + 1:]]
+            stop = threading.Event()
+            thread = threading.Thread(
+                target=search, args=(board.copy(), multipv, depth, movetime,
+                                     searchmoves, args.latency, scores, stop,
+                                     out))
+            thread.start()
+        elif command == "stop":
+            stop.set()
+        elif command == "quit":
+            stop.set()
+            break
+    if thread:
+        thread.join()
+
+
+if __name__ == '__main__':
+    main()
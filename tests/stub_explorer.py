@@ -0,0 +1,113 @@
+"""Local stand-in for the Lichess Masters explorer, for tests and benchmarks.
+
+    server = stub_explorer.start(latency=0.02, error_rate=0.05,
+                                 rate_limit_every=50)
+    helpers.explorer_url = server.url
+    ...
+    server.stop()
+
+Game counts come from a dict of {FEN: count}, or from a hash of the FEN, so
+they're the same on every run. Errors are injected with a seeded random
+number generator, and every rate_limit_every-th request gets a 429.
+"""
+
+import argparse
+import http.server
+import json
+import random
+import sys
+import threading
+import time
+import zlib
+from urllib.parse import parse_qs, urlparse
+
+
+class StubExplorer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, counts=None, latency=0.0, error_rate=0.0,
+                 rate_limit_every=0, seed=0):
+        super().__init__(address, ExplorerHandler)
+        self.counts = counts or {}
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rate_limit_every = rate_limit_every
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.errors = 0
+        self.rate_limited = 0
+        self.url = f"http://{self.server_address[0]}:{self.server_port}/master"
+
+    def count(self, fen: str) -> int:
+        if fen in self.counts:
+            return self.counts[fen]
+        return zlib.crc32(fen.encode()) % 5
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def handle_error(self, request, client_address):
+        # Clients that time out or give up close the connection mid-reply
+        if not isinstance(sys.exc_info()[1],
+                          (BrokenPipeError, ConnectionResetError)):
+            super().handle_error(request, client_address)
+
+
+class ExplorerHandler(http.server.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.requests += 1
+            rate_limited = server.rate_limit_every and \
+                server.requests % server.rate_limit_every == 0
+            error = not rate_limited and \
+                server.random.random() < server.error_rate
+            server.rate_limited += bool(rate_limited)
+            server.errors += bool(error)
+        time.sleep(server.latency)
+        if rate_limited or error:
+            self.send_response(429 if rate_limited else 500)
+            self.end_headers()
+            return
+        fen = parse_qs(urlparse(self.path).query).get("fen", [""])[0]
+        count = server.count(fen)
+        body = json.dumps({"white": count, "draws": 0, "black": 0,
+                           "moves": [], "topGames": []}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def start(port: int = 0, **options) -> StubExplorer:
+    """Start a stub explorer in a background thread."""
+    server = StubExplorer(("127.0.0.1", port), **options)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=9001)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--rate-limit-every", type=int, default=0)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+    server = StubExplorer(("127.0.0.1", args.port), latency=args.latency,
+                          error_rate=args.error_rate,
+                          rate_limit_every=args.rate_limit_every,
+                          seed=args.seed)
+    print(f"Serving a stub explorer at {server.url}")
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
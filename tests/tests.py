@@ -1,12 +1,79 @@
+import contextlib
+import gzip
+import http.server
+import io
+import json
+import operator
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
 import time
 import unittest
+import unittest.mock
+from collections import Counter
 import chess
 import chess.pgn
+import chess.engine
+import chess.polyglot
+import numpy as np
+import requests
 
+import bitboards
+import corpus
+import dataset
+import detect_greek_gifts
+import detect_mates
+import detect_sacs
+import endgame_reach
+import engine_analysis
+import endgame_stats
+import eval_swings
+import helpers
+import ingest
+import main
+import memo
+import pipeline
+import position_index
+import sacs_sweep
+import sampling
+import shards
+import store
+import tactics_stats
+import theory
 import utils
+import verify
 from helpers import check_if_move_is_uniquely_nonlosing, \
     check_position_against_masters_db
 
+import benchmark
+import stub_explorer
+
+tests_dir = os.path.dirname(os.path.abspath(__file__))
+
+
+def fake_engine(*options) -> list:
+    """Command running the fake UCI engine in tests/fake_uci.py."""
+    return [sys.executable, os.path.join(tests_dir, "fake_uci.py"), *options]
+
+
+@contextlib.contextmanager
+def explorer_settings(url, pause=0.0, pause_429=0.0,
+                      timeout=helpers.explorer_timeout):
+    """Point helpers at a stub explorer, without pausing between queries."""
+    saved = (helpers.explorer_url, helpers.explorer_pause,
+             helpers.explorer_pause_429, helpers.explorer_timeout)
+    helpers.explorer_url, helpers.explorer_pause, \
+        helpers.explorer_pause_429, helpers.explorer_timeout = \
+        url, pause, pause_429, timeout
+    try:
+        yield
+    finally:
+        helpers.explorer_url, helpers.explorer_pause, \
+            helpers.explorer_pause_429, helpers.explorer_timeout = saved
+
 
 
 class SacDetectionTestCase(unittest.TestCase):
@@ -111,22 +178,1219 @@ class SacDetectionTestCase(unittest.TestCase):
 
 
     def test_check_if_move_is_uniquely_nonlosing(self):
-        self.assertTrue(check_if_move_is_uniquely_nonlosing(
-            fen="5r1k/Bp2r1pp/4Q3/7q/1b6/8/PP2RPPP/R5K1 w - - 1 25",
-            played="e6e7",
-            engine_path="C:/Users/rahul/PycharmProjects/chess-curator/engine" \
-                 "/stockfish_22031308_x64_avx2/stockfish_22031308_x64_avx2.exe"
-        )
-        )
+        fen = "5r1k/Bp2r1pp/4Q3/7q/1b6/8/PP2RPPP/R5K1 w - - 1 25"
+        with tempfile.TemporaryDirectory() as tmp:
+            # Every move but Qe7 loses
+            scores = os.path.join(tmp, "scores.json")
+            with open(scores, "w") as f:
+                json.dump({fen: {"e6e7": 50}}, f)
+            engine = fake_engine("--scores", scores)
+            memo.cache.clear()
+            self.assertTrue(check_if_move_is_uniquely_nonlosing(
+                fen=fen, played="e6e7", time_per_move=0.1,
+                engine_path=engine))
+            self.assertFalse(check_if_move_is_uniquely_nonlosing(
+                fen=fen, played="e6e5", time_per_move=0.1,
+                engine_path=engine))
+            self.assertTrue(helpers.check_if_move_is_uniquely_nonlosing_adaptive(
+                fen=fen, played="e6e7", engine_path=engine, min_depth=2))
 
     def test_check_move_against_masters_db(self):
-        self.assertEquals(7, check_position_against_masters_db(
-            fen = "rn2k2r/pp2bpp1/2p1pn1p/2Pp1b2/1P1P4/2N2NP1/1P2PPBP/R1B1K2R b KQkq - 0 10"))
-        time.sleep(5)
-        self.assertEquals(5, check_position_against_masters_db(
-            fen="2bqr1k1/rpp2ppp/p1np1n2/4p3/4P3/1BPP1N2/PP1N1PPP/R2Q1RK1 w - - 0 11"))
+        fens = ["rn2k2r/pp2bpp1/2p1pn1p/2Pp1b2/1P1P4/2N2NP1/1P2PPBP/R1B1K2R b KQkq - 0 10",
+                "2bqr1k1/rpp2ppp/p1np1n2/4p3/4P3/1BPP1N2/PP1N1PPP/R2Q1RK1 w - - 0 11"]
+        server = stub_explorer.start(counts={fens[0]: 7, fens[1]: 5},
+                                     rate_limit_every=2)
+        try:
+            with explorer_settings(url=server.url):
+                memo.cache.clear()
+                self.assertEqual(7, check_position_against_masters_db(
+                    fen = fens[0]))
+                self.assertEqual(5, check_position_against_masters_db(
+                    fen=fens[1]))
+        finally:
+            server.stop()
+        self.assertEqual(1, server.rate_limited)
+
+    def test_explorer_errors_are_retried_then_raised(self):
+        server = stub_explorer.start(error_rate=1.0)
+        try:
+            with explorer_settings(url=server.url):
+                memo.cache.clear()
+                with self.assertRaises(Exception):
+                    check_position_against_masters_db(chess.STARTING_FEN)
+        finally:
+            server.stop()
+        self.assertEqual(helpers.explorer_retries + 1, server.requests)
+
+    def test_explorer_timeouts_are_retried_then_raised(self):
+        server = stub_explorer.start(latency=0.3)
+        try:
+            with explorer_settings(url=server.url, timeout=0.05):
+                memo.cache.clear()
+                with self.assertRaises(requests.Timeout):
+                    check_position_against_masters_db(chess.STARTING_FEN)
+        finally:
+            server.stop()
+        self.assertEqual(helpers.explorer_retries + 1, server.requests)
+
+    def test_other_nonlosing(self):
+        board = chess.Board()
+        played = chess.Move.from_uci("e2e4")
+
+        def lines(*moves_and_evals):
+            return [{"pv": [chess.Move.from_uci(m)],
+                     "score": chess.engine.PovScore(chess.engine.Cp(e),
+                                                    chess.WHITE)}
+                    for m, e in moves_and_evals]
+
+        # Played move among the lines: alternatives must be close to it
+        self.assertFalse(helpers._other_nonlosing(
+            board, played, lines(("e2e4", 500), ("d2d4", -400)), 5))
+        self.assertTrue(helpers._other_nonlosing(
+            board, played, lines(("e2e4", 500), ("d2d4", 250)), 5))
+        # Played move worse than every line: any non-losing line will do
+        self.assertTrue(helpers._other_nonlosing(
+            board, played, lines(("d2d4", -200), ("c2c4", -350)), 5))
+        self.assertFalse(helpers._other_nonlosing(
+            board, played, lines(("d2d4", -300), ("c2c4", -350)), 5))
+
+    def test_engine_budget(self):
+        budget = helpers.EngineBudget(10)
+        budget.record(4, 6)
+        self.assertEqual(6, budget.remaining())
+        self.assertEqual(2, budget.saved)
+        budget.record(6, 3)
+        self.assertIsNone(helpers.check_if_move_is_uniquely_nonlosing_adaptive(
+            chess.STARTING_FEN, "e2e4", engine_path="no-such-engine",
+            budget=budget))
+        self.assertEqual(1, budget.skipped)
+
+
+
+class GreekGiftTestCase(unittest.TestCase):
+    """Tests for Greek gift detection."""
+
+    games = [
+        # Accepted by the king
+        "1. e4 e6 2. d4 d5 3. Nc3 Nf6 4. e5 Nfd7 5. Nf3 c5 6. Bd3 Be7 7. O-O "
+        "O-O 8. Bxh7+ Kxh7 9. Ng5+ Kg8 10. Qh5 *",
+        # Declined
+        "1. e4 e6 2. d4 d5 3. Nc3 Nf6 4. e5 Nfd7 5. Nf3 c5 6. Bd3 Be7 7. O-O "
+        "O-O 8. Bxh7+ Kh8 9. Ng5 g6 10. Qg4 *",
+        # Accepted by a pawn
+        "1. e4 e5 2. Nf3 Nc6 3. Bc4 Bc5 4. d3 Nf6 5. Be3 h6 6. Bxh6 gxh6 "
+        "7. Nc3 d6 *",
+        # Accepted on the last move of the game
+        "1. e4 e6 2. d4 d5 3. Nc3 Nf6 4. e5 Nfd7 5. Nf3 c5 6. Bd3 Be7 7. O-O "
+        "O-O 8. Bxh7+ Kxh7 *",
+    ]
+
+    @staticmethod
+    def san_greek_gifts(game):
+        """The original SAN-based check for sacs by White."""
+        found = []
+        board = game.board()
+        for n in game.mainline():
+            if not (n.ply() == 1 or n.turn() or n.is_end() or
+                    n.next().is_end()) and \
+                    n.san() in {"Bxh7+", "Bxh7", "Bxh6+", "Bxh6"} and \
+                    board.is_capture(board.parse_san(n.san())) and \
+                    board.piece_at(n.move.to_square).symbol() == "p" and \
+                    n.next().turn():
+                board.push(n.move)
+                if board.is_capture(board.parse_san(n.next().san())) and \
+                        board.piece_at(
+                            n.next().move.to_square).symbol() in {"B"} and \
+                        board.piece_at(
+                            n.next().move.from_square).symbol() in {"k", "p"}:
+                    found.append(n.ply())
+            else:
+                board.push(n.move)
+        return found
+
+    def test_matches_san_check_for_white(self):
+        for text in self.games:
+            game = chess.pgn.read_game(io.StringIO(text))
+            self.assertEqual(self.san_greek_gifts(game),
+                             [ply for ply, _, _ in utils.greek_gifts(game)])
+
+    def test_black_sac(self):
+        game = chess.pgn.read_game(io.StringIO(
+            "1. d4 d5 2. Nf3 Nf6 3. e3 e6 4. Bd3 Bd6 5. O-O O-O 6. b3 Bxh2+ "
+            "7. Kxh2 Ng4+ 8. Kg1 Qh4 *"))
+        self.assertEqual([(12, chess.Move.from_uci("d6h2"))],
+                         [(ply, move) for ply, move, _ in
+                          utils.greek_gifts(game)])
+
+
+    def test_scores_from_pgn_evals(self):
+        game = chess.pgn.read_game(io.StringIO(
+            "1. d4 d5 2. Nf3 Nf6 3. e3 e6 4. Bd3 Bd6 5. O-O O-O "
+            "6. b3 { [%eval 0.2] } 6... Bxh2+ { [%eval -1.1] } "
+            "7. Kxh2 { [%eval -2.5] } (7. Kh1 Ng4 8. g3) 7... Ng4+ 8. Kg1 Qh4 *"))
+        [sac] = detect_greek_gifts.analyse_game(game)["candidates"]
+        # From Black's point of view
+        self.assertEqual((sac["eval_before"], sac["eval_after_sac"],
+                          sac["eval_after_acceptance"]), (-20, 110, 250))
+        self.assertEqual(sac["best_defence"], "7. Kh1 Ng4 8. g3")
+        self.assertEqual(sac["scored_by"], "pgn")
+        self.assertEqual(detect_greek_gifts.quality(sac), "sound")
+
+    def test_engine_scores_games_without_evals(self):
+        games = [chess.pgn.read_game(io.StringIO(text))
+                 for text in [self.games[0], self.games[2]]]
+        per_game = [detect_greek_gifts.analyse_game(game) for game in games]
+        self.assertTrue(all("scored_by" not in can for results in per_game
+                            for can in results["candidates"]))
+        scored = detect_greek_gifts.score_with_engine(
+            per_game, fake_engine(), workers=2, time_per_position=0.01)
+        engine = chess.engine.SimpleEngine.popen_uci(fake_engine())
+        for results in scored:
+            [sac] = results["candidates"]
+            self.assertEqual(sac["scored_by"], "engine")
+            self.assertEqual(
+                {k: sac[k] for k in detect_greek_gifts.scores},
+                {k: v for k, v in detect_greek_gifts.engine_scores(
+                    engine, sac, chess.engine.Limit(time=0.01)).items()
+                 if k in detect_greek_gifts.scores})
+        engine.quit()
+
+
+class DatasetTestCase(unittest.TestCase):
+    """Tests for the columnar ply dataset."""
+
+    def test_move_encoding(self):
+        for uci in ["e2e4", "h7h8q", "a2a1n", "e1g1"]:
+            move = chess.Move.from_uci(uci)
+            self.assertEqual(move,
+                             dataset.decode_move(dataset.encode_move(move)))
+
+    def test_build_dataset(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            pgn_path = os.path.join(tmp, "games.pgn")
+            with open(pgn_path, "w") as f:
+                f.write('[Site "https://lichess.org/abcdefgh"]\n\n'
+                        '1. e4 { [%eval 0.3] [%clk 0:03:00] } 1... e5 '
+                        '2. Qh5 Nc6 3. Bc4 Nf6 4. Qxf7# 1-0\n')
+            self.assertEqual(1, dataset.build_dataset(pgn_path, tmp))
+            plies = dataset.load_plies(tmp)
+            self.assertEqual(list(range(1, 8)), list(plies["ply"]))
+            self.assertEqual([30, dataset.no_eval], list(plies["eval"][:2]))
+            self.assertEqual([180, dataset.no_clock],
+                             list(plies["clock"][:2]))
+            self.assertEqual(38, plies["black_material"][-1])
+            self.assertTrue(dataset.replay(plies).is_checkmate())
+            self.assertEqual("https://lichess.org/abcdefgh",
+                             dataset.load_games(tmp)["Site"][0])
+
+    def test_replay_from_fen(self):
+        fen = "7k/8/6K1/8/8/8/8/R7 w - - 0 1"
+        with tempfile.TemporaryDirectory() as tmp:
+            pgn_path = os.path.join(tmp, "games.pgn")
+            with open(pgn_path, "w") as f:
+                f.write('[Site "https://lichess.org/aaaaaaaa"]\n\n1. e4 *\n\n'
+                        '[Site "https://lichess.org/bbbbbbbb"]\n'
+                        f'[SetUp "1"]\n[FEN "{fen}"]\n\n1. Ra8# 1-0\n')
+            dataset.build_dataset(pgn_path, tmp)
+            games = dataset.load_games(tmp)
+            plies = dataset.load_plies(tmp)
+            _, starts, ends = dataset.game_bounds(plies)
+            board = dataset.replay(plies[starts[1]:ends[1]],
+                                   dataset.start_board(games.loc[1]))
+            self.assertTrue(board.is_checkmate())
+            self.assertEqual(chess.Board(),
+                             dataset.start_board(games.loc[0]))
+
+
+class PositionCacheTestCase(unittest.TestCase):
+    """Tests for the shared position cache."""
+
+    def test_lru_eviction_and_stats(self):
+        cache = memo.PositionCache(maxsize=2)
+        calls = []
+        for key in [1, 2, 1, 3, 2]:
+            cache.lookup("kind", key, lambda: calls.append(key) or key)
+        # 2 is evicted when 3 is added, since 1 was used more recently
+        self.assertEqual([1, 2, 3, 2], calls)
+        self.assertEqual(2, len(cache))
+        self.assertEqual({"kind": {"hits": 1, "misses": 4, "hit_rate": 0.2}},
+                         cache.stats())
+
+    def test_transpositions_share_results(self):
+        memo.cache.clear()
+        first = chess.Board()
+        for san in ["Nf3", "Nf6", "g3", "g6"]:
+            first.push_san(san)
+        second = chess.Board()
+        for san in ["g3", "g6", "Nf3", "Nf6"]:
+            second.push_san(san)
+        utils.is_trapped(first, chess.F3)
+        utils.is_trapped(second, chess.F3)
+        self.assertEqual(1, memo.cache.stats()["is_trapped"]["hits"])
+
+    def test_only_nodes_keeping_their_board_are_cached(self):
+        memo.cache.clear()
+        board = chess.Board()
+        for san in ["e4", "d5", "exd5", "Qxd5", "Nc3"]:
+            board.push_san(san)
+        game = chess.pgn.Game.from_board(board)
+        utils.fork(game.end())
+        utils.skewer(game.end())
+        self.assertEqual({}, memo.cache.stats())
+        node = utils.cached_mainline(board)[-1]
+        self.assertEqual(utils.fork(game.end()), utils.fork(node))
+        self.assertEqual(utils.skewer(game.end()), utils.skewer(node))
+        self.assertEqual(1, memo.cache.stats()["fork"]["misses"])
+        self.assertEqual(1, memo.cache.stats()["skewer"]["misses"])
+
+
+class TheoryIndexTestCase(unittest.TestCase):
+    """Tests for the offline opening-theory index."""
+
+    def test_counts_games_reaching_position(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            pgn_path = os.path.join(tmp, "masters.pgn")
+            with open(pgn_path, "w") as f:
+                f.write("1. e4 e5 2. Nf3 Nc6 *\n\n"
+                        "1. e4 e5 2. Nf3 Nf6 *\n\n"
+                        "1. Nf3 Nc6 2. e4 e5 *\n")
+            theory.build_theory_index([pgn_path]).save(
+                os.path.join(tmp, "theory.npz"))
+            index = theory.TheoryIndex.load(os.path.join(tmp, "theory.npz"))
+
+        board = chess.Board()
+        self.assertEqual(3, index.count(board))
+        for san in ["e4", "e5", "Nf3", "Nc6"]:
+            board.push_san(san)
+        # Reached by transposition in the third game
+        self.assertEqual(2, index.count(board))
+        board.push_san("Bb5")
+        self.assertEqual(0, index.count(board))
+
+    def test_adjacent_keys(self):
+        # Keys this big are only told apart when compared as integers
+        board = chess.Board()
+        key = chess.polyglot.zobrist_hash(board)
+        self.assertTrue(2 ** 62 <= key < 2 ** 63)
+        index = theory.TheoryIndex(
+            np.arange(key - 1, key + 3, dtype=np.uint64),
+            np.array([1, 2, 3, 4], dtype=np.uint32))
+        self.assertEqual(2, index.count(board))
+
+
+class EndgameReachTestCase(unittest.TestCase):
+    """Tests for tablebase-range position detection."""
+
+    def test_first_ply_at_or_below(self):
+        pieces = np.array([32, 32, 31, 9, 8, 8, 7, 6, 6])
+        self.assertEqual(6, endgame_reach.first_ply_at_or_below(pieces, 7))
+        self.assertEqual(3, endgame_reach.first_ply_at_or_below(pieces, 9))
+        self.assertEqual(-1, endgame_reach.first_ply_at_or_below(pieces, 5))
+
+    def test_game_endgame_reach(self):
+        pgn = io.StringIO(
+            '[Site "https://lichess.org/bbbbbbbb"]\n'
+            '[FEN "4k2r/p7/8/8/8/8/3PP3/R3K2R w KQk - 0 1"]\n'
+            '[SetUp "1"]\n\n'
+            '1. Rxa7 Kf8 2. Rxh8+ *\n')
+        game = chess.pgn.read_game(
+            pgn, Visitor=helpers.HeadersAndFinalBoard)
+        reach = endgame_reach.game_endgame_reach(game)
+        self.assertEqual(1, reach["ply"])
+        self.assertEqual("KRRPPvKR", reach["signature"])
+        self.assertIsNone(endgame_reach.game_endgame_reach(game, 5))
+
+
+class EndgameStatsTestCase(unittest.TestCase):
+    """Tests for material signature statistics."""
+
+    def test_game_signatures(self):
+        pgn = io.StringIO(
+            '[Result "1-0"]\n'
+            '[FEN "4k2r/p7/8/8/8/8/3PP3/R3K2R w KQk - 0 1"]\n'
+            '[SetUp "1"]\n\n'
+            '1. Rxa7 Kf8 2. Rxh8+ 1-0\n')
+        game = chess.pgn.read_game(pgn, Visitor=helpers.HeadersAndFinalBoard)
+        counts = endgame_stats.game_signatures(game)
+        self.assertEqual({("endgame", "KRRPPvKRP", "white_wins"): 1,
+                          ("endgame", "KRRPPvKR", "white_wins"): 1,
+                          ("endgame", "KRRPPvK", "white_wins"): 1}, counts)
+        table = endgame_stats.signature_table(counts + counts)
+        self.assertEqual([2, 2, 2], list(table["games"]))
+
+
+class TacticsStatsTestCase(unittest.TestCase):
+    """Tests for corpus-wide tactics tagging."""
+
+    def game_tactics(self, fen, movetext):
+        pgn = io.StringIO(f'[White "A"]\n[Black "B"]\n[FEN "{fen}"]\n'
+                          f'[SetUp "1"]\n\n{movetext} *\n')
+        return tactics_stats.game_tactics(
+            chess.pgn.read_game(pgn, Visitor=helpers.HeadersAndFinalBoard))
+
+    def test_tags_match_node_checks(self):
+        # https://lichess.org/2WcWpKfH#20
+        counts = self.game_tactics(
+            "r2qkb1r/p3nppp/1pp1p3/3pP3/2b5/3Q1NP1/PP3PBP/RNB2RK1 w kq - 0 11",
+            "11. Qe3 Bxf1")
+        self.assertEqual("22:skewer", counts["tagged"])
+        self.assertEqual(1, counts["black_skewer"])
+
+        # https://lichess.org/4z9FA9dC#21
+        counts = self.game_tactics(
+            "rn1qkb1r/1Q3ppp/p7/3ppb2/N2PnB2/4P3/PP3PPP/2R1KBNR b Kkq - 0 11",
+            "11... exf4 12. Qxa8")
+        self.assertEqual("23:trapped", counts["tagged"])
+        self.assertEqual(1, counts["white_trapped"])
+
+    def test_cached_mainline(self):
+        game = chess.pgn.read_game(io.StringIO("1. e4 e5 2. Nf3 Nc6 *"),
+                                   Visitor=helpers.HeadersAndFinalBoard)
+        nodes = utils.cached_mainline(game[1])
+        self.assertEqual([1, 2, 3, 4], [node.ply() for node in nodes])
+        self.assertEqual(game[1].fen(), nodes[-1].board().fen())
+        self.assertEqual(nodes[1], nodes[0].next())
+
+
+class CommandLineTestCase(unittest.TestCase):
+    """Tests for the command-line interface."""
+
+    def test_parses_detector_options(self):
+        args = main.build_parser().parse_args(
+            ["sacs", "--pgn", "games.pgn", "--ids", "abcdefgh",
+             "--no-online-theory"])
+        self.assertEqual(["games.pgn"], args.pgn)
+        self.assertEqual(["abcdefgh"], args.ids)
+        self.assertFalse(args.online_theory)
+
+    def test_help_skips_heavy_imports(self):
+        code = ("import sys, main\n"
+                "try:\n"
+                "    main.main(['--help'])\n"
+                "except SystemExit:\n"
+                "    pass\n"
+                "print(sorted({'pandas', 'numpy', 'requests', 'chess'} & "
+                "set(sys.modules)))")
+        repo = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        out = subprocess.run([sys.executable, "-c", code], cwd=repo,
+                             capture_output=True, text=True,
+                             check=True).stdout
+        self.assertEqual("[]", out.splitlines()[-1])
+
+
+class ResultStoreTestCase(unittest.TestCase):
+    """Tests for the incremental result store."""
+
+    def test_results_are_kept_per_config(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "results.sqlite")
+            first = store.ResultStore(path, "sacs", {"threshold": 2})
+            first.save({"abcdefgh": {"candidates": ["link#10"]}})
+            first.close()
+
+            same = store.ResultStore(path, "sacs", {"threshold": 2})
+            self.assertEqual({"abcdefgh": {"candidates": ["link#10"]}},
+                             same.load(["abcdefgh", "zzzzzzzz"]))
+            same.close()
+
+            changed = store.ResultStore(path, "sacs", {"threshold": 3})
+            self.assertEqual({}, changed.load(["abcdefgh"]))
+            changed.close()
+
+    def test_analyse_games_skips_stored_games(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            pgn_path = os.path.join(tmp, "games.pgn")
+            with open(pgn_path, "w") as f:
+                f.write('[Site "https://lichess.org/aaaaaaaa"]\n\n1. e4 *\n\n'
+                        '[Site "https://lichess.org/bbbbbbbb"]\n\n1. d4 *\n')
+            offsets, keys, _ = sampling.sample_games(pgn_path)
+            results = store.ResultStore(os.path.join(tmp, "results.sqlite"),
+                                        "test", {})
+            results.save({"aaaaaaaa": "stored"})
+            analysed = helpers.analyse_games(
+                lambda game: game.next().uci(), pgn_path, offsets, keys,
+                results)
+            self.assertEqual(["stored", "d2d4"], analysed)
+            self.assertEqual("d2d4", results.load(["bbbbbbbb"])["bbbbbbbb"])
+            results.close()
+
+    def test_games_without_links_are_stored_apart(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            pgn_path = os.path.join(tmp, "games.pgn")
+            with open(pgn_path, "w") as f:
+                f.write('[White "a"]\n\n1. e4 *\n\n'
+                        '[White "b"]\n\n1. d4 *\n')
+            offsets, keys, _ = sampling.sample_games(pgn_path)
+            results = store.ResultStore(os.path.join(tmp, "results.sqlite"),
+                                        "test", {})
+            analyse = lambda game: game.next().uci()
+            self.assertEqual(["e2e4", "d2d4"], helpers.analyse_games(
+                analyse, pgn_path, offsets, keys, results))
+            self.assertEqual(["e2e4", "d2d4"], helpers.analyse_games(
+                int, pgn_path, offsets, keys, results))
+            games = helpers.read_games(pgn_path, offsets)
+            self.assertEqual(["e2e4", "d2d4"], helpers.analyse_stream(
+                int, games, results))
+            results.close()
+
+
+class ExportServer(http.server.BaseHTTPRequestHandler):
+    """Local stand-in for the Lichess user game export endpoint."""
+
+    # Each user's games, as (created at in ms, game ID, moves)
+    games = {"alice": [(1600000000000, "aaaaaaaa", "e4 e5"),
+                       (1600000060000, "bbbbbbbb", "d4 d5")],
+             "bob": [(1600000030000, "cccccccc", "c4")]}
+
+    def do_GET(self):
+        path, _, query = self.path.partition("?")
+        params = dict(p.split("=") for p in query.split("&") if p)
+        since = int(params.get("since", 0))
+        games = [g for g in self.games[path.rsplit("/", 1)[-1]]
+                 if g[0] >= since]
+        ndjson = self.headers["Accept"] == "application/x-ndjson"
+        self.send_response(200)
+        self.end_headers()
+        for created, gameid, moves in games:
+            if ndjson:
+                line = json.dumps({"id": gameid, "createdAt": created,
+                                   "moves": moves, "status": "resign",
+                                   "winner": "white",
+                                   "players": {"white": {}, "black": {}},
+                                   "analysis": [{"eval": 20}]})
+                self.wfile.write(f"{line}\n".encode())
+            else:
+                date = time.strftime("%Y.%m.%d", time.gmtime(created / 1000))
+                clock = time.strftime("%H:%M:%S", time.gmtime(created / 1000))
+                self.wfile.write(
+                    f'[Site "https://lichess.org/{gameid}"]\n'
+                    f'[UTCDate "{date}"]\n[UTCTime "{clock}"]\n\n'
+                    f'1. {moves} 1-0\n\n\n'.encode())
+            self.wfile.flush()
+
+    def log_message(self, *args):
+        pass
+
+
+class IngestTestCase(unittest.TestCase):
+    """Tests for streaming games from the Lichess export API."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0),
+                                                     ExportServer)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.base_url = f"http://127.0.0.1:{cls.server.server_port}"
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def test_stream_formats(self):
+        url = ingest.user_export_url("alice", self.base_url)
+        for fmt in ["pgn", "ndjson"]:
+            games = list(ingest.stream_games(url, fmt=fmt))
+            self.assertEqual(["https://lichess.org/aaaaaaaa",
+                              "https://lichess.org/bbbbbbbb"],
+                             [game.headers["Site"] for game in games])
+            self.assertEqual(["e2e4", "e7e5"],
+                             [m.uci() for m in games[0].mainline_moves()])
+            self.assertEqual(1600000000000, ingest.game_timestamp(games[0]))
+        self.assertEqual(20, games[0].next().eval().white().score())
+
+    def test_concurrent_pulls_resume(self):
+        urls = [ingest.user_export_url(user, self.base_url)
+                for user in ["alice", "bob"]]
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "state.json")
+            games = ingest.stream_exports(urls, ingest.ResumeState(path))
+            self.assertEqual(["aaaaaaaa", "bbbbbbbb", "cccccccc"],
+                             sorted(helpers.game_id(g.headers["Site"])
+                                    for g in games))
+
+            # Nothing new to fetch the second time
+            games = ingest.stream_exports(urls, ingest.ResumeState(path))
+            self.assertEqual([], list(games))
+
+    def test_resume_after_abandoned_game(self):
+        urls = [ingest.user_export_url("alice", self.base_url)]
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "state.json")
+            games = ingest.stream_exports(urls, ingest.ResumeState(path))
+            next(games)
+            # The run stops while analysing the second game
+            next(games)
+            games.close()
+            games = ingest.stream_exports(urls, ingest.ResumeState(path))
+            self.assertEqual(["https://lichess.org/bbbbbbbb"],
+                             [game.headers["Site"] for game in games])
+
+    def test_split_pgn(self):
+        lines = ['[Site "a"]', '', '1. e4 *', '', '', '[Site "b"]', '',
+                 '1. d4', '*']
+        self.assertEqual(['[Site "a"]\n\n1. e4 *\n\n', '[Site "b"]\n\n1. d4\n*'],
+                         list(ingest.split_pgn(lines)))
+
+
+class ShardsTestCase(unittest.TestCase):
+    """Tests for sharded runs."""
+
+    def test_sharded_run_matches_single_run(self):
+        games = ['[Site "https://lichess.org/{}"]\n\n{}\n\n'.format(i, moves)
+                 for i, moves in [
+                     ("aaaaaaaa", "1. f3 e5 2. g4 Qh4# 0-1"),
+                     ("bbbbbbbb", "1. e4 e5 *"),
+                     ("cccccccc", "1. e4 e5 2. Qh5 Nc6 3. Bc4 Nf6 "
+                                  "4. Qxf7# 1-0"),
+                     ("dddddddd", "1. d4 { [%eval 0.2] } d5 *")] * 3]
+        with tempfile.TemporaryDirectory() as tmp:
+            pgn_path = os.path.join(tmp, "games.pgn")
+            with open(pgn_path, "w") as f:
+                f.write("".join(games))
+            all_offsets, _ = helpers.game_offsets(pgn_path, dedupe=False)
+
+            ranges = shards.shard_ranges(pgn_path, 5)
+            self.assertEqual(0, ranges[0][0])
+            self.assertEqual(os.path.getsize(pgn_path), ranges[-1][1])
+            for start, end in ranges:
+                self.assertTrue(start == end or start in all_offsets)
+
+            queue = os.path.join(tmp, "queue")
+            shards.plan(queue, pgn_path, 5, "mates")
+            task = shards.claim(queue)
+            self.assertEqual((0, ranges[0][1]), (task["start"], task["end"]))
+            self.assertEqual(1, shards.requeue(queue))
+            self.assertEqual(5, shards.work(queue))
+
+            # Both skip the copies of the first four games
+            offsets, keys, _ = sampling.sample_games(pgn_path)
+            self.assertEqual(4, len(offsets))
+            single = helpers.analyse_games(detect_mates.analyse_game,
+                                           pgn_path, offsets, keys)
+            self.assertEqual(json.loads(json.dumps(single)),
+                             shards.merged_results(queue))
+
+
+class EngineAnalysisTestCase(unittest.TestCase):
+    """Tests for whole-game engine analysis."""
+
+    def test_cpl(self):
+        # White drops 120cp, Black walks into a winning position for White
+        # (capped at 1000cp), then White misses a mate
+        np.testing.assert_array_equal(
+            [120, 1100, 2000],
+            engine_analysis.cpl(np.array([20, -100, 5000, -100000]),
+                                np.array([True, False, True])))
+
+    def test_game_over_positions_skip_the_engine(self):
+        board = chess.Board()
+        for move in ["f3", "e5", "g4", "Qh4#"]:
+            board.push_san(move)
+        self.assertEqual((-engine_analysis.mate_score, None),
+                         engine_analysis.position_eval(None, board, None))
+        stalemate = chess.Board("7k/5Q2/6K1/8/8/8/8/8 b - - 0 1")
+        self.assertEqual((0, None),
+                         engine_analysis.position_eval(None, stalemate, None))
+
+
+class BitboardsTestCase(unittest.TestCase):
+    """Tests for batch position queries on bitboard arrays."""
+
+    def test_matches_per_board_functions(self):
+        game = chess.pgn.read_game(io.StringIO(
+            "1. e4 d5 2. exd5 Qxd5 3. Nc3 Qa5 4. d4 Nf6 5. Nf3 Bf5 6. Bc4 e6 "
+            "7. Bd2 c6 8. Nd5 Qd8 9. Nxf6+ gxf6 10. Bb3 Qxd4 11. Nxd4 *"))
+        rows = bitboards.game_bitboards(game)
+        boards = [game.board()] + [node.board() for node in game.mainline()]
+        self.assertEqual((len(boards), 12), rows.shape)
+        material = bitboards.material(rows)
+        np.testing.assert_array_equal(
+            [utils.material_diff(board, chess.BLACK) for board in boards],
+            bitboards.material_diff(rows, chess.BLACK))
+        np.testing.assert_array_equal(
+            [utils.material_count(board, chess.WHITE) for board in boards],
+            material[:, 0])
+        self.assertEqual([utils.material_signature(board) for board in boards],
+                         list(bitboards.signatures(rows)))
+        self.assertEqual([utils.game_phase(board) for board in boards],
+                         list(bitboards.phases(rows)))
+
+    def test_popcount(self):
+        values = np.array([0, 1, 0xFF, 2 ** 64 - 1], dtype=np.uint64)
+        np.testing.assert_array_equal([0, 1, 8, 64],
+                                      bitboards.popcount(values))
+
+
+class PositionIndexTestCase(unittest.TestCase):
+    """Tests for the corpus-wide position index."""
+
+    def test_incremental_update_and_lookup(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            first = os.path.join(tmp, "first.pgn")
+            second = os.path.join(tmp, "second.pgn")
+            with open(first, "w") as f:
+                f.write('[Site "https://lichess.org/aaaaaaaa"]\n\n'
+                        '1. e4 e5 2. Nf3 Nc6 *\n\n'
+                        '[Site "https://lichess.org/bbbbbbbb"]\n\n'
+                        '1. Nf3 Nc6 2. e4 e5 *\n\n')
+            with open(second, "w") as f:
+                # One game already indexed, one new
+                f.write('[Site "https://lichess.org/bbbbbbbb"]\n\n'
+                        '1. Nf3 Nc6 2. e4 e5 *\n\n'
+                        '[Site "https://lichess.org/cccccccc"]\n\n'
+                        '1. d4 d5 *\n\n')
+            path = os.path.join(tmp, "index")
+            index = position_index.PositionIndex(path)
+            self.assertEqual(2, index.update([first], processes=1))
+            self.assertEqual(1, index.update([first, second], processes=1))
+
+            board = chess.Board()
+            for move in ["e4", "e5", "Nf3", "Nc6"]:
+                board.push_san(move)
+            expected = [("aaaaaaaa", 4), ("bbbbbbbb", 4)]
+            reopened = position_index.PositionIndex(path)
+            self.assertEqual(3, len(reopened))
+            self.assertEqual(2, len(reopened.segments))
+            self.assertEqual(expected, reopened.lookup(board))
+            self.assertEqual(3, reopened.count_games(chess.Board()))
+
+            reopened.compact()
+            self.assertEqual(1, len(reopened.segments))
+            self.assertEqual(expected, reopened.lookup(board))
+            self.assertEqual(expected,
+                             position_index.PositionIndex(path).lookup(board))
+
+
+class DuplicateGamesTestCase(unittest.TestCase):
+    """Tests for skipping copies of the same game."""
+
+    def test_duplicates_by_id_and_by_moves(self):
+        pgn = ('[Site "https://lichess.org/aaaaaaaa"]\n\n1. e4 e5 *\n\n'
+               '[Site "https://lichess.org/aaaaaaaa"]\n\n'
+               '1. e4 { [%clk 0:03:00] } 1... e5 *\n\n'
+               '[White "A"]\n[Black "B"]\n\n1. d4 d5 2. c4 *\n\n'
+               # Same moves, different comments and layout
+               '[White "A"]\n[Black "B"]\n\n'
+               '1. d4 { [%eval 0.1] } 1... d5 (1... Nf6 2. c4) 2. c4 $1 *\n\n'
+               # Same moves, different players
+               '[White "C"]\n[Black "B"]\n\n1. d4 d5 2. c4 *\n\n')
+        with tempfile.TemporaryDirectory() as tmp:
+            pgn_path = os.path.join(tmp, "games.pgn")
+            with open(pgn_path, "w") as f:
+                f.write(pgn)
+            offsets, links, keys = helpers.scan_games(pgn_path)
+            self.assertEqual([1, 3], helpers.duplicates(keys))
+            deduped, _ = helpers.game_offsets(pgn_path)
+            self.assertEqual([offsets[0], offsets[2], offsets[4]], deduped)
+
+    def test_normalize_movetext(self):
+        self.assertEqual("e4 e5 Nf3", helpers.normalize_movetext(
+            "1. e4 {comment} 1... e5 (1... c5 (1... e6) 2. Nf3) 2. Nf3 $2"))
+
+
+class SamplingTestCase(unittest.TestCase):
+    """Tests for single-pass game sampling."""
+
+    def write_pgn(self, tmp):
+        pgn_path = os.path.join(tmp, "games.pgn")
+        with open(pgn_path, "w") as f:
+            for i in range(300):
+                tc = ["60+0", "180+2", "600+5"][i % 3]
+                f.write(f'[Site "https://lichess.org/{i:08}"]\n'
+                        f'[TimeControl "{tc}"]\n'
+                        f'[WhiteElo "{1500 + i}"]\n[BlackElo "{1500 + i}"]\n'
+                        f'\n1. e4 e5 *\n\n')
+        return pgn_path
+
+    def test_reservoir_sample_is_seeded_and_uniform(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            pgn_path = self.write_pgn(tmp)
+            offsets, keys, total = sampling.sample_games(pgn_path, 20,
+                                                         seed=1)
+            self.assertEqual(300, total)
+            self.assertEqual(20, len(set(offsets)))
+            self.assertEqual(sorted(offsets), offsets)
+            self.assertEqual((offsets, keys), sampling.sample_games(
+                pgn_path, 20, seed=1)[:2])
+            all_offsets, all_links = helpers.game_offsets(pgn_path)
+            self.assertEqual([helpers.game_id(all_links[
+                all_offsets.index(offset)]) for offset in offsets], keys)
+        # Every item is equally likely to be kept
+        counts = Counter()
+        for seed in range(2000):
+            reservoir = sampling.Reservoir(2, random.Random(seed))
+            for item in range(10):
+                reservoir.add(item)
+            counts.update(reservoir.items)
+        self.assertTrue(all(350 < counts[item] < 450 for item in range(10)))
+
+    def test_stratified_sample(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            pgn_path = self.write_pgn(tmp)
+            _, keys, _ = sampling.sample_games(pgn_path, 30, seed=0,
+                                               stratify_by="time-control")
+            speeds = Counter(int(key) % 3 for key in keys)
+            self.assertEqual({0: 10, 1: 10, 2: 10}, speeds)
+        self.assertEqual({"a": 2, "b": 5, "c": 5},
+                         sampling.allocate({"a": 2, "b": 50, "c": 9}, 12))
+        self.assertEqual("1800-1999", sampling.rating_band(
+            {"WhiteElo": "1850", "BlackElo": "1990"}))
+        self.assertEqual("Season 21", sampling.season(
+            {"Event": "Lichess4545 League Season 21", "Date": "2021.01.02"}))
+
+    def test_sample_by_ids(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            pgn_path = self.write_pgn(tmp)
+            _, keys, _ = sampling.sample_games(
+                pgn_path, sample_ids=["00000007", "00000003", "missing"])
+            self.assertEqual(["00000003", "00000007"], keys)
+
+
+class CorpusTestCase(unittest.TestCase):
+    """Tests for reading several PGN files as one corpus."""
+
+    @staticmethod
+    def game(i):
+        return f'[Site "https://lichess.org/{i:08}"]\n\n1. e4 e5 2. Nf3 *\n\n'
+
+    def write_corpus(self, tmp):
+        os.makedirs(os.path.join(tmp, "season-1"))
+        with open(os.path.join(tmp, "season-1", "a.pgn"), "w") as f:
+            f.write("".join(self.game(i) for i in range(0, 10)))
+        with open(os.path.join(tmp, "season-1", "b.pgn"), "w") as f:
+            f.write("".join(self.game(i) for i in range(10, 13)))
+        # A compressed file, repeating a game from a.pgn
+        with gzip.open(os.path.join(tmp, "c.pgn.gz"), "wt") as f:
+            f.write("".join(self.game(i) for i in [5, 13, 14]))
+        manifest = os.path.join(tmp, "corpus.txt")
+        with open(manifest, "w") as f:
+            f.write("# Every season\nseason-*/*.pgn\n\nc.pgn.gz\n")
+        return manifest
+
+    def test_manifest_globs_and_compressed_files(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            games = corpus.Corpus([self.write_corpus(tmp)],
+                                  os.path.join(tmp, "cache"))
+            self.assertEqual(["a.pgn", "b.pgn", "c.pgn.gz"],
+                             [os.path.basename(path) for path in games.files])
+            locations, links = helpers.game_offsets(games)
+            self.assertEqual([f"https://lichess.org/{i:08}"
+                              for i in range(15)], links)
+            self.assertEqual(games.files[2], locations[-1][0])
+            # Chunks smaller than the files, and split between files
+            headers = helpers.map_games(
+                operator.itemgetter(0), games, locations,
+                visitor=helpers.HeadersAndFinalBoard, processes=2,
+                chunksize=4)
+            self.assertEqual(links, [h["Site"] for h in headers])
+            # ...except the compressed file, which is read in one go
+            self.assertEqual([2], [len(run) for path, run
+                                   in helpers.file_runs(games, locations, 1)
+                                   if path == games.files[2]])
+            offsets, sampled, total = sampling.sample_games(games, 5, seed=0)
+            self.assertEqual((5, 15), (len(offsets), total))
+            self.assertEqual(sampled, [
+                helpers.game_id(game.headers["Site"])
+                for game in helpers.read_games(games, offsets)])
+
+    def test_cached_indexes(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            manifest = self.write_corpus(tmp)
+            cache = os.path.join(tmp, "cache")
+            corpus.Corpus([manifest], cache).scan()
+            self.assertEqual(3, len(os.listdir(cache)))
+            games = corpus.Corpus([manifest], cache)
+            self.assertIsNotNone(games._cached(games.files[0]))
+            # A changed file is scanned again
+            with open(games.files[1], "a") as f:
+                f.write(self.game(99))
+            os.utime(games.files[1], (0, 0))
+            self.assertIsNone(games._cached(games.files[1]))
+            self.assertEqual(4, len(games.scan()[games.files[1]][0]))
+            # Samples come from the cached scans without reading the files
+            with unittest.mock.patch.object(helpers, "iter_headers") as read:
+                _, keys, total = sampling.sample_games(games, 3, seed=0)
+            read.assert_not_called()
+            self.assertEqual((3, 16), (len(keys), total))
+
+    def test_single_file(self):
+        self.assertEqual("games.pgn", corpus.open_pgn(["games.pgn"]))
+
+
+class PipelineTestCase(unittest.TestCase):
+    """Tests for reading and analysing games at the same time."""
+
+    def test_matches_reading_offsets(self):
+        games = [chess.pgn.read_game(io.StringIO(text))
+                 for text in GreekGiftTestCase.games]
+        with tempfile.TemporaryDirectory() as tmp:
+            pgn_path = os.path.join(tmp, "games.pgn")
+            with open(pgn_path, "w") as f:
+                for i, game in enumerate(games * 10):
+                    game.headers["Site"] = f"https://lichess.org/{i:08}"
+                    f.write(f"{game}\n\n")
+                # A copy of the first game
+                games[0].headers["Site"] = "https://lichess.org/00000000"
+                f.write(f"{games[0]}\n\n")
+            offsets, keys, _ = sampling.sample_games(pgn_path)
+            expected = helpers.analyse_games(detect_greek_gifts.analyse_game,
+                                             pgn_path, offsets, keys)
+            ready = []
+            self.assertEqual(expected, pipeline.analyse_pgn(
+                detect_greek_gifts.analyse_game, pgn_path, processes=2,
+                batch_size=3, on_result=ready.append))
+            self.assertEqual(expected, ready)
+
+            results = store.ResultStore(os.path.join(tmp, "results.sqlite"),
+                                        "greek_gifts", {})
+            pipeline.analyse_pgn(detect_greek_gifts.analyse_game, pgn_path,
+                                 results, processes=2)
+            # Stored results come back as they were saved, as JSON
+            self.assertEqual(json.loads(json.dumps(expected)),
+                             pipeline.analyse_pgn(int, pgn_path, results))
+
+    def test_worker_errors(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            pgn_path = os.path.join(tmp, "games.pgn")
+            with open(pgn_path, "w") as f:
+                f.write(GreekGiftTestCase.games[0])
+            with self.assertRaises(RuntimeError):
+                pipeline.analyse_pgn(int, pgn_path, processes=1)
+
+    def test_results_are_stored_when_a_run_fails(self):
+        def analyse(game):
+            if game.next().uci() == "d2d4":
+                raise ValueError("d4")
+            return game.next().uci()
+
+        with tempfile.TemporaryDirectory() as tmp:
+            pgn_path = os.path.join(tmp, "games.pgn")
+            with open(pgn_path, "w") as f:
+                f.write('[Site "https://lichess.org/aaaaaaaa"]\n\n1. e4 *\n\n'
+                        '[Site "https://lichess.org/bbbbbbbb"]\n\n1. d4 *\n')
+            offsets, keys, _ = sampling.sample_games(pgn_path)
+            for run in [
+                    lambda results: pipeline.analyse_pgn(
+                        analyse, pgn_path, results, processes=1,
+                        batch_size=1),
+                    lambda results: helpers.analyse_games(
+                        analyse, pgn_path, offsets, keys, results)]:
+                path = os.path.join(tmp, f"{len(os.listdir(tmp))}.sqlite")
+                results = store.ResultStore(path, "test", {})
+                with self.assertRaises(Exception):
+                    run(results)
+                self.assertEqual({"aaaaaaaa": "e2e4"},
+                                 results.load(keys))
+                results.close()
+
+    def test_games_without_links_are_stored_apart(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            pgn_path = os.path.join(tmp, "games.pgn")
+            with open(pgn_path, "w") as f:
+                f.write('[White "a"]\n\n1. e4 *\n\n'
+                        '[White "b"]\n\n1. d4 *\n')
+            results = store.ResultStore(os.path.join(tmp, "results.sqlite"),
+                                        "test", {})
+            analysed = pipeline.analyse_pgn(str, pgn_path, results,
+                                            processes=1)
+            self.assertEqual(2, len(set(analysed)))
+            self.assertEqual(analysed, pipeline.analyse_pgn(
+                int, pgn_path, results, processes=1))
+            # The same keys as games read by their offsets
+            offsets, keys, _ = sampling.sample_games(pgn_path)
+            self.assertEqual(analysed, helpers.analyse_games(
+                int, pgn_path, offsets, keys, results))
+            results.close()
+
+
+class VerifyTestCase(unittest.TestCase):
+    """Tests for the asynchronous theory and engine checks."""
+
+    def test_matches_sequential_checks(self):
+        games = benchmark.random_games(12, seed=3)
+        theory_index = os.path.join(tests_dir, "no-index.npz")
+        engine = fake_engine("--latency", "0.001")
+        server = stub_explorer.start()
+        try:
+            with explorer_settings(url=server.url):
+                memo.cache.clear()
+                expected = detect_sacs.engine_check_candidates(
+                    [detect_sacs.analyse_game(game, theory_index, True,
+                                              engine, defer_engine_check=True)
+                     for game in games], engine)
+                requests = server.requests
+                verifier = verify.Verifier(theory_index, True, engine,
+                                           max_requests=3).start()
+                per_game = []
+                for game in games:
+                    per_game.append(detect_sacs.analyse_game(
+                        game, theory_index, True, engine,
+                        defer_theory_check=True))
+                    verifier.submit(per_game[-1])
+                per_game = verifier.finish(per_game)
+        finally:
+            server.stop()
+        for results in per_game:
+            for can in results["candidates"]:
+                del can["theory_fen"]
+        self.assertEqual(expected, per_game)
+        # Candidates in theory never reach the engine
+        kept = sum(len(results["candidates"]) + len(results["only_nonlosing"])
+                   for results in per_game)
+        self.assertTrue(any(results["theory"] for results in per_game))
+        self.assertEqual(kept, verifier.engine_checks)
+        self.assertEqual(requests, server.requests - requests)
+
+    def test_failed_queries_leave_candidates_unverified(self):
+        games = benchmark.random_games(6, seed=3)
+        theory_index = os.path.join(tests_dir, "no-index.npz")
+        engine = fake_engine()
+        server = stub_explorer.start(error_rate=1.0)
+        with tempfile.TemporaryDirectory() as tmp:
+            verdicts = store.ResultStore(os.path.join(tmp, "results.sqlite"),
+                                         "sacs_verify", {})
+            try:
+                with explorer_settings(url=server.url):
+                    verifier = verify.Verifier(theory_index, True, engine,
+                                               results_store=verdicts).start()
+                    per_game = []
+                    for game in games:
+                        per_game.append(detect_sacs.analyse_game(
+                            game, theory_index, True, engine,
+                            defer_theory_check=True))
+                        verifier.submit(per_game[-1])
+                    with contextlib.redirect_stdout(io.StringIO()):
+                        per_game = verifier.finish(per_game)
+            finally:
+                server.stop()
+            candidates = [can for results in per_game
+                          for can in results["candidates"]]
+            self.assertTrue(candidates)
+            self.assertFalse(any(can["engine_checked"] for can in candidates))
+            self.assertEqual(len(candidates), verifier.theory_failures)
+            self.assertEqual({}, verdicts.load(
+                [can["link"] for can in candidates]))
+            verdicts.close()
+
+    def test_engine_crashes_leave_candidates_unverified(self):
+        games = benchmark.random_games(12, seed=3)
+        theory_index = os.path.join(tests_dir, "no-index.npz")
+        engine = fake_engine("--fail-every", "2")
+        verifier = verify.Verifier(theory_index, False, engine,
+                                   max_engines=1).start()
+        per_game = []
+        for game in games:
+            per_game.append(detect_sacs.analyse_game(
+                game, theory_index, False, engine, defer_theory_check=True))
+            verifier.submit(per_game[-1])
+        with contextlib.redirect_stdout(io.StringIO()):
+            per_game = verifier.finish(per_game)
+        unverified = [can for results in per_game
+                      for can in results["candidates"]
+                      if not can["engine_checked"]]
+        self.assertTrue(verifier.engine_failures)
+        self.assertEqual(verifier.engine_failures, len(unverified))
+        self.assertIn("left unverified", verifier.report())
+
+
+class TimeBudgetTestCase(unittest.TestCase):
+    """Tests for per-game and per-candidate time budgets."""
+
+    def test_nested_limits(self):
+        with helpers.time_limit(0.05, "game"):
+            with helpers.time_limit(10, "candidate"):
+                self.assertTrue(helpers.time_left() <= 0.05)
+                helpers.check_time()
+                with self.assertRaisesRegex(helpers.GameTimeout, "game"):
+                    helpers.check_time(1)
+        self.assertEqual(float("inf"), helpers.time_left())
+        helpers.check_time(1000)
+
+    def test_slow_games_are_left_for_a_retry(self):
+        def analyse(game):
+            while game.next().uci() == "d2d4":
+                time.sleep(0.01)
+                helpers.check_time()
+            return game.next().uci()
+
+        with tempfile.TemporaryDirectory() as tmp:
+            pgn_path = os.path.join(tmp, "games.pgn")
+            with open(pgn_path, "w") as f:
+                f.write('[Site "https://lichess.org/aaaaaaaa"]\n\n1. e4 *\n\n'
+                        '[Site "https://lichess.org/bbbbbbbb"]\n\n1. d4 *\n\n'
+                        '[White "c"]\n\n1. d4 *\n')
+            offsets, keys, _ = sampling.sample_games(pgn_path)
+            results = store.ResultStore(os.path.join(tmp, "results.sqlite"),
+                                        "test", {})
+            timer = helpers.GameTimer(0.2)
+            analysed = helpers.analyse_games(analyse, pgn_path, offsets,
+                                             keys, results, timer=timer)
+            self.assertEqual(["e2e4"], analysed)
+            self.assertEqual({}, results.load(keys[1:]))
+            results.close()
+            self.assertEqual(keys[1:], list(timer.timed_out))
+            self.assertIn(timer.slowest(1)[0][0], keys[1:])
+            retry = os.path.join(tmp, "timed_out.txt")
+            timer.save_timed_out(retry)
+            args = main.build_parser().parse_args(["sacs", "--ids-file",
+                                                   retry])
+            self.assertEqual(["bbbbbbbb", keys[2]], args.ids)
+            # Both games, with and without a Lichess link, can be retried
+            self.assertEqual(offsets[1:], sampling.sample_games(
+                pgn_path, sample_ids=args.ids)[0])
+
+    def test_candidate_budget_caps_adaptive_searches(self):
+        game = benchmark.random_games(1, seed=3)[0]
+        theory_index = os.path.join(tests_dir, "no-index.npz")
+        per_game = [detect_sacs.analyse_game(game, theory_index, False,
+                                             defer_engine_check=True)]
+        candidates = len(per_game[0]["candidates"])
+        self.assertTrue(candidates)
+        start = time.perf_counter()
+        with contextlib.redirect_stderr(io.StringIO()):
+            detect_sacs.engine_check_candidates(
+                per_game, fake_engine("--latency", "0.05"),
+                candidate_time=0.1)
+        # Well short of the 12 depths (0.6s) each search would otherwise run
+        self.assertTrue(time.perf_counter() - start < 0.4 * candidates)
+
+    def test_candidate_budget_covers_explorer_waits(self):
+        game = benchmark.random_games(1, seed=3)[0]
+        theory_index = os.path.join(tests_dir, "no-index.npz")
+        server = stub_explorer.start(latency=0.5)
+        try:
+            with explorer_settings(url=server.url):
+                memo.cache.clear()
+                start = time.perf_counter()
+                with self.assertRaisesRegex(helpers.GameTimeout,
+                                            "candidate"):
+                    detect_sacs.analyse_game(game, theory_index,
+                                             defer_engine_check=True,
+                                             candidate_time=0.1)
+                self.assertTrue(time.perf_counter() - start < 0.4)
+        finally:
+            server.stop()
+
+
+class EvalSwingsTestCase(unittest.TestCase):
+    """Tests for the vectorized blunder and turning point finder."""
+
+    pgn = ('[Site "https://lichess.org/aaaaaaaa"]\n\n'
+           '1. e4 { [%eval 0.2] } 1... f6 { [%eval 3.5] } '
+           '2. Nc3 { [%eval 0.5] } 2... g5 { [%eval -2.0] } '
+           '3. Qh5+ { [%eval #2] } 1-0\n\n'
+           '[Site "https://lichess.org/bbbbbbbb"]\n\n'
+           '1. d4 { [%eval 0.1] } 1... d5 { [%eval 0.1] } '
+           '2. c4 { [%eval -2.0] } 2... e6 { [%eval 0.0] } *\n')
+    expected = [("https://lichess.org/aaaaaaaa#2", "blunder"),
+                ("https://lichess.org/aaaaaaaa#3", "blunder"),
+                ("https://lichess.org/aaaaaaaa#3", "missed_win"),
+                ("https://lichess.org/aaaaaaaa#4", "turning_point"),
+                ("https://lichess.org/aaaaaaaa#5", "turning_point"),
+                ("https://lichess.org/bbbbbbbb#3", "blunder"),
+                ("https://lichess.org/bbbbbbbb#4", "blunder")]
+
+    def swings(self, series, headers):
+        swings = eval_swings.find_swings(series)
+        return [(f"{headers[game]['Site']}#{ply}", kind)
+                for game, ply, kind in zip(swings["game"], swings["ply"],
+                                           swings["kind"])]
+
+    def test_pgn_and_dataset_series(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            pgn_path = os.path.join(tmp, "games.pgn")
+            with open(pgn_path, "w") as f:
+                f.write(self.pgn)
+            series, headers = eval_swings.pgn_series(pgn_path, processes=1)
+            self.assertEqual(self.expected, self.swings(series, headers))
+
+            out_dir = os.path.join(tmp, "dataset")
+            dataset.build_dataset(pgn_path, out_dir)
+            from_dataset, headers = eval_swings.dataset_series(out_dir)
+            np.testing.assert_array_equal(series, from_dataset)
+            self.assertEqual(self.expected, self.swings(from_dataset,
+                                                        headers))
+
+    def test_matches_node_evals(self):
+        game = chess.pgn.read_game(io.StringIO(self.pgn))
+        _, evals = chess.pgn.read_game(
+            io.StringIO(self.pgn), Visitor=eval_swings.HeadersAndEvals)
+        self.assertEqual([node.eval().white().score(mate_score=100000)
+                          for node in game.mainline()], evals)
+
+
+class SacsSweepTestCase(unittest.TestCase):
+    """Tests for sweeping detect_sacs's thresholds."""
+
+    def test_configs_match_detect_sacs(self):
+        games = benchmark.random_games(20, plies=100, seed=5)
+        theory_index = os.path.join(tests_dir, "no-index.npz")
+        configs = sacs_sweep.grid_configs({"opening_plies": [20],
+                                           "theory_games": [1, 4]})
+        server = stub_explorer.start()
+        try:
+            with explorer_settings(url=server.url):
+                memo.cache.clear()
+                features = [sacs_sweep.game_features(game, theory_index)
+                            for game in games]
+                requests = server.requests
+                rows, _ = sacs_sweep.sweep(features, configs)
+                self.assertEqual(requests, server.requests)
+                for config, row in zip(configs, rows):
+                    saved = sacs_sweep.default_config()
+                    for parameter, value in config.items():
+                        setattr(detect_sacs, parameter, value)
+                    try:
+                        expected = helpers.merge_results(
+                            [detect_sacs.analyse_game(
+                                game, theory_index, defer_engine_check=True)
+                             for game in games],
+                            ["candidates", *sacs_sweep.rejections])
+                    finally:
+                        for parameter, value in saved.items():
+                            setattr(detect_sacs, parameter, value)
+                    results = sacs_sweep.apply_config(features, config)
+                    self.assertEqual(
+                        [can["link"] for can in expected["candidates"]],
+                        [can["link"] for can in results["candidates"]])
+                    for kind in sacs_sweep.rejections:
+                        self.assertEqual(expected[kind], results[kind])
+                    self.assertEqual(len(results["candidates"]),
+                                     row["candidates"])
+        finally:
+            server.stop()
+        self.assertEqual(sacs_sweep.default_config(), configs[0])
+        self.assertEqual((0, 0), (rows[0]["added"], rows[0]["removed"]))
+        self.assertTrue(rows[1]["candidates"] < rows[0]["candidates"])
 
+    def test_command_line(self):
+        games = benchmark.random_games(4, plies=60, seed=5)
+        theory_index = os.path.join(tests_dir, "no-index.npz")
+        cwd = os.getcwd()
+        with tempfile.TemporaryDirectory() as tmp:
+            pgn_path = os.path.join(tmp, "games.pgn")
+            with open(pgn_path, "w") as f:
+                f.write("\n\n".join(str(game) for game in games))
+            os.makedirs(os.path.join(tmp, "outputs"))
+            os.chdir(tmp)
+            try:
+                with contextlib.redirect_stdout(io.StringIO()):
+                    main.main(["sacs-sweep", "--pgn", pgn_path, "--no-store",
+                               "--theory-index", theory_index,
+                               "--no-online-theory", "--processes", "1",
+                               "--winning-eval-threshold", "200", "400"])
+            finally:
+                os.chdir(cwd)
+            saved = os.listdir(os.path.join(tmp, "outputs"))
+        self.assertEqual(1, len(saved))
+        self.assertTrue(saved[0].startswith(sacs_sweep.task_label))
 
+    def test_invalid_windows(self):
+        with self.assertRaises(ValueError):
+            sacs_sweep.grid_configs({"ending_plies": [4]})
+        with self.assertRaises(ValueError):
+            sacs_sweep.grid_configs({"margin": [1]})
 
 
 if __name__ == '__main__':
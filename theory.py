@@ -0,0 +1,107 @@
+"""Offline opening-theory index.
+
+Built once from a local reference PGN database (e.g. a masters collection),
+the index maps each position's Zobrist hash to the number of reference games
+that reached it. It's stored on disk as two sorted arrays, so checking a
+position is a single binary search with no network involved.
+
+Usage: python main.py theory-index REFERENCE_PGN [REFERENCE_PGN ...]
+"""
+
+import os
+from collections import Counter
+from typing import Iterable
+
+import chess
+import chess.pgn
+import chess.polyglot
+import numpy as np
+from tqdm import tqdm
+
+import helpers
+
+default_index_path = "inputs/masters_theory.npz"
+# Positions after this ply are very rarely shared between master games
+default_max_ply = 50
+
+
+class TheoryIndex:
+    """Zobrist hash -> number of reference games reaching the position."""
+
+    def __init__(self, keys: np.ndarray, counts: np.ndarray):
+        self.keys = keys
+        self.counts = counts
+
+    def __len__(self):
+        return len(self.keys)
+
+    @classmethod
+    def load(cls, path: str):
+        with np.load(path) as data:
+            return cls(data["keys"], data["counts"])
+
+    def save(self, path: str):
+        np.savez(path, keys=self.keys, counts=self.counts)
+
+    def count(self, board: chess.Board) -> int:
+        """Number of reference games that reached the board's position."""
+        # As a uint64, so NumPy doesn't compare the keys as floats
+        key = np.uint64(chess.polyglot.zobrist_hash(board))
+        i = np.searchsorted(self.keys, key)
+        if i < len(self.keys) and self.keys[i] == key:
+            return int(self.counts[i])
+        return 0
+
+
+def build_theory_index(pgn_paths: Iterable[str],
+                       max_ply: int = default_max_ply) -> TheoryIndex:
+    """Count the games reaching each position in a set of reference PGNs.
+
+    :param pgn_paths: paths to the reference PGN files.
+    :param max_ply: only index positions up to this ply. Default value: 50.
+    """
+    counts = Counter()
+    for pgn_path in pgn_paths:
+        pgn = helpers.read_pgn(pgn_path)
+        with tqdm(desc=pgn_path, unit=" games") as progress:
+            while True:
+                game = chess.pgn.read_game(pgn)
+                if game is None:
+                    break
+                board = game.board()
+                # Count each position once per game, even if it's repeated
+                seen = {chess.polyglot.zobrist_hash(board)}
+                for move in game.mainline_moves():
+                    if board.ply() >= max_ply:
+                        break
+                    board.push(move)
+                    seen.add(chess.polyglot.zobrist_hash(board))
+                counts.update(seen)
+                progress.update()
+        pgn.close()
+
+    keys = np.fromiter(counts.keys(), dtype=np.uint64, count=len(counts))
+    values = np.fromiter(counts.values(), dtype=np.uint32, count=len(counts))
+    order = np.argsort(keys)
+    return TheoryIndex(keys[order], values[order])
+
+
+_indexes = {}
+
+
+def masters_games(board: chess.Board,
+                  index_path: str = default_index_path,
+                  online_fallback: bool = True) -> int:
+    """Count master games reaching a position.
+
+    Uses the local index at index_path when it exists. Otherwise falls back
+    to the Lichess Masters explorer if online_fallback is set, or returns 0.
+    """
+    if index_path not in _indexes:
+        _indexes[index_path] = TheoryIndex.load(index_path) \
+            if os.path.exists(index_path) else None
+    if _indexes[index_path] is not None:
+        return _indexes[index_path].count(board)
+    if online_fallback:
+        return helpers.check_position_against_masters_db(board.fen())
+    return 0
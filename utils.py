@@ -9,6 +9,8 @@ from chess import KING, QUEEN, ROOK, BISHOP, KNIGHT, PAWN
 from chess.pgn import ChildNode
 from typing import Type, TypeVar
 
+import memo
+
 A = TypeVar('A')
 def pp(a: A, msg = None) -> A:
     print(f'{msg + ": " if msg else ""}{a}')
@@ -62,6 +64,23 @@ def material_count(board: Board, side: Color) -> int:
 def material_diff(board: Board, side: Color) -> int:
     return material_count(board, side) - material_count(board, not side)
 
+def game_phase(board: Board) -> str:
+    """Opening, middlegame or endgame, going by the number of majors and
+    minors left (as in Lichess's Divider, without its backrank checks)."""
+    majors_and_minors = chess.popcount(board.occupied & ~board.pawns & ~board.kings)
+    if majors_and_minors <= 6:
+        return "endgame"
+    if majors_and_minors <= 10:
+        return "middlegame"
+    return "opening"
+
+def material_signature(board: Board) -> str:
+    """Material on the board in the usual "KRPvKR" form, White first."""
+    return "v".join(
+        "".join(chess.piece_symbol(piece_type).upper() * len(board.pieces(piece_type, color))
+                for piece_type in [KING, QUEEN, ROOK, BISHOP, KNIGHT, PAWN])
+        for color in [WHITE, BLACK])
+
 def attacked_opponent_pieces(board: Board, from_square: Square, pov: Color) -> List[Piece]:
     return [piece for (piece, _) in attacked_opponent_squares(board, from_square, pov)]
 
@@ -106,6 +125,8 @@ def is_in_bad_spot(board: Board, square: Square) -> bool:
     return (bool(board.attackers(not piece.color, square)) and
             (is_hanging(board, piece, square) or can_be_taken_by_lower_piece(board, piece, square)))
 
+@memo.memoize("is_trapped",
+              lambda board, square: (memo.board_key(board), square))
 def is_trapped(board: Board, square: Square) -> bool:
     if board.is_check() or board.is_pinned(board.turn, square):
         return False
@@ -138,6 +159,34 @@ def attacker_pieces(board: Board, color: Color, square: Square) -> List[Piece]:
 #     return t
 
 
+class CachedBoardNode(ChildNode):
+    """ChildNode that keeps its position, so board(), ply() and turn() don't
+    replay the game from the root on every call."""
+
+    def __init__(self, parent: chess.pgn.GameNode, move: chess.Move, board: Board):
+        super().__init__(parent, move)
+        self._board = board
+
+    def board(self) -> Board:
+        return self._board.copy(stack=False)
+
+    def ply(self) -> int:
+        return self._board.ply()
+
+def cached_mainline(final: Board) -> List[CachedBoardNode]:
+    """Build the mainline of a game from its final board's move stack."""
+    game = chess.pgn.Game()
+    game.setup(final.root())
+    board = final.root()
+    nodes = []
+    node = game
+    for move in final.move_stack:
+        board.push(move)
+        node = CachedBoardNode(node, move, board.copy(stack=False))
+        nodes.append(node)
+    return nodes
+
+
 ###############################################################################
 
 # ---- Additional tactics detection functions ---------------------------------
@@ -157,6 +206,27 @@ def trapped_piece(node: ChildNode) -> bool:
     return False
 
 
+def _cached_board_key(node: chess.pgn.GameNode):
+    """Zobrist hash of a node's position if it keeps it (see
+    CachedBoardNode), else None: any other node would replay the game from
+    the root to build the key, which costs more than the checks cached."""
+    if isinstance(node, CachedBoardNode):
+        return memo.board_key(node._board)
+    return None
+
+
+def _fork_key(node: ChildNode):
+    board_key = _cached_board_key(node)
+    return None if board_key is None else (board_key, node.move.to_square)
+
+
+def _skewer_key(node: ChildNode):
+    board_key = _cached_board_key(node.parent)
+    return None if board_key is None \
+        else (board_key, node.move, node.parent.move)
+
+
+@memo.memoize("fork", _fork_key)
 def fork(node: ChildNode) -> bool:
     """Detect forks."""
     if moved_piece_type(node) is not KING:
@@ -179,6 +249,7 @@ def fork(node: ChildNode) -> bool:
     return False
 
 
+@memo.memoize("skewer", _skewer_key)
 def skewer(node: ChildNode) -> bool:
     """Detect skewers."""
     prev = node.parent
@@ -247,3 +318,54 @@ def captured_piece_was_abs_pinned(node: ChildNode) -> bool:
     return False
 
 
+
+
+# Squares a Greek gift bishop captures on, for each sacrificing side
+greek_gift_squares = {
+    WHITE: chess.BB_H7 | chess.BB_H6,
+    BLACK: chess.BB_H2 | chess.BB_H3,
+}
+
+
+def is_greek_gift(board: Board, move: chess.Move, reply: chess.Move) -> bool:
+    """Check if a move is a bishop sac on h7/h6 (h2/h3 for Black) that the
+    opponent accepts by capturing with the king or a pawn.
+
+    Only looks at square masks and piece bitboards of the position before the
+    sac, so it's safe to call on every ply without generating any SAN.
+    """
+    color = board.turn
+    us = board.occupied_co[color]
+    them = board.occupied_co[not color]
+    from_mask = chess.BB_SQUARES[move.from_square]
+    to_mask = chess.BB_SQUARES[move.to_square]
+
+    # A bishop capturing a pawn on one of the target squares
+    if not (to_mask & greek_gift_squares[color] and
+            from_mask & board.bishops & us and
+            to_mask & board.pawns & them):
+        return False
+
+    # The reply must capture a bishop of the sacrificing side (after the sac)
+    # with the king or a pawn
+    bishops_after = (board.bishops & us & ~from_mask) | to_mask
+    if not chess.BB_SQUARES[reply.to_square] & bishops_after:
+        return False
+    return bool(chess.BB_SQUARES[reply.from_square] &
+                (board.kings | board.pawns) & them)
+
+
+def greek_gifts(game: chess.pgn.Game) -> List[Tuple[int, chess.Move, str]]:
+    """Find accepted Greek gift sacs by either side in a game's mainline.
+
+    :return: (ply, move, FEN before the sac) for each sac found.
+    """
+    found = []
+    board = game.board()
+    moves = list(game.mainline_moves())
+    # Ignore sacs that are the last or penultimate move of the game
+    for i in range(len(moves) - 2):
+        if is_greek_gift(board, moves[i], moves[i + 1]):
+            found.append((board.ply() + 1, moves[i], board.fen()))
+        board.push(moves[i])
+    return found
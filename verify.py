@@ -0,0 +1,322 @@
+"""Asynchronous theory and engine checks of candidate sacs.
+
+detect_sacs.analyse_game(defer_theory_check=True) stops before its two slow
+checks: the number of master games reaching the position (a Lichess Masters
+explorer query, unless there is a local theory index) and the engine's
+only-non-losing check. A Verifier runs them instead on an asyncio event loop
+in a background thread, so games go on being read and analysed while
+candidates wait on the network or the engine. Games' results are handed
+over as soon as they're ready (see the on_result arguments of
+helpers.analyse_games(), helpers.analyse_stream() and
+pipeline.analyse_pgn()).
+
+Up to max_requests explorer queries and max_engines engine searches run at
+once, each engine being a python-chess async engine. The engine isn't
+consulted at all for candidates that the theory check already rejects. The
+explorer is queried with aiohttp when it's installed, and otherwise with
+requests in a thread.
+"""
+
+import asyncio
+import os
+import threading
+import time
+
+import chess
+import chess.engine
+
+import helpers
+import store
+import theory
+
+default_max_requests = 2
+default_max_engines = 2
+# Master games needed for a candidate to count as theory, as in
+# detect_sacs.analyse_game()
+theory_games = 3
+
+
+class Verifier:
+    """Theory and engine checks of candidate sacs, run concurrently on an
+    event loop in a background thread."""
+
+    def __init__(self,
+                 theory_index: str = theory.default_index_path,
+                 online_theory: bool = True,
+                 engine_path: str = helpers.engine_path,
+                 max_requests: int = default_max_requests,
+                 max_engines: int = default_max_engines,
+                 time_per_move: float = 3,
+                 budget: helpers.EngineBudget = None,
+                 results_store: store.ResultStore = None,
+                 candidate_time: float = None):
+        """
+        :param theory_index: path to the local opening-theory index.
+        :param online_theory: whether to query the Lichess Masters explorer
+            when there is no local theory index.
+        :param engine_path: path to the engine.
+        :param max_requests: max number of explorer queries at once.
+        :param max_engines: max number of engines searching at once.
+        :param time_per_move: max seconds of engine time per candidate.
+        :param budget: optional helpers.EngineBudget for the whole run.
+        :param results_store: optional store.ResultStore of verdicts, keyed
+            by candidate link.
+        :param candidate_time: optional cap, in seconds, on each candidate's
+            engine search. helpers.time_limit() deadlines don't reach the
+            event loop, and explorer queries are bounded by
+            helpers.explorer_timeout instead.
+        """
+        self.theory_index = theory_index
+        self.online_theory = online_theory
+        self.engine_path = engine_path
+        self.max_requests = max_requests
+        self.max_engines = max_engines
+        self.time_per_move = time_per_move
+        self.budget = budget or helpers.EngineBudget()
+        self.results_store = results_store
+        self.candidate_time = candidate_time
+        self.verdicts = {}
+        self.requests = 0
+        self.engine_checks = 0
+        self.engine_failures = 0
+        self.theory_failures = 0
+        self._loop = None
+        self._queue = None
+        self._ready = threading.Event()
+        self._error = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+        self._ready.wait()
+        return self
+
+    def submit(self, results: dict):
+        """Queue a game's candidates (from detect_sacs.analyse_game() with
+        defer_theory_check) for checking. Safe to call from any thread."""
+        for can in results["candidates"]:
+            self._loop.call_soon_threadsafe(self._queue.put_nowait, can)
+
+    def finish(self, per_game: list) -> list:
+        """ Wait for every submitted candidate to be checked.
+
+        :param per_game: each game's results.
+
+        :return: per_game, with candidates in master games moved to "theory",
+            and those the engine found to be the only non-losing move moved
+            to "only_nonlosing". Candidates the engine budget didn't stretch
+            to, whose engine died checking them, or whose explorer queries
+            kept failing, are kept, with "engine_checked" set to False.
+        """
+        self._loop.call_soon_threadsafe(self._queue.put_nowait, None)
+        self._thread.join()
+        if self._error:
+            raise self._error
+        checked = []
+        for results in per_game:
+            kept = []
+            in_theory = list(results["theory"])
+            nonlosing = list(results["only_nonlosing"])
+            for can in results["candidates"]:
+                verdict = self.verdicts.get(can["link"], {})
+                if verdict.get("theory"):
+                    in_theory.append(can["link"])
+                elif verdict.get("nonlosing"):
+                    nonlosing.append(can["link"])
+                else:
+                    kept.append({**can, "engine_checked":
+                                 verdict.get("nonlosing") is not None})
+            checked.append({**results, "candidates": kept,
+                            "theory": in_theory,
+                            "only_nonlosing": nonlosing})
+        return checked
+
+    def report(self) -> str:
+        report = (f"{len(self.verdicts)} candidates verified with "
+                  f"{self.requests} explorer queries and "
+                  f"{self.engine_checks} engine checks")
+        if self.engine_failures:
+            report += (f" ({self.engine_failures} left unverified after the "
+                       f"engine died)")
+        if self.theory_failures:
+            report += (f" ({self.theory_failures} left unverified after "
+                       f"failed explorer queries)")
+        return report
+
+    def _run(self):
+        try:
+            asyncio.run(self._main())
+        except Exception as error:
+            self._error = error
+            self._ready.set()
+
+    async def _main(self):
+        self._loop = asyncio.get_running_loop()
+        self._queue = asyncio.Queue()
+        self._requests = asyncio.Semaphore(self.max_requests)
+        self._engines = asyncio.Queue()
+        self._engines_started = 0
+        self._engines_lock = asyncio.Lock()
+        self._resume_at = 0.0
+        self._counts = {}
+        self._session = None
+        # SQLite connections can't be shared between threads
+        verdict_store = self.results_store.reopen() \
+            if self.results_store else None
+        self._ready.set()
+
+        tasks = []
+        try:
+            while True:
+                can = await self._queue.get()
+                if can is None:
+                    break
+                tasks.append(asyncio.create_task(
+                    self._verify(can, verdict_store)))
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+            while not self._engines.empty():
+                await (await self._engines.get()).quit()
+            if self._session:
+                await self._session.close()
+
+    async def _verify(self, can: dict, verdict_store):
+        link = can["link"]
+        stored = verdict_store.load([link]) if verdict_store else {}
+        if link in stored:
+            self.verdicts[link] = stored[link]
+            return
+        try:
+            masters = await self._masters_games(can["theory_fen"])
+        except RuntimeError as error:
+            # Leave this candidate unverified, rather than losing every
+            # other candidate's verdict
+            print(f"Theory check of {link} failed: {error}")
+            self.theory_failures += 1
+            return
+        if masters >= theory_games:
+            # No need for the engine
+            verdict = {"theory": True}
+        else:
+            verdict = {"theory": False,
+                       "nonlosing": await self._uniquely_nonlosing(
+                           can["fen"], can["uci"])}
+        self.verdicts[link] = verdict
+        if verdict_store and verdict.get("nonlosing", True) is not None:
+            verdict_store.save({link: verdict})
+
+    async def _masters_games(self, fen: str) -> int:
+        """Number of master games reaching a position, querying the explorer
+        once per position however many candidates reach it."""
+        if os.path.exists(self.theory_index) or not self.online_theory:
+            return theory.masters_games(chess.Board(fen), self.theory_index,
+                                        online_fallback=False)
+        key = " ".join(fen.split()[:4])
+        if key not in self._counts:
+            self._counts[key] = asyncio.ensure_future(self._query(fen))
+        return await self._counts[key]
+
+    async def _query(self, fen: str) -> int:
+        """Query the explorer, pausing and retrying as
+        helpers.check_position_against_masters_db() does."""
+        failures = 0
+        async with self._requests:
+            while True:
+                await asyncio.sleep(max(self._resume_at - time.monotonic(),
+                                        0))
+                self.requests += 1
+                status, data = await self._get(
+                    {"fen": fen, "topGames": 0, "moves": 30})
+                if status == 200:
+                    await asyncio.sleep(helpers.explorer_pause)
+                    return data["white"] + data["black"] + data["draws"]
+                if status == 429:
+                    # Every query waits, not just this one
+                    print(f"Pausing for {helpers.explorer_pause_429} seconds")
+                    self._resume_at = time.monotonic() + \
+                        helpers.explorer_pause_429
+                    continue
+                failures += 1
+                if failures > helpers.explorer_retries:
+                    raise RuntimeError(
+                        f"Explorer query failed with HTTP {status}: {fen}"
+                        if status else f"Explorer query timed out: {fen}")
+                await asyncio.sleep(helpers.explorer_pause * 2 ** failures)
+
+    async def _get(self, params: dict):
+        """(HTTP status, JSON body or None) of an explorer query. A query
+        with no reply within helpers.explorer_timeout has the status
+        None."""
+        try:
+            import aiohttp
+        except ImportError:
+            import requests
+            try:
+                r = await asyncio.to_thread(
+                    requests.get, helpers.explorer_url, params=params,
+                    timeout=helpers.explorer_timeout)
+            except requests.Timeout:
+                return None, None
+            return r.status_code, r.json() if r.status_code == 200 else None
+        if self._session is None:
+            self._session = aiohttp.ClientSession(
+                timeout=aiohttp.ClientTimeout(total=helpers.explorer_timeout))
+        try:
+            async with self._session.get(helpers.explorer_url,
+                                         params=params) as r:
+                return r.status, await r.json() if r.status == 200 else None
+        except asyncio.TimeoutError:
+            return None, None
+
+    async def _engine(self):
+        """An idle engine, starting a new one if fewer than max_engines are
+        running."""
+        async with self._engines_lock:
+            if self._engines.empty() and \
+                    self._engines_started < self.max_engines:
+                self._engines_started += 1
+                _, engine = await chess.engine.popen_uci(self.engine_path)
+                return engine
+        return await self._engines.get()
+
+    async def _uniquely_nonlosing(self, fen: str, played: str,
+                                  num_engine_moves: int = 5,
+                                  min_depth: int = 12,
+                                  stable_depths: int = 3):
+        """Async version of
+        helpers.check_if_move_is_uniquely_nonlosing_adaptive()."""
+        engine = await self._engine()
+        try:
+            limit = min(self.time_per_move, self.budget.remaining())
+            if self.candidate_time is not None:
+                limit = min(limit, self.candidate_time)
+            if limit <= 0:
+                self.budget.skipped += 1
+                return None
+            board = chess.Board(fen)
+            num_lines = min(num_engine_moves + 1, board.legal_moves.count())
+            verdict = helpers.StableVerdict(
+                board, chess.Move.from_uci(played), num_lines,
+                num_engine_moves, min_depth, stable_depths)
+            self.engine_checks += 1
+            start = time.perf_counter()
+            with await engine.analysis(board,
+                                       chess.engine.Limit(time=limit),
+                                       multipv=num_lines) as analysis:
+                async for info in analysis:
+                    if verdict.update(info):
+                        break
+            self.budget.record(time.perf_counter() - start,
+                               verdict.fixed_cost(self.time_per_move))
+            return verdict.verdict
+        except chess.engine.EngineTerminatedError as error:
+            # Leave this candidate unverified, and start a new engine in
+            # place of this one for the others
+            print(f"Engine died checking {fen}: {error}")
+            self.engine_failures += 1
+            _, engine = await chess.engine.popen_uci(self.engine_path)
+            return None
+        finally:
+            self._engines.put_nowait(engine)